@@ -0,0 +1,124 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import multiprocessing
+
+import pygame
+
+from game import Game
+from scripts.atlas import ensure_atlas
+
+# Each worker process keeps one headless game around, so the assets are only loaded once per worker
+_game = None
+
+def _init_worker():
+    global _game
+    _game = Game(headless=True)
+
+def random_inputs(seed, ticks):
+    """Generate a reproducible stream of button presses, like a player mashing around the level
+
+    :param seed: seed for the generator
+    :param ticks: how many ticks of input to generate
+    :return: a list with the set of actions pressed on each tick
+    """
+    rng = random.Random(seed)
+    inputs = []
+    held = set()
+    for i in range(ticks):
+        # Hold a direction for a while before changing your mind
+        if rng.random() < 0.05:
+            held = {rng.choice(['left', 'right'])} if rng.random() < 0.8 else set()
+        pressed = set(held)
+        if rng.random() < 0.03:
+            pressed.add('jump')
+        if rng.random() < 0.01:
+            pressed.add('dash')
+        inputs.append(pressed)
+    return inputs
+
+def run_episode(episode):
+    """Play one episode on the worker's game and collect its statistics
+
+    :param episode: a dict with the 'map' to load, the RNG 'seed', how many 'ticks' to run for,
+                    and optionally a 'script' of per-tick input sets (random inputs from the seed otherwise)
+    :return: a dict of statistics for the episode
+    """
+    game = _game
+    game.load_level(episode['map'], seed=episode['seed'])
+    script = episode.get('script')
+    if script is None:
+        script = random_inputs(episode['seed'], episode['ticks'])
+
+    survival = None
+    distance = 0
+    last_pos = tuple(game.player.pos)
+    start = time.perf_counter()
+    for tick in range(episode['ticks']):
+        game.step(script[tick] if tick < len(script) else ())
+        distance += math.dist(last_pos, game.player.pos)
+        last_pos = tuple(game.player.pos)
+        if survival is None and game.hits:
+            survival = game.ticks
+    elapsed = time.perf_counter() - start
+
+    return {
+        'map' : episode['map'],
+        'seed' : episode['seed'],
+        'ticks' : episode['ticks'],
+        'survival_ticks' : survival if survival is not None else episode['ticks'], # ticks until the player was first shot
+        'hits' : game.hits,
+        'distance' : distance,
+        'ticks_per_second' : episode['ticks'] / elapsed if elapsed else 0,
+    }
+
+def run_batch(episodes, processes=None):
+    """Fan a list of episodes out across a pool of worker processes
+
+    :param episodes: the episode dicts, see run_episode()
+    :param processes: the number of workers (default one per CPU core)
+    :return: the statistics of every episode, in the same order as the episodes
+    """
+    # Bring the atlas up to date here, once, rather than have every worker find it stale and rebuild it at the same time.
+    # Building it converts images, which needs the (windowless) video system, shut down again before the workers fork
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    pygame.display.init()
+    ensure_atlas()
+    pygame.display.quit()
+    with multiprocessing.Pool(processes, initializer=_init_worker) as pool:
+        return pool.map(run_episode, episodes)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run many headless simulations of the game in parallel')
+    parser.add_argument('maps', nargs='*', default=['data/maps/0.json', 'data/maps/1.json', 'data/maps/2.json'], help='the levels to play')
+    parser.add_argument('--seeds', type=int, default=100, help='how many seeds to play per level')
+    parser.add_argument('--ticks', type=int, default=3600, help='how long each episode lasts')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes (default one per core)')
+    parser.add_argument('--output', default=None, help='write the per-episode statistics to this JSON file')
+    args = parser.parse_args()
+
+    episodes = [{'map' : path, 'seed' : seed, 'ticks' : args.ticks} for path in args.maps for seed in range(args.seeds)]
+    start = time.perf_counter()
+    results = run_batch(episodes, processes=args.processes)
+    elapsed = time.perf_counter() - start
+
+    # Summarize each level
+    for path in args.maps:
+        level = [r for r in results if r['map'] == path]
+        print(path)
+        print('  mean survival: %.1f ticks' % (sum(r['survival_ticks'] for r in level) / len(level)))
+        print('  mean hits: %.2f' % (sum(r['hits'] for r in level) / len(level)))
+        print('  mean distance: %.1f px' % (sum(r['distance'] for r in level) / len(level)))
+        print('  mean ticks/s per worker: %.0f' % (sum(r['ticks_per_second'] for r in level) / len(level)))
+    print('%d episodes, %d ticks in %.1f s (%.0f ticks/s overall)' % (len(results), len(results) * args.ticks, elapsed, len(results) * args.ticks / elapsed))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,280 @@
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import platform
+
+import numpy as np
+import pygame
+
+from game import Game
+from scripts.entities import PhysicsEntity, Enemy
+from scripts.tilemaps import Tilemap
+from scripts.history import EditHistory
+from scripts.physics import BatchPhysics
+from scripts.broadphase import Broadphase
+from scripts.display import Presenter
+from scripts.clouds import Clouds
+
+# Every benchmark registers itself here as name -> (function, the sizes it runs at)
+BENCHMARKS = {}
+
+TILEMAP_SIZES = [1000, 10000, 100000, 1000000]
+FILL_SIZES = [10000, 100000]
+ENTITY_COUNTS = [10, 100, 1000]
+ENEMY_COUNTS = [1000, 5000]
+PARTICLE_COUNTS = [100, 1000, 10000]
+CLOUD_COUNTS = [16, 256, 4096]
+BUNDLED_MAPS = ['data/maps/0.json', 'data/maps/1.json', 'data/maps/2.json']
+WINDOW_SIZES = ['640x480', '1280x960', '1920x1080']
+
+def benchmark(name, sizes):
+    """Register a benchmark
+
+    A benchmark is called with the game and a size, does its setup and returns
+    a function that runs one operation of the hot path being measured.
+    """
+    def register(func):
+        BENCHMARKS[name] = (func, sizes)
+        return func
+    return register
+
+def measure(op, min_time=0.2, repeat=3):
+    """Time an operation, doubling the batch size until a batch takes long enough to trust
+
+    :param op: the function to time
+    :param min_time: the shortest batch in seconds
+    :param repeat: how many batches to time once the batch size is settled
+    :return: a dict with the best and mean seconds per call, and the batch size
+    """
+    def run(number):
+        start = time.perf_counter()
+        for i in range(number):
+            op()
+        return (time.perf_counter() - start) / number
+
+    number = 1
+    timing = run(number)
+    while timing * number < min_time:
+        number *= 2
+        timing = run(number)
+
+    timings = [timing] + [run(number) for i in range(repeat - 1)]
+    return {'best' : min(timings), 'mean' : sum(timings) / len(timings), 'batch' : number}
+
+def synthetic_tilemap(game, n_tiles, seed=0):
+    """Build a square-ish level of roughly n_tiles physics tiles, with ragged terrain and holes in it
+
+    :param game: the game object holding the tile assets
+    :param n_tiles: how many tiles to place
+    :param seed: seed for the layout
+    :return: the Tilemap, and its size in tiles as (width, height)
+    """
+    rng = random.Random(seed)
+    width = max(4, int(math.sqrt(n_tiles * 1.5)))
+    height = math.ceil(n_tiles / width * 1.5)
+    tilemap = Tilemap(game, tile_size=16)
+    placed = 0
+    for y in range(height):
+        for x in range(width):
+            if placed < n_tiles and rng.random() < 0.7:
+                tilemap.set_tile((x, y), rng.choice(['grass', 'stone']), 0)
+                placed += 1
+    return tilemap, (width, height)
+
+def random_positions(size, tile_size, count=1024, seed=1):
+    rng = random.Random(seed)
+    return [(rng.random() * size[0] * tile_size, rng.random() * size[1] * tile_size) for i in range(count)]
+
+def cycle(items):
+    """A function handing out the items one after another, round and round"""
+    state = {'i' : 0}
+    def next_item():
+        state['i'] = (state['i'] + 1) % len(items)
+        return items[state['i']]
+    return next_item
+
+@benchmark('tilemap.tiles_around', TILEMAP_SIZES)
+def bench_tiles_around(game, size):
+    tilemap, dims = synthetic_tilemap(game, size)
+    next_pos = cycle(random_positions(dims, tilemap.tile_size))
+    return lambda: tilemap.tiles_around(next_pos())
+
+@benchmark('tilemap.physics_rects_around', TILEMAP_SIZES)
+def bench_physics_rects_around(game, size):
+    tilemap, dims = synthetic_tilemap(game, size)
+    next_pos = cycle(random_positions(dims, tilemap.tile_size))
+    return lambda: tilemap.physics_rects_around(next_pos())
+
+@benchmark('tilemap.solid_check', TILEMAP_SIZES)
+def bench_solid_check(game, size):
+    tilemap, dims = synthetic_tilemap(game, size)
+    next_pos = cycle(random_positions(dims, tilemap.tile_size))
+    return lambda: tilemap.solid_check(next_pos())
+
+@benchmark('tilemap.autotile', TILEMAP_SIZES)
+def bench_autotile(game, size):
+    tilemap, dims = synthetic_tilemap(game, size)
+    return tilemap.autotile
+
+@benchmark('tilemap.flood_fill', FILL_SIZES)
+def bench_flood_fill(game, size):
+    # An empty box of about `size` cells walled in with stone, filled the way the editor does it:
+    # recorded for undo and autotiled afterwards, alternating the type so every fill changes every cell
+    tilemap = Tilemap(game, tile_size=16)
+    width = int(math.sqrt(size * 1.6))
+    height = size // width
+    tilemap.fill_rect((0, 0, width + 2, height + 2), 'stone', 0)
+    tilemap.erase_rect((1, 1, width, height))
+    tilemap.autotile_dirty()
+    history = EditHistory(tilemap)
+    tile_type = cycle(['grass', 'decor'])
+    def fill():
+        history.begin('flood fill')
+        tilemap.flood_fill((1, 1), tile_type(), 0)
+        tilemap.autotile_dirty()
+        history.end()
+    return fill
+
+@benchmark('tilemap.render', TILEMAP_SIZES)
+def bench_render(game, size):
+    tilemap, dims = synthetic_tilemap(game, size)
+    surface = pygame.Surface((320, 240))
+    # Pan the camera across the level like a player running through it
+    span = max(1, dims[0] * tilemap.tile_size - surface.get_width())
+    state = {'x' : 0}
+    def render():
+        state['x'] = (state['x'] + 2) % span
+        tilemap.render(surface, offset=(state['x'], dims[1] * tilemap.tile_size // 2))
+    return render
+
+@benchmark('entities.update', ENTITY_COUNTS)
+def bench_entities_update(game, count):
+    tilemap, dims = synthetic_tilemap(game, 100000)
+    rng = random.Random(2)
+    entities = [PhysicsEntity(game, 'enemy', pos, (8, 15)) for pos in random_positions(dims, tilemap.tile_size, count=count)]
+    for entity in entities:
+        entity.velocity = [rng.uniform(-1, 1), rng.uniform(-3, 3)]
+    def update():
+        for entity in entities:
+            entity.update(tilemap, (0.5, 0))
+    return update
+
+@benchmark('entities.enemies', ENEMY_COUNTS)
+def bench_enemies(game, count):
+    # Enemies dropped onto a big map, patrolling and shooting like in the game
+    tilemap, dims = synthetic_tilemap(game, 100000)
+    enemies = [Enemy(game, pos, (8, 15)) for pos in random_positions(dims, tilemap.tile_size, count=count)]
+    game.projectiles.clear()
+    def update():
+        for enemy in enemies:
+            enemy.update(tilemap, (0, 0))
+        game.projectiles.clear()
+    return update
+
+@benchmark('entities.enemies_batched', ENEMY_COUNTS)
+def bench_enemies_batched(game, count):
+    # The same horde, moved by BatchPhysics
+    tilemap, dims = synthetic_tilemap(game, 100000)
+    enemies = [Enemy(game, pos, (8, 15)) for pos in random_positions(dims, tilemap.tile_size, count=count)]
+    physics = BatchPhysics()
+    game.projectiles.clear()
+    def update():
+        physics.update(enemies, tilemap)
+        game.projectiles.clear()
+    return update
+
+@benchmark('broadphase.update_pairs', ENEMY_COUNTS)
+def bench_broadphase(game, count):
+    # Re-index a moving horde and find every overlapping pair, as enemy-enemy separation would each tick
+    tilemap, dims = synthetic_tilemap(game, 100000)
+    rng = random.Random(4)
+    enemies = [Enemy(game, pos, (8, 15)) for pos in random_positions(dims, tilemap.tile_size, count=count)]
+    broadphase = Broadphase()
+    broadphase.update(enemies)
+    def update():
+        for enemy in enemies:
+            enemy.pos[0] += rng.uniform(-1, 1)
+        broadphase.update(enemies)
+        return broadphase.pairs()
+    return update
+
+@benchmark('particles.update_render', PARTICLE_COUNTS)
+def bench_particles(game, count):
+    rng = random.Random(3)
+    surface = pygame.Surface((320, 240))
+    particles = game.particles
+    def frame():
+        # Keep the pool topped up, as the dash bursts and leaf spawners do
+        while len(particles) < count:
+            angle = rng.random() * math.pi * 2
+            particles.spawn(rng.choice(['leaf', 'particle']), (rng.random() * 320, rng.random() * 240), velocity=(math.cos(angle), math.sin(angle)), frame=rng.randint(0, 7))
+        particles.update()
+        particles.render(surface)
+    particles.clear()
+    return frame
+
+@benchmark('clouds.render', CLOUD_COUNTS)
+def bench_clouds(game, count):
+    clouds = Clouds(game.assets['clouds'], count=count, background=game.assets['background'])
+    surface = pygame.Surface((320, 240))
+    state = {'x' : 0}
+    def frame():
+        state['x'] += 2
+        clouds.update()
+        clouds.render_background(surface)
+        clouds.render(surface, offset=(state['x'], state['x'] // 4))
+    return frame
+
+@benchmark('game.frame', BUNDLED_MAPS)
+def bench_game_frame(game, map_path):
+    game.load_level(map_path, seed=0)
+    inputs = cycle([{'right'}] * 40 + [{'right', 'jump'}] + [{'left'}] * 40 + [{'left', 'dash'}])
+    def frame():
+        game.step(inputs())
+        game.render()
+    return frame
+
+# Last, as it changes the window the other benchmarks would be drawing into
+@benchmark('display.present', WINDOW_SIZES)
+def bench_present(game, window_size):
+    presenter = Presenter(window_size=[int(n) for n in window_size.split('x')])
+    presenter.display.blit(game.assets['background'], (0, 0))
+    return presenter.present
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths of the game')
+    parser.add_argument('names', nargs='*', help='only run the benchmarks whose name starts with one of these')
+    parser.add_argument('--max-size', type=int, default=None, help='skip benchmark sizes larger than this')
+    parser.add_argument('--min-time', type=float, default=0.2, help='shortest timed batch in seconds')
+    parser.add_argument('--output', default='benchmark.json', help='where to write the results')
+    args = parser.parse_args()
+
+    game = Game(headless=True, seed=0)
+    results = []
+    for name, (func, sizes) in BENCHMARKS.items():
+        if args.names and not any(name.startswith(prefix) for prefix in args.names):
+            continue
+        for size in sizes:
+            if args.max_size is not None and isinstance(size, int) and size > args.max_size:
+                continue
+            random.seed(0)
+            timing = measure(func(game, size), min_time=args.min_time)
+            results.append({'name' : name, 'size' : size, **timing})
+            print('%-32s %-18s %12.3f us/op' % (name, size, timing['best'] * 1e6))
+
+    report = {
+        'created' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python' : platform.python_version(),
+        'pygame' : pygame.version.ver,
+        'numpy' : np.__version__,
+        'machine' : platform.platform(),
+        'results' : results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+
+if __name__ == '__main__':
+    sys.exit(main())
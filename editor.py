@@ -1,27 +1,40 @@
 import sys
+import math
 import pygame
 
-from scripts.utils import load_images
+from scripts.assets import AssetManager
 from scripts.tilemaps import Tilemap
+from scripts.history import EditHistory
+from scripts.autosave import AutoSaver, recover
+from scripts.display import Presenter
 
-RENDER_SCALE = 2.0
+# How fast the camera pans, in pixels per second
+SCROLL_SPEED = 120
+# The longest frame the camera pan accounts for, so a hitch doesn't throw the view across the map
+MAX_FRAME_TIME = 0.1
+# Past this many changed areas in a frame it's cheaper to just show the whole screen
+DIRTY_RECT_LIMIT = 32
 
 class Editor:
-    def __init__(self):
+    def __init__(self, dirty_rects=True, integer_scale=True):
+        """Initialize the Editor object
+
+        :param dirty_rects: only redraw and show the parts of the screen that changed, and sleep while
+                            there's no input (default True; False redraws everything every frame)
+        :param integer_scale: only scale the picture up by whole numbers when the window is resized, which
+                              keeps showing just the changed parts possible (default True)
+        """
+        self.dirty_rects = dirty_rects
         pygame.init()
         pygame.display.set_caption('Editor')
-        self.screen = pygame.display.set_mode((640, 480))
-        self.display = pygame.Surface((320, 240))
+        self.presenter = Presenter(integer_scale=integer_scale, resizable=True)
+        self.display = self.presenter.display
         self.clock = pygame.time.Clock()
 
         # Import mapping assets
-        self.assets = {
-            'decor' : load_images('tiles/decor'),
-            'grass' : load_images('tiles/grass'),
-            'large_decor' : load_images('tiles/large_decor'),
-            'stone' : load_images('tiles/stone'),
-            'spawners' : load_images('tiles/spawners'),
-        }
+        self.assets = AssetManager()
+        self.assets.update(self.assets.tiles())
+        self.assets['spawners'] = self.assets.images('tiles/spawners')
         self.tilemap = Tilemap(self, tile_size=16)
 
         # Loading a pre-existing saved tilemap, if it exists
@@ -30,6 +43,18 @@ class Editor:
         except FileNotFoundError:
             pass
 
+        # Picking up where we left off if the editor went down with edits that were never saved
+        recovered = recover(self.tilemap, 'map.json')
+
+        # Undo/redo of everything we do to the tilemap, one mouse drag or key press at a time
+        self.history = EditHistory(self.tilemap)
+
+        # Saving in the background, plus autosaving whatever we change in between
+        self.saver = AutoSaver(self.tilemap, 'map.json')
+        if recovered:
+            print('Recovered unsaved edits to map.json (press O to save them)')
+            self.saver.checkpoint()
+
         # Need a method for moving the camera around in x and y axes
         self.movement = [False, False, False, False] # left, right, up, down
         self.scroll = [0, 0]
@@ -44,67 +69,179 @@ class Editor:
         self.right_clicking = False
         self.shift = False
         self.ongrid = True
+        self.autotiling = False # Autotile the cells around every edit as we paint
+
+        # Ctrl+dragging fills (left button) or erases (right button) a rectangle and Alt+dragging copies one, all
+        # in one go when the button comes back up
+        self.region_start = None # the grid cell the drag started on
+        self.region_button = None
+        self.region_mode = None # 'fill', 'erase' or 'copy'
+        self.selection = None # the outline drawn over the region, kept while its size stays the same
+        self.stamp = None # the last copied region, for Ctrl+V to paste
+
+        # The tilemap as last drawn, so the overlays can be moved around without redrawing it
+        self.scene = pygame.Surface(self.display.get_size())
+        self.scene_dirty = [self.display.get_rect()] # display areas of the scene that need redrawing
+        # Whatever changes on the tilemap (painting, autotiling, undo...) gets its part of the scene redrawn
+        self.tilemap.add_listener(self.mark_changes)
+        self.last_overlays = [] # display areas the overlays covered last frame
+        self.previews = {} # (type, variant) -> the semi-transparent preview image
+        # How far past its grid cell the biggest tile image reaches, for working out what an edit can touch
+        tile_size = self.tilemap.tile_size
+        self.overhang = (max(img.get_width() for key in self.tile_list for img in self.assets[key]) - tile_size,
+                         max(img.get_height() for key in self.tile_list for img in self.assets[key]) - tile_size)
+
+    def preview_image(self):
+        """The semi-transparent image of the currently selected tile, made once per tile and variant"""
+        key = (self.tile_list[self.tile_group], self.tile_variant)
+        if key not in self.previews:
+            img = self.assets[key[0]][key[1]].copy()
+            img.set_alpha(100)
+            self.previews[key] = img
+        return self.previews[key]
+
+    def selection_image(self, size):
+        """An outlined box the size of the region being dragged out"""
+        if self.selection is None or self.selection.get_size() != size:
+            self.selection = pygame.Surface(size, pygame.SRCALPHA)
+            pygame.draw.rect(self.selection, (255, 255, 255), self.selection.get_rect(), 1)
+        return self.selection
+
+    def region_rect(self, tile_pos):
+        """The (x, y, w, h) grid area from the cell the region drag started on to tile_pos, both included"""
+        x0, y0 = self.region_start
+        return (min(x0, tile_pos[0]), min(y0, tile_pos[1]), abs(tile_pos[0] - x0) + 1, abs(tile_pos[1] - y0) + 1)
+
+    def bulk_edit(self, label, edit, *args):
+        """Run one of the tilemap's bulk operations as a single undoable step, autotiling around it once
+
+        :param label: what to call the step in the history
+        :param edit: the Tilemap method to call
+        :return: whatever edit returns
+        """
+        self.history.begin(label)
+        result = edit(*args)
+        if self.autotiling:
+            self.tilemap.autotile_dirty()
+        self.history.end()
+        return result
+
+    def mark_world(self, rect):
+        """Mark an area of the level (in pixels) as changed, so that part of the scene gets redrawn"""
+        # Positions can be fractional (off-grid tiles), so round the area outwards rather than towards zero
+        left, top = math.floor(rect[0]), math.floor(rect[1])
+        right, bottom = math.ceil(rect[0] + rect[2]), math.ceil(rect[1] + rect[3])
+        self.scene_dirty.append(pygame.Rect(left - int(self.scroll[0]), top - int(self.scroll[1]), right - left, bottom - top))
+
+    def mark_cell(self, tile_pos):
+        """Mark the area a grid cell's tile is drawn over as changed"""
+        tile_size = self.tilemap.tile_size
+        self.mark_world((tile_pos[0] * tile_size, tile_pos[1] * tile_size,
+                         tile_size + self.overhang[0], tile_size + self.overhang[1]))
+
+    def mark_offgrid(self, tile):
+        """Mark the area covered by an off-grid tile's image as changed"""
+        img = self.assets[tile['type']][tile['variant']]
+        # With a pixel to spare all round, for however the fractional position gets rounded when it's drawn
+        self.mark_world(pygame.Rect(math.floor(tile['pos'][0]), math.floor(tile['pos'][1]), img.get_width(), img.get_height()).inflate(2, 2))
+
+    def mark_changes(self, kind, changes):
+        """Tilemap listener: mark the parts of the scene an edit changed, see Tilemap.add_listener()"""
+        if len(changes) >= DIRTY_RECT_LIMIT or len(self.scene_dirty) >= DIRTY_RECT_LIMIT:
+            # A big edit, or lots of small ones in the same frame: cheaper to redraw the whole scene
+            self.scene_dirty = [self.display.get_rect()]
+            return
+        for key, before, after in changes:
+            if kind == 'grid':
+                self.mark_cell(key)
+            else:
+                self.mark_offgrid(before or after)
+
+    def redraw_scene(self, rects):
+        """Redraw the parts of the cached scene (the tilemap without the editor overlays) inside some display rects"""
+        render_scroll = (int(self.scroll[0]), int(self.scroll[1]))
+        for rect in rects:
+            self.scene.set_clip(rect)
+            self.scene.fill((0, 0, 0))
+            self.tilemap.render(self.scene, offset=render_scroll)
+        self.scene.set_clip(None)
 
     def run(self):
         while True:
-            # Black background
-            self.display.fill((0, 0, 0))
+            # Nothing moves on its own in the editor, so while no key or button is held we sleep until the next input
+            idle = self.dirty_rects and not (any(self.movement) or self.clicking or self.right_clicking or self.region_start)
+            # Scroll by time rather than by frame, so the camera moves at the same speed however fast we draw
+            if idle:
+                # ...or until the next autosave is due, if there is anything to autosave
+                due = self.saver.due_in()
+                events = [pygame.event.wait(max(1, int(due * 1000)) if due is not None else 0)] + pygame.event.get()
+                self.clock.tick() # the time spent asleep doesn't count towards the next frame
+                dt = 0
+            else:
+                events = pygame.event.get()
+                dt = min(self.clock.tick(60) / 1000, MAX_FRAME_TIME)
 
             # Moving the camera based on key input
-            self.scroll[0] += (self.movement[1] - self.movement[0]) * 2 # Right - left
-            self.scroll[1] += (self.movement[3] - self.movement[2]) * 2 # Down - Up
-
-            # Rendering the tilemap
+            old_scroll = (int(self.scroll[0]), int(self.scroll[1]))
+            self.scroll[0] += (self.movement[1] - self.movement[0]) * SCROLL_SPEED * dt # Right - left
+            self.scroll[1] += (self.movement[3] - self.movement[2]) * SCROLL_SPEED * dt # Down - Up
             render_scroll = (int(self.scroll[0]), int(self.scroll[1]))
-            self.tilemap.render(self.display, offset=render_scroll)
-
-            # Currently selected tile
-            current_tile_img = self.assets[self.tile_list[self.tile_group]][self.tile_variant].copy()
-            current_tile_img.set_alpha(100)
+            if render_scroll != old_scroll or not self.dirty_rects:
+                # The whole scene moved, so there is nothing to save by tracking the pieces
+                self.scene_dirty = [self.display.get_rect()]
 
             # Getting the current mouse position and converting it into grid coordinates
-            mpos = pygame.mouse.get_pos()
-            mpos = (mpos[0] / RENDER_SCALE, mpos[1] / RENDER_SCALE)
+            mpos = self.presenter.to_render(pygame.mouse.get_pos())
             tile_pos = (int(mpos[0] + self.scroll[0]) // self.tilemap.tile_size, int(mpos[1] + self.scroll[1]) // self.tilemap.tile_size)
 
-            # Previewing the tile we're about to put down
-            if self.ongrid: # Snapped to the tile grid
-                self.display.blit(current_tile_img, (tile_pos[0] * self.tilemap.tile_size - self.scroll[0], tile_pos[1] * self.tilemap.tile_size - self.scroll[1]))
-            else: # Unrestrained by the tile grid
-                self.display.blit(current_tile_img, mpos)
-
             # Placing the tile wherever we left-click
             if self.clicking and self.ongrid:
-                self.tilemap.tilemap[str(tile_pos[0]) + ';' + str(tile_pos[1])] = {'type' : self.tile_list[self.tile_group], 'variant' : self.tile_variant, 'pos' : tile_pos} # {'type' : 'stone', 'variant' : 1, 'pos' : (10, i + 5)}
+                tile = self.tilemap.get_tile(tile_pos)
+                # While autotiling, the variant is picked for us, so leave tiles of the same type alone
+                if not (self.autotiling and tile and tile['type'] == self.tile_list[self.tile_group]):
+                    # Holding the button down over a tile that's already right changes nothing, so there's nothing to redraw either
+                    if not (tile and tile['type'] == self.tile_list[self.tile_group] and tile['variant'] == self.tile_variant):
+                        self.tilemap.set_tile(tile_pos, self.tile_list[self.tile_group], self.tile_variant)
             # Deleting tiles, if any, wherever we right-click
             if self.right_clicking:
-                tile_loc = str(tile_pos[0]) + ';' + str(tile_pos[1])
-                if tile_loc in self.tilemap.tilemap: # Deleting tiles that are snapped to the grid
-                    del self.tilemap.tilemap[tile_loc]
-                for tile in self.tilemap.offgrid_tiles.copy(): # Deleting off-grid tiles
-                    tile_img = self.assets[tile['type']][tile['variant']]
-                    tile_r = pygame.Rect(tile['pos'][0] - self.scroll[0], tile['pos'][1] - self.scroll[1], tile_img.get_width(), tile_img.get_height())
-                    if tile_r.collidepoint(mpos):
-                        self.tilemap.offgrid_tiles.remove(tile)
-
-            # Show the current tile selected in the top left hand corner of the screen
-            self.display.blit(current_tile_img, (5, 5))
-
-            for event in pygame.event.get():
+                if self.tilemap.get_tile(tile_pos):
+                    self.tilemap.remove_tile(tile_pos) # Deleting tiles that are snapped to the grid
+                for tile_id, tile in self.tilemap.offgrid_at((mpos[0] + self.scroll[0], mpos[1] + self.scroll[1])): # Deleting off-grid tiles
+                    self.tilemap.remove_offgrid(tile_id)
+
+            # Fixing up the variants around whatever we just painted or erased
+            if self.autotiling:
+                self.tilemap.autotile_dirty()
+
+            for event in events:
                 # Quitting the level editor
                 if event.type == pygame.QUIT:
+                    self.saver.close()
                     pygame.quit()
                     sys.exit()
 
                 # Laying down currently selected tile when we click down on the mouse
                 if event.type == pygame.MOUSEBUTTONDOWN:
-                    if event.button == 1:
-                        self.clicking = True
-                        # Putting down offgrid tiles, one sprite per click instead of holding down and dragging
-                        if not self.ongrid:
-                            self.tilemap.offgrid_tiles.append({'type' : self.tile_list[self.tile_group], 'variant' : self.tile_variant, 'pos' : (mpos[0] + self.scroll[0], mpos[1] + self.scroll[1])})
-                    if event.button == 3:
-                        self.right_clicking = True
+                    mods = pygame.key.get_mods()
+                    if event.button in (1, 3) and self.ongrid and mods & (pygame.KMOD_CTRL | pygame.KMOD_ALT) and self.region_start is None:
+                        # Starting a region drag instead of painting
+                        self.region_start = tile_pos
+                        self.region_button = event.button
+                        if event.button == 3:
+                            self.region_mode = 'erase'
+                        else:
+                            self.region_mode = 'copy' if mods & pygame.KMOD_ALT else 'fill'
+                    elif event.button in (1, 3):
+                        # Everything painted or erased until the button comes back up is undone in one go
+                        self.history.begin('paint' if event.button == 1 else 'erase')
+                        if event.button == 1:
+                            self.clicking = True
+                            # Putting down offgrid tiles, one sprite per click instead of holding down and dragging
+                            if not self.ongrid:
+                                tile = {'type' : self.tile_list[self.tile_group], 'variant' : self.tile_variant, 'pos' : (mpos[0] + self.scroll[0], mpos[1] + self.scroll[1])}
+                                self.tilemap.add_offgrid(tile)
+                        if event.button == 3:
+                            self.right_clicking = True
                     if self.shift: # If holding shift, using the variant tiles instead
                         if event.button == 4:
                             self.tile_variant = (self.tile_variant - 1) % len(self.assets[self.tile_list[self.tile_group]]) # Number of variant tiles as the limit
@@ -118,10 +255,21 @@ class Editor:
                             self.tile_group = (self.tile_group + 1) % len(self.tile_list)
                             self.tile_variant = 0
                 if event.type == pygame.MOUSEBUTTONUP:
+                    if self.region_start is not None and event.button == self.region_button:
+                        rect = self.region_rect(tile_pos)
+                        if self.region_mode == 'fill':
+                            self.bulk_edit('fill', self.tilemap.fill_rect, rect, self.tile_list[self.tile_group], self.tile_variant)
+                        elif self.region_mode == 'erase':
+                            self.bulk_edit('erase', self.tilemap.erase_rect, rect)
+                        else:
+                            self.stamp = self.tilemap.copy_region(rect)
+                        self.region_start = None
                     if event.button == 1:
                         self.clicking = False
                     if event.button == 3:
                         self.right_clicking = False
+                    if event.button in (1, 3) and not (self.clicking or self.right_clicking):
+                        self.history.end_all()
 
                 # Moving around in the level editor with the arrow keys
                 if event.type == pygame.KEYDOWN:
@@ -136,9 +284,30 @@ class Editor:
                     if event.key == pygame.K_g:
                         self.ongrid = not self.ongrid
                     if event.key == pygame.K_t:
+                        self.history.begin('autotile')
                         self.tilemap.autotile()
+                        self.history.end()
+                    if event.key == pygame.K_z and event.mod & pygame.KMOD_CTRL: # Ctrl+Z undo, Ctrl+Shift+Z redo
+                        if event.mod & pygame.KMOD_SHIFT:
+                            self.history.redo()
+                        else:
+                            self.history.undo()
+                    if event.key == pygame.K_y and event.mod & pygame.KMOD_CTRL: # Ctrl+Y redo
+                        self.history.redo()
+                    if event.key == pygame.K_f and self.ongrid: # Flood fill the area under the cursor
+                        if self.bulk_edit('flood fill', self.tilemap.flood_fill, tile_pos, self.tile_list[self.tile_group], self.tile_variant) is None:
+                            print('Nothing filled: the area is not enclosed, or too big to flood fill')
+                    if event.key == pygame.K_v and event.mod & pygame.KMOD_CTRL and self.stamp: # Ctrl+V pastes the last copied region at the cursor
+                        self.bulk_edit('paste', self.tilemap.paste, self.stamp, tile_pos)
+                    if event.key == pygame.K_l: # Live autotiling while painting
+                        self.autotiling = not self.autotiling
+                        if self.autotiling:
+                            # Catching up on everything painted while it was off, as an undoable step of its own
+                            self.history.begin('autotile')
+                            self.tilemap.autotile_dirty()
+                            self.history.end()
                     if event.key == pygame.K_o:
-                        self.tilemap.save('map.json')
+                        self.saver.save()
                     if event.key == pygame.K_LSHIFT:
                         self.shift = True
                 if event.type == pygame.KEYUP: # Releasing arrow keys stops camera motion
@@ -152,11 +321,51 @@ class Editor:
                         self.movement[3] = False
                     if event.key == pygame.K_LSHIFT:
                         self.shift = False
+                if event.type in (pygame.WINDOWEXPOSED, pygame.VIDEOEXPOSE):
+                    # Something covered the window, so everything on it has to be shown again
+                    self.scene_dirty = [self.display.get_rect()]
+                    self.presenter.invalidate()
+                if event.type == pygame.VIDEORESIZE: # The picture is laid out again to fit the new window
+                    self.presenter.resize()
+                    self.scene_dirty = [self.display.get_rect()]
+
+            self.saver.update()
+            while self.saver.errors:
+                print(self.saver.errors.pop(0))
+
+            # The overlays drawn on top of the scene this frame: the tile preview under the cursor and the selected tile in the corner
+            current_tile_img = self.preview_image()
+            if self.ongrid: # Snapped to the tile grid
+                preview_pos = (tile_pos[0] * self.tilemap.tile_size - render_scroll[0], tile_pos[1] * self.tilemap.tile_size - render_scroll[1])
+            else: # Unrestrained by the tile grid
+                preview_pos = (int(mpos[0]), int(mpos[1]))
+            overlays = [(current_tile_img, current_tile_img.get_rect(topleft=preview_pos)), (current_tile_img, current_tile_img.get_rect(topleft=(5, 5)))]
+            if self.region_start is not None:
+                # The outline of the region being dragged out, cut down to what's on screen
+                tile_size = self.tilemap.tile_size
+                x, y, w, h = self.region_rect(tile_pos)
+                region = pygame.Rect(x * tile_size - render_scroll[0], y * tile_size - render_scroll[1], w * tile_size, h * tile_size)
+                region = region.clip(self.display.get_rect().inflate(2, 2))
+                if region.w and region.h:
+                    overlays.append((self.selection_image(region.size), region))
+
+            # Whatever changed in the scene, plus wherever the overlays were and are now. The overlays are
+            # see-through, so they're always drawn onto freshly restored scene, never on top of themselves
+            if not self.scene_dirty and overlays == self.last_overlays:
+                continue
+            display_rect = self.display.get_rect()
+            self.scene_dirty = [rect.clip(display_rect) for rect in self.scene_dirty]
+            dirty = [rect for rect in self.scene_dirty + [rect.clip(display_rect) for img, rect in self.last_overlays + overlays] if rect.w and rect.h]
 
-            # scaling up the display to the screen size
-            self.screen.blit(pygame.transform.scale(self.display, self.screen.get_size()), (0, 0,))
+            self.redraw_scene(self.scene_dirty)
+            for rect in dirty:
+                self.display.blit(self.scene, rect, rect)
+            for img, rect in overlays:
+                self.display.blit(img, rect)
+            self.presenter.present(dirty if len(dirty) < DIRTY_RECT_LIMIT else None)
 
-            pygame.display.update()
-            self.clock.tick(60)  # ensures 60 FPS
+            self.scene_dirty = []
+            self.last_overlays = overlays
 
-Editor().run()
+if __name__ == '__main__':
+    Editor().run()
@@ -1,142 +1,279 @@
+import os
 import sys
-import math
+import time
 import pygame
 import random
 
-from scripts.utils import load_image, load_images, Animation
-from scripts.entities import PhysicsEntity, Player, Enemy
+from scripts.assets import AssetManager
+from scripts.entities import Player, Enemy
 from scripts.tilemaps import Tilemap
 from scripts.clouds import Clouds
-from scripts.particles import Particle
+from scripts.particles import ParticleSystem
+from scripts.projectiles import ProjectileSystem
+from scripts.profiler import FrameProfiler
+from scripts.streaming import WorldStreamer
+from scripts.physics import BatchPhysics
+from scripts.broadphase import Broadphase
+from scripts.display import Presenter, RENDER_SIZE, WINDOW_SIZE
+
+# Game logic runs at a fixed rate, however fast frames get drawn; all the movement constants are per tick at this rate
+TICK_RATE = 60
+# Frames are drawn at up to this rate, in between ticks when it's faster than TICK_RATE
+MAX_FPS = 120
+# A frame that took longer than this (a stall, dragging the window) only gets this much simulated, so we never spiral into catching up
+MAX_FRAME_TIME = 0.25
 
 class Game:
-    def __init__(self):
+    def __init__(self, headless=False, seed=None, map_path='map.json', profile=False, stream=False, batch_physics=False, max_fps=MAX_FPS,
+                 render_size=RENDER_SIZE, window_size=WINDOW_SIZE, integer_scale=False, scaled=False):
+        """Initialize the Game object
+
+        :param headless: run without a window, for driving the simulation with step() (default False)
+        :param seed: seed for the random number generator, for reproducible runs (default None)
+        :param map_path: the level to load (default 'map.json')
+        :param profile: start with the frame profiler and its overlay switched on (default False, toggle with F3)
+        :param stream: stream the level in and out around the camera instead of loading all of it (needs a binary map, default False)
+        :param batch_physics: move all the enemies together with NumPy instead of one at a time, for levels with hordes of them (default False)
+        :param max_fps: the most frames drawn per second in run(), 0 for no limit (default MAX_FPS)
+        :param render_size: the resolution the game is drawn at (default RENDER_SIZE)
+        :param window_size: the resolution of the window, which can also be resized; the picture is scaled to fit with bars around it (default WINDOW_SIZE)
+        :param integer_scale: only scale the picture up by whole numbers (default False)
+        :param scaled: leave the scaling to SDL's SCALED mode instead (default False)
+        """
+        self.headless = headless
+        self.max_fps = max_fps
+        self.physics = BatchPhysics() if batch_physics else None
+        self.stream = stream
+        self.streamer = None
+        self.profiler = FrameProfiler(enabled=profile)
+        if headless:
+            # SDL's dummy driver still lets us create a "window" and convert images, it just never shows anything
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
+            # Don't let SDL swallow SIGINT/SIGTERM, so batch runs and CI jobs can stop us like any other process
+            os.environ['SDL_NO_SIGNAL_HANDLERS'] = '1'
+
         # Initialize the pygame library
         pygame.init()
 
         # Set the window name
         pygame.display.set_caption('Ninja Game')
 
-        # Set output window resolution
-        self.screen = pygame.display.set_mode((640, 480))
-        self.display = pygame.Surface((320, 240))
+        # Set output window resolution, and the one we draw at
+        self.presenter = Presenter(render_size, window_size, integer_scale=integer_scale, scaled=scaled, resizable=True)
+        self.display = self.presenter.display
 
         self.clock = pygame.time.Clock()
 
+        # mass importing the following asset folders (the animations are only read once something first plays them)
+        self.assets = AssetManager()
+        self.assets.update(self.assets.tiles())
+        self.assets.update({
+            'player' : self.assets.image('entities/player.png'),
+            'background' : self.assets.image('background.png'),
+            'clouds' : self.assets.images('clouds'),
+            'enemy/idle' : self.assets.animation('entities/enemy/idle', img_dur=6),
+            'enemy/run' : self.assets.animation('entities/enemy/run', img_dur=6),
+            'player/idle' : self.assets.animation('entities/player/idle', img_dur=6),
+            'player/run' : self.assets.animation('entities/player/run', img_dur=4),
+            'player/jump' : self.assets.animation('entities/player/jump'),
+            'player/slide' : self.assets.animation('entities/player/slide'),
+            'player/wall_slide' : self.assets.animation('entities/player/wall_slide'),
+            'particle/leaf' : self.assets.animation('particles/leaf', img_dur=20, loop=False),
+            'particle/particle' : self.assets.animation('particles/particle', img_dur=6, loop=False),
+            'gun' : self.assets.image('gun.png'),
+            'projectile': self.assets.image('projectile.png'),
+        })
+
+        self.load_level(map_path, seed=seed)
+
+    def load_level(self, map_path, seed=None):
+        """(Re)start the game on a level, resetting everything but the loaded assets
+
+        :param map_path: the level to load
+        :param seed: seed for the random number generator, for reproducible runs (default None)
+        """
+        if seed is not None:
+            random.seed(seed)
+
         self.movement = [False, False]
+        self.ticks = 0
+        self.hits = 0 # how many times the player has been shot
 
-        # mass importing the following asset folders
-        self.assets = {
-            'decor' : load_images('tiles/decor'),
-            'grass' : load_images('tiles/grass'),
-            'large_decor' : load_images('tiles/large_decor'),
-            'stone' : load_images('tiles/stone'),
-            'player' : load_image('entities/player.png'),
-            'background' : load_image('background.png'),
-            'clouds' : load_images('clouds'),
-            'enemy/idle' : Animation(load_images('entities/enemy/idle'), img_dur=6),
-            'enemy/run' : Animation(load_images('entities/enemy/run'), img_dur=6),
-            'player/idle' : Animation(load_images('entities/player/idle'), img_dur=6),
-            'player/run' : Animation(load_images('entities/player/run'), img_dur=4),
-            'player/jump' : Animation(load_images('entities/player/jump')),
-            'player/slide' : Animation(load_images('entities/player/slide')),
-            'player/wall_slide' : Animation(load_images('entities/player/wall_slide')),
-            'particle/leaf' : Animation(load_images('particles/leaf'), img_dur=20, loop=False),
-            'particle/particle' : Animation(load_images('particles/particle'), img_dur=6, loop=False),
-            'gun' : load_image('gun.png'),
-            'projectile': load_image('projectile.png'),
-        }
-
-        self.clouds = Clouds(self.assets['clouds'], count=16)
+        self.clouds = Clouds(self.assets['clouds'], count=16, area=self.display.get_size(), background=self.assets['background'])
 
         self.player = Player(self, (50, 50), (8, 15))
 
         self.tilemap = Tilemap(self, tile_size=16)
+        self.leaf_spawners = []
+        self.enemies = []
 
-        # TEMPORARY: load the map we made to playtest
-        self.tilemap.load('map.json')
+        # Where every entity is, so they can be looked up by position instead of checking them all
+        self.broadphase = Broadphase()
 
-        # Locate the trees on the tilemap from which we can spawn leaves particles
-        self.leaf_spawners = []
-        for tree in self.tilemap.extract([('large_decor', 2)], keep=True):
-            self.leaf_spawners.append(pygame.Rect(4 + tree['pos'][0], 4 + tree['pos'][1], 23, 13))
+        if self.streamer is not None:
+            self.streamer.close()
+            self.streamer = None
+        if self.stream:
+            # Trees, spawners and tiles come and go with their chunks as the camera moves, see WorldStreamer
+            self.streamer = WorldStreamer(self, map_path)
+            spawn = self.streamer.player_spawn()
+            if spawn is not None:
+                self.player.pos = list(spawn)
+        else:
+            self.tilemap.load(map_path)
 
-        # Spawning the player character and enemy sprites
-        self.enemies = []
-        for spawner in self.tilemap.extract([('spawners', 0), ('spawners', 1)]):
-            if spawner['variant'] == 0:
-                self.player.pos = spawner['pos'] # Player spawning position
-            else:
-                self.enemies.append(Enemy(self, spawner['pos'], (8, 15)))
+            # Locate the trees on the tilemap from which we can spawn leaves particles
+            for tree in self.tilemap.extract([('large_decor', 2)], keep=True):
+                self.leaf_spawners.append(pygame.Rect(4 + tree['pos'][0], 4 + tree['pos'][1], 23, 13))
+
+            # Spawning the player character and enemy sprites
+            for spawner in self.tilemap.extract([('spawners', 0), ('spawners', 1)]):
+                if spawner['variant'] == 0:
+                    self.player.pos = spawner['pos'] # Player spawning position
+                else:
+                    self.spawn_enemy(spawner['pos'])
 
         # Projectile system
-        self.projectiles = []
+        self.projectiles = ProjectileSystem(self, self.assets['projectile'])
 
-        # Particles system
-        self.particles = []
+        # Particles system, with leaves gently swaying side to side as they fall
+        self.particles = ParticleSystem(self, sway={'leaf': 0.3})
 
         # Scrolling and camera handling
         self.scroll = [0, 0]
+        self.prev_scroll = (0, 0)
+        if self.streamer is not None:
+            # Start on the player rather than panning over from the origin, which could be half the world away
+            self.scroll = [self.player.rect().centerx - self.display.get_width() / 2, self.player.rect().centery - self.display.get_height() / 2]
 
-    def run(self):
-        while True:
-            # Clearing the screen
-            self.display.blit(self.assets['background'], (0, 0))
+    def spawn_enemy(self, pos):
+        """Add an enemy to the level
+
+        :param pos: its pixel position
+        :return: the new Enemy
+        """
+        enemy = Enemy(self, pos, (8, 15))
+        self.enemies.append(enemy)
+        return enemy
+
+    def step(self, inputs=()):
+        """Advance the simulation by one fixed 1/60 s tick without drawing anything
+
+        :param inputs: the actions pressed this tick, any of 'left', 'right', 'jump' and 'dash'
+        """
+        self.movement = ['left' in inputs, 'right' in inputs]
+        if 'jump' in inputs:
+            self.player.jump()
+        if 'dash' in inputs:
+            self.player.dash()
+        self.update()
+
+    def update(self):
+        """Run one tick of the game logic: camera, spawners, entities, projectiles and particles"""
+        self.ticks += 1
+        profiler = self.profiler
+        self.prev_scroll = (self.scroll[0], self.scroll[1])
+
+        # Move towards the player at a dynamic rate
+        self.scroll[0] += (self.player.rect().centerx - self.display.get_width()/2 - self.scroll[0]) / 30
+        self.scroll[1] += (self.player.rect().centery - self.display.get_height()/2 - self.scroll[1]) / 30
 
-            # Move towards the player at a dynamic rate
-            self.scroll[0] += (self.player.rect().centerx - self.display.get_width()/2 - self.scroll[0]) / 30
-            self.scroll[1] += (self.player.rect().centery - self.display.get_height()/2 - self.scroll[1]) / 30
-            # Fixing subpixel "jitter" during camera motion
-            render_scroll = (int(self.scroll[0]), int(self.scroll[1]))
+        if self.streamer is not None:
+            self.streamer.update()
+            profiler.mark('update.streaming')
 
-            # Spawning particles
-            for rect in self.leaf_spawners:
-                if random.random() * 49999 < rect.width * rect.height:
-                    # Any random space within bounds of the rectangle
-                    pos = (rect.x + random.random() * rect.width, rect.y + random.random() * rect.height)
-                    self.particles.append(Particle(self, 'leaf', pos, velocity=[-0.1, 0.3], frame=random.randint(0, 20)))
+        # Spawning particles
+        for rect in self.leaf_spawners:
+            if random.random() * 49999 < rect.width * rect.height:
+                # Any random space within bounds of the rectangle
+                pos = (rect.x + random.random() * rect.width, rect.y + random.random() * rect.height)
+                self.particles.spawn('leaf', pos, velocity=[-0.1, 0.3], frame=random.randint(0, 20))
+        profiler.mark('update.spawners')
 
-            # Draw the clouds before the tiles so they're in the background
-            self.clouds.update()
-            self.clouds.render(self.display, offset=render_scroll)
+        self.clouds.update()
+        profiler.mark('update.clouds')
 
-            # Rendering the tilemap behind the player
-            self.tilemap.render(self.display, offset=render_scroll)
+        self.broadphase.update([self.player] + self.enemies)
+        profiler.mark('update.broadphase')
 
+        if self.physics is not None:
+            self.physics.update(self.enemies.copy(), self.tilemap)
+        else:
             for enemy in self.enemies.copy():
                 enemy.update(self.tilemap, (0, 0))
-                enemy.render(self.display, offset=render_scroll)
-
-            # Calculate the horizontal movement vector and account for physics and collisions
-            self.player.update(self.tilemap, (self.movement[1] - self.movement[0], 0)) # in a platformer you move left to right
-
-            # Rendering the moveable player sprite
-            self.player.render(self.display, offset=render_scroll)
-
-            # Updating and drawing any projectiles
-            for projectile in self.projectiles.copy(): # [[x, y], direction, timer]
-                projectile[0][0] += projectile[1]
-                projectile[2] += 1
-                img = self.assets['projectile']
-                self.display.blit(img, (projectile[0][0] - img.get_width() / 2 - render_scroll[0], projectile[0][1] - img.get_height() / 2 - render_scroll[1]))
-                if self.tilemap.solid_check(projectile[0]):
-                    self.projectiles.remove(projectile)
-                elif projectile[2] > 360:
-                    self.projectiles.remove(projectile)
-                elif abs(self.player.dashing) < 50:
-                    # Check whether Player is getting hit by the projectile
-                    if self.player.rect().collidepoint(projectile[0]):
-                        self.projectiles.remove(projectile)
-                        print("HIT")
-
-            # Managing the particles system
-            for particle in self.particles.copy():
-                kill = particle.update()
-                particle.render(self.display, offset=render_scroll)
-                if particle.type == 'leaf':
-                    particle.position[0] += math.sin(particle.animation.frame * 0.035) * 0.3
-                if kill:
-                    self.particles.remove(particle)
+        profiler.mark('update.enemies')
+
+        # Calculate the horizontal movement vector and account for physics and collisions
+        self.player.update(self.tilemap, (self.movement[1] - self.movement[0], 0)) # in a platformer you move left to right
+        profiler.mark('update.player')
+
+        # Updating any projectiles
+        self.projectiles.update(self.tilemap)
+        if abs(self.player.dashing) < 50:
+            # Check whether Player is getting hit by any projectile
+            for target in self.broadphase.hit_test_projectiles(self.projectiles, [self.player]):
+                self.hits += 1
+                if not self.headless:
+                    print("HIT")
+        profiler.mark('update.projectiles')
+
+        self.particles.update()
+        profiler.mark('update.particles')
+
+        profiler.count('enemies', len(self.enemies))
+        profiler.count('projectiles', len(self.projectiles))
+        profiler.count('particles', len(self.particles))
+
+    def render(self, alpha=1):
+        """Draw the current state of the game onto the display surface
+
+        :param alpha: how far we are between the last tick and the next one, from 0 to 1; moving things are drawn
+                      that far along from their previous position to their current one (default 1, just the current state)
+        """
+        profiler = self.profiler
+
+        # Clearing the screen
+        self.clouds.render_background(self.display)
+        profiler.mark('render.background')
+
+        # Fixing subpixel "jitter" during camera motion
+        back = 1 - alpha
+        render_scroll = (int(self.scroll[0] - (self.scroll[0] - self.prev_scroll[0]) * back), int(self.scroll[1] - (self.scroll[1] - self.prev_scroll[1]) * back))
+
+        # Draw the clouds before the tiles so they're in the background
+        self.clouds.render(self.display, offset=render_scroll)
+        profiler.mark('render.clouds')
+
+        # Rendering the tilemap behind the player
+        self.tilemap.render(self.display, offset=render_scroll)
+        profiler.mark('render.tilemap')
+
+        for enemy in self.enemies:
+            enemy.render(self.display, offset=render_scroll, alpha=alpha)
+        profiler.mark('render.enemies')
+
+        # Rendering the moveable player sprite
+        self.player.render(self.display, offset=render_scroll, alpha=alpha)
+        profiler.mark('render.player')
+
+        self.projectiles.render(self.display, offset=render_scroll, alpha=alpha)
+        profiler.mark('render.projectiles')
+
+        self.particles.render(self.display, offset=render_scroll)
+        profiler.mark('render.particles')
+
+    def run(self):
+        """The main loop: a fixed-rate simulation, drawn as often as the machine manages
+
+        Real time goes into an accumulator that is spent in whole ticks of 1/TICK_RATE seconds, so
+        the game runs at the same speed whatever the frame rate; slow frames just mean several
+        ticks in one frame. Whatever is left over sets how far to interpolate when drawing.
+        """
+        tick = 1 / TICK_RATE
+        accumulator = tick # so there is a tick before the first frame
+        last_time = time.perf_counter()
+        while True:
+            self.profiler.start_frame()
 
             # Event-handling logic
             for event in pygame.event.get():
@@ -153,16 +290,36 @@ class Game:
                         self.player.jump()
                     if event.key == pygame.K_x:
                         self.player.dash()
+                    if event.key == pygame.K_F3: # Frame profiler and its overlay
+                        self.profiler.toggle()
+                    if event.key == pygame.K_F4: # Dump what the profiler recorded for chrome://tracing
+                        self.profiler.export_trace('trace.json')
                 if event.type == pygame.KEYUP: # Releasing a key
                     if event.key ==  pygame.K_LEFT:
                         self.movement[0] = False
                     if event.key == pygame.K_RIGHT:
                         self.movement[1] = False
+                if event.type == pygame.VIDEORESIZE: # The picture is laid out again to fit the new window
+                    self.presenter.resize()
+            self.profiler.mark('events')
+
+            while accumulator >= tick:
+                self.update()
+                accumulator -= tick
+            self.render(accumulator / tick)
+            self.profiler.render(self.display)
 
             # scaling up the display to the screen size
-            self.screen.blit(pygame.transform.scale(self.display, self.screen.get_size()), (0, 0,))
+            self.presenter.present()
+            self.profiler.mark('present')
+            self.profiler.end_frame()
+            self.clock.tick(self.max_fps) # caps the frame rate, the simulation doesn't depend on it
 
-            pygame.display.update()
-            self.clock.tick(60)  # ensures 60 FPS
+            now = time.perf_counter()
+            accumulator += min(now - last_time, MAX_FRAME_TIME)
+            last_time = now
 
-Game().run()
+if __name__ == '__main__':
+    # python game.py [map] [--stream] [--scaled]
+    args = [arg for arg in sys.argv[1:] if arg not in ('--stream', '--scaled')]
+    Game(map_path=args[0] if args else 'map.json', stream='--stream' in sys.argv, scaled='--scaled' in sys.argv).run()
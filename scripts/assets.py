@@ -0,0 +1,233 @@
+import io
+import os
+import struct
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import pygame
+
+from scripts.atlas import load_atlas
+from scripts.utils import BASE_IMAGE_PATH, AnimationClip
+
+# Decoded pixels are cached here under the hash of the file they came from, so a changed file never hits a stale entry
+CACHE_DIR = '.cache/assets/'
+CACHE_HEADER = struct.Struct('<4sHH') # magic, width, height, then width * height * 3 bytes of RGB
+CACHE_MAGIC = b'RAW1'
+
+# The tile folders, shared by the game and the level editor
+TILE_ASSETS = {
+    'decor' : 'tiles/decor',
+    'grass' : 'tiles/grass',
+    'large_decor' : 'tiles/large_decor',
+    'stone' : 'tiles/stone',
+}
+
+class _Lazy:
+    __slots__ = ('loader',)
+
+    def __init__(self, loader):
+        self.loader = loader
+
+class AssetManager(dict):
+    def __init__(self, workers=None, cache_dir=CACHE_DIR, use_atlas=True):
+        """A dict-like store of the game's images and animations
+
+        Images come out of the packed atlas (see scripts/atlas.py) when there is one, and are
+        decoded on a thread pool otherwise. Either way each decoded file is also cached on disk
+        as raw pixels, which load several times faster than PNGs. Entries added with lazy() are
+        only loaded the first time they are looked up.
+
+        Needs the display mode to be set, since images get converted to the display format.
+
+        :param workers -- the number of decoding threads (default: let ThreadPoolExecutor pick)
+        :param cache_dir -- where to keep the raw pixel cache, or None to not cache
+        :param use_atlas -- whether to load from the atlas
+        """
+        super().__init__()
+        self.workers = workers
+        self.cache_dir = cache_dir
+        self.pending = {} # key -> _Lazy of the entries not loaded yet
+        self.atlas = load_atlas(load=self.load_surface) if use_atlas else None
+
+    # -- decoding --
+
+    def _cache_path(self, data):
+        return self.cache_dir + hashlib.sha1(data).hexdigest() + '.raw'
+
+    def _decode(self, path):
+        """Read an image file into an unconverted surface, through the raw pixel cache (safe to call from any thread)"""
+        f = open(path, 'rb')
+        data = f.read()
+        f.close()
+
+        cache_path = self._cache_path(data) if self.cache_dir else None
+        if cache_path and os.path.exists(cache_path):
+            f = open(cache_path, 'rb')
+            raw = f.read()
+            f.close()
+            magic, width, height = CACHE_HEADER.unpack_from(raw)
+            if magic == CACHE_MAGIC and len(raw) == CACHE_HEADER.size + width * height * 3:
+                return pygame.image.frombytes(raw[CACHE_HEADER.size:], (width, height), 'RGB')
+
+        img = pygame.image.load(io.BytesIO(data), os.path.basename(path))
+        if cache_path:
+            # Just the RGB channels: convert() drops the alpha channel without blending anyway
+            raw = CACHE_HEADER.pack(CACHE_MAGIC, img.get_width(), img.get_height()) + pygame.image.tobytes(img, 'RGB')
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                # Write under a temporary name first, so another process never reads half a file
+                f = open(cache_path + '.%d.tmp' % os.getpid(), 'wb')
+                f.write(raw)
+                f.close()
+                os.replace(cache_path + '.%d.tmp' % os.getpid(), cache_path)
+            except OSError:
+                pass
+        return img
+
+    def load_surface(self, path):
+        """Load an image file converted to the display format (no colorkey)
+
+        :param path -- the file path of the image
+        """
+        return self._decode(path).convert()
+
+    def load_files(self, paths):
+        """Load many image files at once, decoding them in parallel
+
+        :param paths -- the image paths relative to BASE_IMAGE_PATH
+        :return -- the colorkeyed images, in the same order
+        """
+        with ThreadPoolExecutor(self.workers) as pool:
+            decoded = list(pool.map(self._decode, [BASE_IMAGE_PATH + path for path in paths]))
+        images = []
+        for img in decoded:
+            # Converting touches the display, so that part stays on this thread
+            img = img.convert()
+            img.set_colorkey((0, 0, 0))
+            images.append(img)
+        return images
+
+    # -- loading --
+
+    def image(self, path):
+        """Load one image
+
+        :param path -- the image path relative to BASE_IMAGE_PATH, e.g. 'gun.png'
+        """
+        if self.atlas and path in self.atlas:
+            img = self.atlas.image(path)
+            img.set_colorkey((0, 0, 0))
+            return img
+        return self.load_files([path])[0]
+
+    def images(self, path):
+        """Load every image in a folder, in file name order
+
+        :param path -- the folder relative to BASE_IMAGE_PATH, e.g. 'tiles/grass'
+        """
+        names = self.atlas.listdir(path) if self.atlas else []
+        if not names:
+            names = sorted(os.listdir(BASE_IMAGE_PATH + path))
+        paths = [path + '/' + name for name in names]
+        if self.atlas and all(p in self.atlas for p in paths):
+            return [self.image(p) for p in paths]
+        return self.load_files(paths)
+
+    def animation(self, path, img_dur=5, loop=True):
+        """An AnimationClip over every image in a folder that is only loaded when it's first looked up"""
+        return _Lazy(lambda: AnimationClip(self.images(path), img_dur=img_dur, loop=loop))
+
+    def lazy(self, loader):
+        """Wrap a function so that its result is only made when the entry is first looked up"""
+        return _Lazy(loader)
+
+    def tiles(self):
+        """Load the tile images shared by the game and the editor
+
+        :return -- {tile type: list of images}
+        """
+        return {tile_type : self.images(path) for tile_type, path in TILE_ASSETS.items()}
+
+    # -- dict interface --
+    # Loaded entries live in the dict itself, so looking them up costs no more than a plain dict;
+    # lazy ones wait in self.pending until __missing__ loads them on first lookup
+
+    def __missing__(self, key):
+        value = self.pending.pop(key).loader()
+        dict.__setitem__(self, key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        if type(value) is _Lazy:
+            dict.pop(self, key, None)
+            self.pending[key] = value
+        else:
+            self.pending.pop(key, None)
+            dict.__setitem__(self, key, value)
+
+    # Everything that goes through the whole store sees the lazy entries too, loading them as it gets to them
+
+    def update(self, entries=(), **kwargs):
+        """Add entries like dict.update(), from a mapping or (key, value) pairs, lazy ones included"""
+        if hasattr(entries, 'keys'):
+            entries = [(key, entries[key]) for key in entries.keys()]
+        for key, value in list(entries) + list(kwargs.items()):
+            self[key] = value
+
+    def __delitem__(self, key):
+        if self.pending.pop(key, None) is None:
+            dict.__delitem__(self, key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.pending
+
+    def __iter__(self):
+        yield from dict.__iter__(self)
+        yield from self.pending
+
+    def __len__(self):
+        return dict.__len__(self) + len(self.pending)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def clear(self):
+        dict.clear(self)
+        self.pending.clear()
+
+    def copy(self):
+        """A shallow copy that shares the atlas, with the lazy entries still waiting to be loaded"""
+        other = type(self).__new__(type(self))
+        dict.update(other, dict.items(self))
+        other.workers = self.workers
+        other.cache_dir = self.cache_dir
+        other.atlas = self.atlas
+        other.pending = dict(self.pending)
+        return other
+
+    def is_loaded(self, key):
+        """Whether an entry has been loaded yet (lazy entries aren't until they are first looked up)"""
+        return dict.__contains__(self, key)
@@ -0,0 +1,170 @@
+import os
+import json
+
+import pygame
+
+from scripts.utils import BASE_IMAGE_PATH
+
+# The packed sheet and its manifest are build artifacts, regenerated whenever an image under BASE_IMAGE_PATH changes
+ATLAS_IMAGE = 'data/atlas.png'
+ATLAS_MANIFEST = 'data/atlas.json'
+ATLAS_WIDTH = 512
+ATLAS_VERSION = 1
+
+def scan_sources(base=BASE_IMAGE_PATH):
+    """Find every PNG under a directory
+
+    :param base -- the directory to search
+    :return -- {path relative to base: [mtime in ns, size in bytes]}, used to tell when the atlas is stale
+    """
+    sources = {}
+    pending = ['']
+    while pending:
+        directory = pending.pop()
+        for entry in os.scandir(base + directory):
+            rel = directory + entry.name
+            if entry.is_dir():
+                pending.append(rel + '/')
+            elif entry.name.endswith('.png'):
+                stat = entry.stat()
+                sources[rel] = [stat.st_mtime_ns, stat.st_size]
+    return sources
+
+def pack(sizes, width=ATLAS_WIDTH):
+    """Lay rectangles out on shelves, tallest first
+
+    :param sizes -- {name: (w, h)}
+    :param width -- the width of the sheet
+    :return -- ({name: (x, y, w, h)}, height of the sheet)
+    """
+    rects = {}
+    x = y = shelf = 0
+    for name in sorted(sizes, key=lambda name: (-sizes[name][1], name)):
+        w, h = sizes[name]
+        if x + w > width:
+            x, y = 0, y + shelf
+            shelf = 0
+        rects[name] = (x, y, w, h)
+        x += w
+        shelf = max(shelf, h)
+    return rects, y + shelf
+
+def _temp_path(path):
+    """A temporary name next to path for this process to write to, keeping the extension (pygame picks the image format by it)"""
+    root, ext = os.path.splitext(path)
+    return '%s.%d.tmp%s' % (root, os.getpid(), ext)
+
+def build_atlas(base=BASE_IMAGE_PATH, image_path=ATLAS_IMAGE, manifest_path=ATLAS_MANIFEST):
+    """Pack every image under base into one sheet, and write it out along with its manifest
+
+    :param base -- the directory holding the source PNGs
+    :param image_path -- where the packed sheet goes
+    :param manifest_path -- where the manifest (the rectangle of every source image) goes
+    :return -- the manifest
+    """
+    sources = scan_sources(base)
+    images = {rel: pygame.image.load(base + rel) for rel in sources}
+    width = max([ATLAS_WIDTH] + [img.get_width() for img in images.values()])
+    frames, height = pack({rel: img.get_size() for rel, img in images.items()}, width)
+
+    sheet = pygame.Surface((width, max(1, height)), 0, 24)
+    for rel, img in images.items():
+        # Converting drops the alpha channel without blending, the same thing convert() does to each image at load
+        sheet.blit(img.convert(sheet), frames[rel][:2])
+    # Both files are written under temporary names first, so another process never reads half of one
+    temp_path = _temp_path(image_path)
+    pygame.image.save(sheet, temp_path)
+    os.replace(temp_path, image_path)
+
+    manifest = {'version' : ATLAS_VERSION, 'image' : os.path.basename(image_path), 'sources' : sources, 'frames' : frames}
+    temp_path = _temp_path(manifest_path)
+    f = open(temp_path, 'w')
+    json.dump(manifest, f)
+    f.close()
+    os.replace(temp_path, manifest_path)
+    return manifest
+
+class Atlas:
+    def __init__(self, sheet, frames):
+        """The images of a packed sheet, cut out once and handed out by their original path
+
+        Each frame is copied out of the sheet rather than kept as a subsurface, since blitting
+        a subsurface is noticeably slower and these get blitted every frame.
+
+        :param sheet -- the converted sheet surface
+        :param frames -- {path relative to BASE_IMAGE_PATH: (x, y, w, h)}
+        """
+        self.frames = {}
+        self.directories = {} # directory -> sorted file names in it, so load_images() never has to list the disk
+        for rel, rect in frames.items():
+            self.frames[rel] = sheet.subsurface(rect).copy()
+            directory, name = rel.rpartition('/')[::2]
+            self.directories.setdefault(directory, []).append(name)
+        for names in self.directories.values():
+            names.sort()
+
+    def __contains__(self, path):
+        return path in self.frames
+
+    def image(self, path):
+        return self.frames[path]
+
+    def listdir(self, directory):
+        return self.directories.get(directory.rstrip('/'), [])
+
+def _read_manifest(manifest_path, image_path):
+    """The manifest on disk, or None if there's no usable one"""
+    if not (os.path.exists(manifest_path) and os.path.exists(image_path)):
+        return None
+    try:
+        f = open(manifest_path, 'r')
+        manifest = json.load(f)
+        f.close()
+    except (OSError, ValueError):
+        return None
+    return manifest
+
+def ensure_atlas(base=BASE_IMAGE_PATH, image_path=ATLAS_IMAGE, manifest_path=ATLAS_MANIFEST, rebuild=False):
+    """Rebuild the atlas if it is missing, unreadable or any source image changed
+
+    Call this once before starting several processes that load the atlas, so they don't all rebuild it at the same time.
+
+    :param rebuild -- rebuild it whatever state it's in (e.g. the sheet turned out to be unreadable)
+    :return -- the manifest, or None if the atlas can't be built (e.g. a read-only checkout)
+    """
+    manifest = None if rebuild else _read_manifest(manifest_path, image_path)
+    if manifest is None or manifest.get('version') != ATLAS_VERSION or manifest.get('sources') != scan_sources(base):
+        try:
+            manifest = build_atlas(base, image_path, manifest_path)
+        except OSError:
+            return None
+    return manifest
+
+def load_atlas(base=BASE_IMAGE_PATH, image_path=ATLAS_IMAGE, manifest_path=ATLAS_MANIFEST, load=None):
+    """Load the atlas, rebuilding it first if it is missing, unreadable or any source image changed
+
+    Needs the display mode to be set, since the sheet gets converted to the display format.
+
+    :param load -- the function reading the sheet into a converted surface (default pygame.image.load + convert)
+    :return -- the Atlas, or None if it can't be built (e.g. a read-only checkout), in which case load the PNGs one by one
+    """
+    if load is None:
+        load = lambda path: pygame.image.load(path).convert()
+    manifest = ensure_atlas(base, image_path, manifest_path)
+    if manifest is None:
+        return None
+    try:
+        sheet = load(image_path)
+    except pygame.error:
+        # A sheet that can't be read (e.g. cut short by a crash) is as good as missing
+        manifest = ensure_atlas(base, image_path, manifest_path, rebuild=True)
+        if manifest is None:
+            return None
+        sheet = load(image_path)
+    return Atlas(sheet, manifest['frames'])
+
+if __name__ == '__main__':
+    # python -m scripts.atlas  (rebuild data/atlas.png and data/atlas.json)
+    pygame.init()
+    manifest = build_atlas()
+    print('packed %d images into %s' % (len(manifest['frames']), ATLAS_IMAGE))
@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import queue
+import threading
+
+from scripts.history import EditCommand
+from scripts.mapfile import write_atomic
+
+# How often unsaved edits are written out, in seconds
+AUTOSAVE_INTERVAL = 30
+# Once the journal holds this many cell changes, the next autosave writes a full checkpoint instead and starts it over
+CHECKPOINT_AFTER = 20000
+
+def _file_stamp(path):
+    """Size and modification time of a file, to tell whether it is still the one a journal was started against"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+def _journal_entry(command):
+    """The net changes of an EditCommand as one JSON line of the journal"""
+    grid = []
+    for pos, (before, after) in command.grid.items():
+        grid.append([pos[0], pos[1]] + (list(after) if after is not None else []))
+    remove = [before for before, after in command.offgrid.values() if before is not None]
+    add = [after for before, after in command.offgrid.values() if after is not None]
+    return json.dumps({'grid' : grid, 'remove' : remove, 'add' : add}) + '\n'
+
+class AutoSaver:
+    def __init__(self, tilemap, path, interval=AUTOSAVE_INTERVAL, checkpoint_after=CHECKPOINT_AFTER):
+        """Saves a tilemap in the background, and keeps unsaved edits safe on disk as they happen
+
+        save() writes the map itself. In between, update() writes the edits made since the last
+        write every `interval` seconds, as one line appended to `path + '.journal'`, so an autosave
+        costs as much as the edits rather than the whole map. Once the journal gets long, the whole
+        map is checkpointed into `path + '.autosave'` instead and the journal starts over from it.
+        recover() puts the two back together after a crash.
+
+        All the writing happens on a worker thread, from a snapshot taken on the calling thread, so
+        nothing stalls the editor; full writes are atomic (a temporary file renamed into place).
+
+        :param tilemap -- the Tilemap to save
+        :param path -- where save() writes the map; the autosave files go next to it
+        :param interval -- how often update() writes pending edits, in seconds
+        :param checkpoint_after -- how many cell changes the journal holds before it is rolled into a checkpoint
+        """
+        self.tilemap = tilemap
+        self.path = path
+        self.autosave_path = path + '.autosave'
+        self.journal_path = path + '.journal'
+        self.interval = interval
+        self.checkpoint_after = checkpoint_after
+
+        self.pending = EditCommand() # net changes not written anywhere yet
+        self.journal_size = 0 # cell changes in the journal since its base
+        self.journal_started = False # whether the journal on disk belongs to this session yet
+        self.last_write = time.monotonic()
+        self.errors = [] # messages of writes that failed, for the caller to report
+        tilemap.add_listener(self.record)
+
+        # The worker only ever writes files; snapshots and journal lines are made here, on the calling thread
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _worker(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            try:
+                job()
+            except OSError as e:
+                self.errors.append('autosave failed: %s' % e)
+
+    def record(self, kind, changes):
+        """The tilemap listener: collect the net change to every cell since the last write"""
+        self.pending.record(kind, changes)
+
+    def _take_pending(self):
+        command, self.pending = self.pending, EditCommand()
+        return command
+
+    def dirty(self):
+        """Whether there are edits that haven't been handed to the worker yet"""
+        return bool(len(self.pending))
+
+    def due_in(self):
+        """How many seconds until update() writes something, or None if there is nothing to write"""
+        if not self.dirty():
+            return None
+        return max(0, self.last_write + self.interval - time.monotonic())
+
+    def save(self):
+        """Write the whole map to its path in the background; the autosave files are then out of date and get removed"""
+        self._take_pending()
+        snapshot = self.tilemap.snapshot()
+        self.journal_started = False
+        self.journal_size = 0
+        self.last_write = time.monotonic()
+
+        def job():
+            snapshot.save(self.path)
+            # The journal goes first: without it nothing gets recovered, whether or not the checkpoint is still there
+            for path in (self.journal_path, self.autosave_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        self.jobs.put(job)
+
+    def checkpoint(self):
+        """Write the whole map to the autosave file in the background, and start the journal over from it"""
+        self._take_pending()
+        snapshot = self.tilemap.snapshot()
+        self.journal_started = True
+        self.journal_size = 0
+        self.last_write = time.monotonic()
+
+        def job():
+            snapshot.save(self.autosave_path)
+            header = {'base' : os.path.basename(self.autosave_path), 'stamp' : _file_stamp(self.autosave_path)}
+            write_atomic(self.journal_path, (json.dumps(header) + '\n').encode('utf-8'))
+        self.jobs.put(job)
+
+    def autosave(self):
+        """Write whatever changed since the last write, as a journal line or, once the journal is long, a checkpoint"""
+        if not self.dirty():
+            return
+        if self.journal_size + len(self.pending) > self.checkpoint_after:
+            self.checkpoint()
+            return
+
+        command = self._take_pending()
+        self.journal_size += len(command)
+        self.last_write = time.monotonic()
+        entry = _journal_entry(command)
+        start = not self.journal_started
+        self.journal_started = True
+
+        def job():
+            if start:
+                # The first journal of a session builds on the map file as it is right now
+                header = {'base' : os.path.basename(self.path), 'stamp' : _file_stamp(self.path)}
+                write_atomic(self.journal_path, (json.dumps(header) + '\n').encode('utf-8'))
+            f = open(self.journal_path, 'a')
+            f.write(entry)
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+        self.jobs.put(job)
+
+    def update(self):
+        """Call this every frame: autosaves once the interval has passed since the last write"""
+        if self.dirty() and time.monotonic() - self.last_write >= self.interval:
+            self.autosave()
+
+    def close(self):
+        """Write out any pending edits, wait for the worker to finish everything and stop it"""
+        self.autosave()
+        self.jobs.put(None)
+        self.thread.join()
+
+def recover(tilemap, path):
+    """Load the edits an AutoSaver kept for a map that was never saved, e.g. after a crash
+
+    :param tilemap -- the Tilemap to load into (it is only touched if there is something to recover)
+    :param path -- the map's path, as given to the AutoSaver
+    :return -- True if unsaved edits were found and loaded
+    """
+    journal_path = path + '.journal'
+    if not os.path.exists(journal_path):
+        return False
+    f = open(journal_path, 'r')
+    lines = f.read().split('\n')
+    f.close()
+    try:
+        header = json.loads(lines[0])
+    except ValueError:
+        return False
+    base = os.path.join(os.path.dirname(path), header['base'])
+    # A journal whose base has been replaced since (e.g. the map was saved) has nothing left to add
+    if header['stamp'] != _file_stamp(base):
+        return False
+
+    entries = []
+    for line in lines[1:]:
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            break # an empty last line, or one cut off by the crash
+
+    if header['stamp'] is not None:
+        tilemap.load(base)
+    # Replaying isn't editing, so whoever listens to the tilemap doesn't hear about it
+    listeners, tilemap.listeners = tilemap.listeners, []
+    try:
+        for entry in entries:
+            for change in entry['grid']:
+                if len(change) > 2:
+                    tilemap.set_tile(change[:2], change[2], change[3])
+                else:
+                    tilemap.remove_tile(change)
+            for tile in entry['remove']:
+                for tile_id, other in tilemap.offgrid_at(tile['pos']):
+                    if (other['type'], other['variant'], list(other['pos'])) == (tile['type'], tile['variant'], list(tile['pos'])):
+                        tilemap.remove_offgrid(tile_id)
+                        break
+            for tile in entry['add']:
+                tilemap.add_offgrid(tile)
+    finally:
+        tilemap.listeners = listeners
+    tilemap.dirty_cells.clear()
+    return True
@@ -0,0 +1,144 @@
+import numpy as np
+
+from scripts.spatial import SpatialHash
+
+# Bucket size of the entity grid, in pixels; about two hit boxes wide
+ENTITY_CELL_SIZE = 32
+
+class Broadphase:
+    def __init__(self, cell_size=ENTITY_CELL_SIZE):
+        """A spatial hash over the moving entities, so they can be found by position without checking every one
+
+        Call update() once a tick with everything that moves; queries then only look at the
+        entities in the buckets they touch.
+
+        :param cell_size -- the width and height of a bucket in pixels
+        """
+        self.grid = SpatialHash(cell_size)
+        self.ids = {} # entity -> its id in the grid
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def entity_rect(entity):
+        """An entity's hit box as an (x, y, w, h) tuple, the same as entity.rect()"""
+        return (int(entity.pos[0]), int(entity.pos[1]), entity.size[0], entity.size[1])
+
+    def update(self, entities):
+        """Bring the index up to date: entities already in it are moved, new ones added and missing ones dropped
+
+        :param entities -- every entity that should be in the index this tick
+        """
+        grid = self.grid
+        ids = {}
+        for entity in entities:
+            item_id = self.ids.pop(entity, None)
+            if item_id is None:
+                item_id = grid.insert(entity, self.entity_rect(entity))
+            else:
+                grid.move(item_id, self.entity_rect(entity))
+            ids[entity] = item_id
+        for item_id in self.ids.values():
+            grid.remove(item_id)
+        self.ids = ids
+
+    def query_rect(self, rect):
+        """Find the entities whose hit box overlaps an area
+
+        :param rect -- the (x, y, w, h) area in pixels
+        :return -- a list of entities, in the order they were first added
+        """
+        return [entity for item_id, entity in self.grid.query_rect(rect)]
+
+    def query_radius(self, pos, radius):
+        """Find the entities whose hit box comes within a distance of a point
+
+        :param pos -- the X and Y pixel position
+        :param radius -- the distance in pixels
+        :return -- a list of entities, in the order they were first added
+        """
+        return [entity for item_id, entity in self.grid.query_radius(pos, radius)]
+
+    def pairs(self):
+        """Find every pair of entities whose hit boxes overlap
+
+        :return -- a list of (entity, entity) pairs, each pair once
+        """
+        return [(a, b) for (a_id, a), (b_id, b) in self.grid.pairs()]
+
+    def raycast(self, start, end, tilemap=None, ignore=()):
+        """Find the first entity a line runs into, optionally stopping at walls
+
+        :param start -- the X and Y pixel position the line starts from
+        :param end -- the X and Y pixel position it goes to
+        :param tilemap -- if given, the line stops at the first physics tile
+        :param ignore -- entities the line passes through (e.g. whoever is looking)
+        :return -- (entity, hit position) for the closest entity hit, (None, wall position) if a wall came first,
+                   or (None, None) if nothing is in the way
+        """
+        dx, dy = end[0] - start[0], end[1] - start[1]
+        limit = 1.0
+        wall = tilemap.raycast(start, end) if tilemap is not None else None
+        if wall is not None:
+            limit = (wall[0] - start[0]) / dx if dx else ((wall[1] - start[1]) / dy if dy else 0.0)
+
+        best, best_t = None, limit
+        area = (min(start[0], end[0]), min(start[1], end[1]), abs(dx) + 1, abs(dy) + 1)
+        for entity in self.query_rect(area):
+            if entity in ignore:
+                continue
+            # Slab test: the stretch of the line inside the box along each axis, and where those overlap
+            x, y, w, h = self.entity_rect(entity)
+            t_enter, t_exit = 0.0, best_t
+            for origin, delta, low, high in ((start[0], dx, x, x + w), (start[1], dy, y, y + h)):
+                if delta:
+                    t0, t1 = (low - origin) / delta, (high - origin) / delta
+                    t_enter, t_exit = max(t_enter, min(t0, t1)), min(t_exit, max(t0, t1))
+                elif not low <= origin < high:
+                    t_enter, t_exit = 1, 0
+            if t_enter <= t_exit and t_enter < best_t:
+                best, best_t = entity, t_enter
+
+        if best is not None:
+            return best, (start[0] + dx * best_t, start[1] + dy * best_t)
+        return None, wall
+
+    def hit_test_projectiles(self, projectiles, targets):
+        """Check the live projectiles against the hit boxes of some entities; projectiles that hit something are used up
+
+        Projectiles are sorted into the grid's buckets, so each target only looks at the projectiles
+        in the buckets its hit box covers.
+
+        :param projectiles -- the ProjectileSystem
+        :param targets -- the entities that can be hit, the first one listed wins when they overlap
+        :return -- for each projectile that hit, the entity it hit
+        """
+        n = projectiles.count
+        if not n or not len(targets):
+            return []
+        position = projectiles.position[:n]
+        dead = projectiles.dead[:n]
+        cell_size = self.grid.cell_size
+        cells = np.floor_divide(position, cell_size).astype(np.int64)
+        keys = (cells[:, 0] << 32) ^ (cells[:, 1] & 0xFFFFFFFF)
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+
+        hit_by = np.full(n, -1)
+        for t, target in enumerate(targets):
+            x, y, w, h = self.entity_rect(target)
+            for cell_x, cell_y in self.grid.cells_for((x, y, w, h)):
+                key = (cell_x << 32) ^ (cell_y & 0xFFFFFFFF)
+                lo = np.searchsorted(sorted_keys, key, 'left')
+                hi = np.searchsorted(sorted_keys, key, 'right')
+                if lo == hi:
+                    continue
+                candidates = order[lo:hi]
+                px, py = position[candidates, 0], position[candidates, 1]
+                inside = (px >= x) & (px < x + w) & (py >= y) & (py < y + h) & ~dead[candidates] & (hit_by[candidates] < 0)
+                hit_by[candidates[inside]] = t
+
+        hits = np.flatnonzero(hit_by >= 0)
+        dead[hits] = True
+        return [targets[t] for t in hit_by[hits].tolist()]
@@ -1,34 +1,47 @@
 import random
 
-class Cloud:
-    def __init__(self, pos, img, speed, depth):
-        self.pos = list(pos)
-        self.img = img
-        self.speed = speed
-        self.depth = depth
+from scripts.parallax import Parallax, ParallaxLayer
 
-    def update(self):
-        self.pos[0] += self.speed
+# Clouds get a depth somewhere in this range; 0 would be infinitely far away, 1 as close as the level
+CLOUD_DEPTHS = (0.2, 0.8)
+# How many depths the clouds are sorted into; every depth is pre-rendered and drawn as one layer
+CLOUD_LAYERS = 4
 
-    def render(self, surface, offset = (0, 0)):
-        render_pos = (self.pos[0] - offset[0] * self.depth, self.pos[1] - offset[1] * self.depth)
-        surface.blit(self.img, (render_pos[0] % (surface.get_width() + self.img.get_width()) - self.img.get_width(), render_pos[1] % (surface.get_height() + self.img.get_height()) - self.img.get_height()))
+class Clouds(Parallax):
+    def __init__(self, cloud_images, count=16, layers=CLOUD_LAYERS, area=(320, 240), background=None):
+        """Clouds drifting across the sky at different depths, with the background behind them
 
-class Clouds:
-    def __init__(self, cloud_images, count=16):
-        self.clouds = []
+        Every cloud gets a random depth and speed, and the clouds are then sorted into `layers`
+        evenly spaced depths. The clouds of one depth move together, so they're drawn from one
+        pre-rendered layer, and the cost of drawing them doesn't grow with how many there are.
+
+        :param cloud_images -- the images to pick clouds from
+        :param count -- how many clouds to make
+        :param layers -- how many depths to sort them into
+        :param area -- the size of the surface they'll be drawn on; each layer repeats every that plus the biggest cloud
+        :param background -- the image drawn behind the clouds, see Parallax.render_background()
+        """
+        super().__init__(background=background)
 
         # Generate clouds of random position, specific images, animation speed, and depth rendering order
+        clouds = []
         for i in range(count):
-            self.clouds.append(Cloud((random.random() * 99999, random.random() * 99999), random.choice(cloud_images), random.random() * 0.05 + 0.05, random.random() * 0.6 + 0.2))
+            clouds.append(((random.random() * 99999, random.random() * 99999), random.choice(cloud_images), random.random() * 0.05 + 0.05, random.random() * 0.6 + 0.2))
 
         # Sorting clouds based on depth, so we draw in the correct order
-        self.clouds.sort(key=lambda x: x.depth)
-
-    def update(self):
-        for cloud in self.clouds:
-            cloud.update()
-
-    def render(self, surface, offset=(0, 0)):
-        for cloud in self.clouds:
-            cloud.render(surface, offset=offset)
+        clouds.sort(key=lambda cloud: cloud[3])
+
+        near, far = CLOUD_DEPTHS[1], CLOUD_DEPTHS[0]
+        groups = [[] for i in range(layers)]
+        for cloud in clouds:
+            groups[min(layers - 1, int((cloud[3] - far) / (near - far) * layers))].append(cloud)
+
+        # Like a single cloud wrapping around the screen, a layer repeats once it's all the way off it
+        size = (area[0] + max(img.get_width() for img in cloud_images), area[1] + max(img.get_height() for img in cloud_images))
+        for i, group in enumerate(groups):
+            if not group:
+                continue
+            layer = ParallaxLayer(size, far + (near - far) * (i + 0.5) / layers, speed=sum(cloud[2] for cloud in group) / len(group))
+            for pos, img, speed, depth in group:
+                layer.add(img, pos)
+            self.add(layer)
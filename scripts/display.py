@@ -0,0 +1,116 @@
+import pygame
+
+# The resolution everything is drawn at, and the window it is shown in by default
+RENDER_SIZE = (320, 240)
+WINDOW_SIZE = (640, 480)
+# Colour of the bars around the picture when the window's shape doesn't match it
+LETTERBOX_COLOR = (0, 0, 0)
+
+class Presenter:
+    def __init__(self, render_size=RENDER_SIZE, window_size=WINDOW_SIZE, integer_scale=False, scaled=False, resizable=False):
+        """Owns the window and the low resolution display surface that everything is drawn onto, and gets
+        the one onto the other at the end of each frame
+
+        The display is scaled up to fill as much of the window as it can without stretching, centred,
+        with bars (letterboxing) wherever the shapes don't match. The scaled picture is written straight
+        into the window surface, so presenting doesn't allocate a new window-sized surface every frame.
+
+        :param render_size -- the resolution the game is drawn at
+        :param window_size -- the resolution of the window (left to SDL with `scaled`)
+        :param integer_scale -- only scale by whole numbers, so every pixel comes out the same size,
+                                at the cost of wider bars
+        :param scaled -- have SDL scale the picture with the SCALED display flag, usually on the GPU; the
+                         display is then the window surface itself and presenting copies nothing
+        :param resizable -- let the window be resized; call resize() when it is (VIDEORESIZE)
+        """
+        self.render_size = tuple(render_size)
+        self.integer_scale = integer_scale
+        self.scaled = scaled
+        flags = pygame.RESIZABLE if resizable else 0
+        if scaled:
+            self.screen = pygame.display.set_mode(self.render_size, flags | pygame.SCALED)
+            self.display = self.screen
+        else:
+            self.screen = pygame.display.set_mode(window_size, flags)
+            self.display = pygame.Surface(self.render_size)
+        self.layout()
+
+    def layout(self):
+        """Work out where on the window the picture goes, and how big"""
+        self.screen = pygame.display.get_surface()
+        self.full = True # the whole window, bars and all, is shown on the next present()
+        if self.scaled:
+            self.scale = 1
+            self.viewport = self.screen.get_rect()
+            self.target = self.screen
+            return
+
+        window_w, window_h = self.screen.get_size()
+        render_w, render_h = self.render_size
+        scale = min(window_w / render_w, window_h / render_h)
+        # A window smaller than the picture still gets the whole picture, just not at a whole scale
+        if self.integer_scale and scale >= 1:
+            scale = int(scale)
+        self.scale = scale
+        size = (max(1, int(render_w * scale)), max(1, int(render_h * scale)))
+        self.viewport = pygame.Rect(((window_w - size[0]) // 2, (window_h - size[1]) // 2), size)
+        # The part of the window surface the picture is scaled into, made once rather than every frame
+        self.target = self.screen.subsurface(self.viewport)
+
+    def resize(self):
+        """Lay the picture out again after the window changed size"""
+        self.layout()
+
+    def invalidate(self):
+        """Show the whole window on the next present(), e.g. after something covered it up"""
+        self.full = True
+
+    def to_render(self, pos):
+        """Convert a position on the window (e.g. the mouse) into display coordinates"""
+        if self.scaled:
+            # SDL already hands out mouse positions in display coordinates
+            return (pos[0], pos[1])
+        return ((pos[0] - self.viewport.x) / self.scale, (pos[1] - self.viewport.y) / self.scale)
+
+    def _scale_area(self, rect):
+        """Scale one area of the display into place on the window, returning the window area it covered"""
+        scale = self.scale
+        dest = pygame.Rect(self.viewport.x + rect.x * scale, self.viewport.y + rect.y * scale, rect.w * scale, rect.h * scale)
+        if scale == 1:
+            self.screen.blit(self.display, dest, rect)
+        else:
+            pygame.transform.scale(self.display.subsurface(rect), dest.size, self.screen.subsurface(dest))
+        return dest
+
+    def present(self, rects=None):
+        """Show the display on the window
+
+        Only the given areas are scaled and shown when the scale is a whole number; otherwise their
+        edges wouldn't line up with the rest of the picture, so the whole of it is shown instead.
+
+        :param rects -- the areas of the display that changed, or None for all of it
+        """
+        if self.scaled:
+            if rects is None or self.full:
+                pygame.display.flip()
+            else:
+                pygame.display.update(rects)
+            self.full = False
+            return
+
+        if self.full:
+            self.screen.fill(LETTERBOX_COLOR)
+            rects = None
+        if rects is not None and self.scale == int(self.scale):
+            pygame.display.update([self._scale_area(rect) for rect in rects])
+            return
+
+        if self.scale == 1:
+            self.target.blit(self.display, (0, 0))
+        else:
+            pygame.transform.scale(self.display, self.viewport.size, self.target)
+        if self.full:
+            pygame.display.flip()
+            self.full = False
+        else:
+            pygame.display.update(self.viewport)
@@ -4,25 +4,47 @@ from http.cookiejar import offset_from_tz_string
 
 import pygame
 
-from scripts.particles import Particle
+from scripts.utils import flipped, Playhead
+from scripts.tilemaps import NEIGHBOR_OFFSETS
+
+# Collision state bitflags, one per side of the hit box
+COLLIDE_UP = 1
+COLLIDE_DOWN = 2
+COLLIDE_RIGHT = 4
+COLLIDE_LEFT = 8
+# The bit Tilemap.solid_around() uses for each of the nine cells around an entity
+NEIGHBOR_BITS = [(1 << i, offset) for i, offset in enumerate(NEIGHBOR_OFFSETS)]
+
+# How far an enemy looks for someone to shoot, in pixels: about as far as a projectile flies before it times out
+SIGHT_RANGE = 540
 
 class PhysicsEntity:
+    __slots__ = ('game', 'type', 'pos', 'prev_pos', 'size', 'velocity', 'collision_flags', 'action', 'animation', 'anim_offset', 'flip', 'last_movement')
+
     def __init__(self, game, e_type, pos, size):
         """Initialize the PhysicsEntity object"""
         self.game = game
         self.type = e_type
         self.pos = list(pos) # using a list instead of a tuple for some reason
+        self.prev_pos = tuple(pos) # where we were before the last update, to draw in-between positions
         self.size = size
         self.velocity = [0, 0] # rate of change in the X and Y axis
-        self.collisions = {'up': False, 'down': False, 'right' : False, 'left' : False}
+        self.collision_flags = 0 # COLLIDE_* bits of the sides that touched a tile during the last update
 
         self.action = ''
+        self.animation = None
         self.anim_offset = (-3, -3)
         self.flip = False
         self.set_action('idle')
 
         self.last_movement = [0, 0]
 
+    @property
+    def collisions(self):
+        """The collision state as a {'up', 'down', 'right', 'left'} dict (built on demand; the physics uses collision_flags)"""
+        flags = self.collision_flags
+        return {'up': bool(flags & COLLIDE_UP), 'down': bool(flags & COLLIDE_DOWN), 'right' : bool(flags & COLLIDE_RIGHT), 'left' : bool(flags & COLLIDE_LEFT)}
+
     def rect(self):
         """Dynamically generate the rectangle representing a physics entity's collision box
 
@@ -30,51 +52,101 @@ class PhysicsEntity:
         """
         return pygame.Rect(self.pos[0], self.pos[1], self.size[0], self.size[1])
 
+    def center(self):
+        """The centre of the hit box, as rect().center would give it but without making a Rect"""
+        return int(self.pos[0]) + self.size[0] // 2, int(self.pos[1]) + self.size[1] // 2
+
+    def render_pos(self, alpha=1):
+        """Where to draw the entity, part of the way from its previous position to its current one
+
+        :param alpha: how far into the next update we are, from 0 (the previous position) to 1 (the current one)
+        """
+        # Counting back from the current position, so alpha 1 gives exactly self.pos
+        back = 1 - alpha
+        return (self.pos[0] - (self.pos[0] - self.prev_pos[0]) * back, self.pos[1] - (self.pos[1] - self.prev_pos[1]) * back)
+
     def set_action(self, action):
         # If the action is different than the current state
         if action != self.action:
             self.action = action
-            self.animation = self.game.assets[self.type + '/' + self.action].copy() # EXAMPLE: looking for key `player/run`
+            clip = self.game.assets[self.type + '/' + self.action] # EXAMPLE: looking for key `player/run`
+            # The clip is shared; all we keep per entity is a playhead, and we hang on to the same one
+            if self.animation is None:
+                self.animation = Playhead(clip)
+            else:
+                self.animation.play(clip)
 
     def update(self, tilemap, movement=(0, 0)):
         """Update the physics entity in accordance to gravity, applied motion, and collision detection
 
+        The hit box is kept as plain integers and checked straight against the solid cells of the
+        grid, so nothing gets allocated; it behaves exactly like moving a pygame.Rect against
+        tilemap.physics_rects_around() (including the Rect truncating the position toward zero).
+
         :param tilemap: Tilemap object of the current room
         :param movement: Tuple representing the x and y movement vectors (default (0,0))
         """
-        # Reset adjacent collisions
-        self.collisions = {'up': False, 'down': False, 'right' : False, 'left' : False}
+        pos = self.pos
+        self.prev_pos = (pos[0], pos[1])
+        width, height = self.size
+        tile_size = tilemap.tile_size
+        solid_around = tilemap.solid_around
+        flags = 0
 
         # Calculating the x,y change in a singe frame
-        frame_movement = (movement[0] + self.velocity[0], movement[1] + self.velocity[1])
+        move_x = movement[0] + self.velocity[0]
+        move_y = movement[1] + self.velocity[1]
 
         # Applying movement to x position
-        self.pos[0] += frame_movement[0]
+        pos[0] += move_x
         # Collision detection and handling logic for horizontal travel
-        entity_rect = self.rect()
-        for rect in tilemap.physics_rects_around(self.pos): # check all nearby tiles
-            if entity_rect.colliderect(rect):
-                if frame_movement[0] > 0:
-                    entity_rect.right = rect.left
-                    self.collisions['right'] = True
-                if frame_movement[0] < 0:
-                    entity_rect.left = rect.right
-                    self.collisions['left'] = True
-                self.pos[0] = entity_rect.x
+        left, top = int(pos[0]), int(pos[1])
+        tile_x, tile_y = int(pos[0] // tile_size), int(pos[1] // tile_size)
+        solid = solid_around(tile_x, tile_y)
+        for bit, (offset_x, offset_y) in NEIGHBOR_BITS: # check all nearby tiles
+            if solid & bit:
+                x, y = (tile_x + offset_x) * tile_size, (tile_y + offset_y) * tile_size
+                if left < x + tile_size and left + width > x and top < y + tile_size and top + height > y:
+                    if move_x > 0:
+                        left = x - width
+                        flags |= COLLIDE_RIGHT
+                    if move_x < 0:
+                        left = x + tile_size
+                        flags |= COLLIDE_LEFT
+                    pos[0] = left
 
         # Applying movement to y position with corresponding gravity and collision handling
-        self.pos[1] += frame_movement[1]
-        entity_rect = self.rect()
-        for rect in tilemap.physics_rects_around(self.pos):
-            if entity_rect.colliderect(rect):
-                if frame_movement[1] > 0:
-                    entity_rect.bottom = rect.top
-                    self.collisions['down'] = True
-                if frame_movement[1] < 0:
-                    entity_rect.top = rect.bottom
-                    self.collisions['up'] = True
-                self.pos[1] = entity_rect.y
+        pos[1] += move_y
+        left, top = int(pos[0]), int(pos[1])
+        tile_x, tile_y = int(pos[0] // tile_size), int(pos[1] // tile_size)
+        solid = solid_around(tile_x, tile_y)
+        for bit, (offset_x, offset_y) in NEIGHBOR_BITS:
+            if solid & bit:
+                x, y = (tile_x + offset_x) * tile_size, (tile_y + offset_y) * tile_size
+                if left < x + tile_size and left + width > x and top < y + tile_size and top + height > y:
+                    if move_y > 0:
+                        top = y - height
+                        flags |= COLLIDE_DOWN
+                    if move_y < 0:
+                        top = y + tile_size
+                        flags |= COLLIDE_UP
+                    pos[1] = top
+        self.collision_flags = flags
 
+        # Applying gravity to the y-coordinate and cap at terminal velocity
+        self.velocity[1] = min(5, self.velocity[1] + 0.1)
+
+        # Should stop when we hit the ground or the ceiling
+        if flags & (COLLIDE_DOWN | COLLIDE_UP):
+            self.velocity[1] = 0
+
+        self.end_update(movement)
+
+    def end_update(self, movement):
+        """The part of the update that comes after the physics (BatchPhysics calls this once it has moved everyone)
+
+        :param movement: the movement that was applied this update
+        """
         # If we're moving the right, use the same sprite. If we're moving left, mirror it so it's facing the right way
         if movement[0] > 0:
             self.flip = False
@@ -84,19 +156,15 @@ class PhysicsEntity:
         # Keeping track of the last intended movement, regardless of whether we successfully moved or not
         self.last_movement = movement
 
-        # Applying gravity to the y-coordinate and cap at terminal velocity
-        self.velocity[1] = min(5, self.velocity[1] + 0.1)
-
-        # Should stop when we hit the ground or the ceiling
-        if self.collisions['down'] or self.collisions['up']:
-            self.velocity[1] = 0
-
         self.animation.update()
 
-    def render(self, surface, offset=(0, 0)):
-        surface.blit(pygame.transform.flip(self.animation.img(), self.flip, False), (self.pos[0] - offset[0] + self.anim_offset[0], self.pos[1] - offset[1] - self.anim_offset[1]))
+    def render(self, surface, offset=(0, 0), alpha=1):
+        x, y = self.render_pos(alpha)
+        surface.blit(self.animation.img(self.flip), (x - offset[0] + self.anim_offset[0], y - offset[1] - self.anim_offset[1]))
 
 class Enemy(PhysicsEntity):
+    __slots__ = ('walking',)
+
     def __init__(self, game, pos, size):
         """Initialize the Enemy object"""
         super().__init__(game, 'enemy', pos, size)
@@ -105,9 +173,19 @@ class Enemy(PhysicsEntity):
 
     def update(self, tilemap, movement=(0, 0)):
         """Update the Enemy's movement and sprite"""
+        super().update(tilemap, movement=self.control(tilemap, movement))
+
+    def control(self, tilemap, movement=(0, 0)):
+        """The AI: decide where to walk and whether to shoot, before the physics runs
+
+        :param tilemap: Tilemap object of the current room
+        :param movement: the movement to start from
+        :return: the movement to apply this update
+        """
         if self.walking:
-            if tilemap.solid_check((self.rect().centerx + (-7 if self.flip else 7), self.pos[1] + 23)):
-                if self.collisions['right'] or self.collisions['left']:
+            centerx, centery = self.center()
+            if tilemap.solid_check((centerx + (-7 if self.flip else 7), self.pos[1] + 23)):
+                if self.collision_flags & (COLLIDE_RIGHT | COLLIDE_LEFT):
                     self.flip = not self.flip
                 else:
                     movement = (movement[0] - 0.5 if self.flip else 0.5, movement[1], movement[1])
@@ -115,19 +193,38 @@ class Enemy(PhysicsEntity):
                 self.flip = not self.flip
             self.walking = max(0, self.walking - 1)
 
-            # Are we still walking? If not, fire projectile at the player
+            # Are we still walking? If not, fire projectile at a player in our row that we're facing
             if not self.walking:
-                distance = (self.game.player.pos[0] - self.pos[0], self.game.player.pos[1] - self.pos[1])
-                if abs(distance[1]) < 16:
-                    if (self.flip and distance[0] < 0):
-                        self.game.projectiles.append([[self.rect().centerx - 10, self.rect().centery + 4], -1.5, 0])
-                    if (not self.flip and distance[0] > 0):
-                        self.game.projectiles.append([[self.rect().centerx + 10, self.rect().centery + 4], 1.5, 0])
+                for target in self.game.broadphase.query_rect(self.sight_rect()):
+                    if target.type != 'player':
+                        continue
+                    distance = (target.pos[0] - self.pos[0], target.pos[1] - self.pos[1])
+                    if abs(distance[1]) < 16:
+                        if (self.flip and distance[0] < 0):
+                            self.game.projectiles.spawn((centerx - 10, centery + 4), -1.5)
+                            break
+                        if (not self.flip and distance[0] > 0):
+                            self.game.projectiles.spawn((centerx + 10, centery + 4), 1.5)
+                            break
 
         elif random.random() < 0.01:
             self.walking = random.randint(30, 120)
 
-        super().update(tilemap, movement=movement)
+        return movement
+
+    def sight_rect(self):
+        """The band in front of the Enemy it can shoot into: its own row, out to as far as a projectile flies
+
+        Padded by a pixel on each side, since hit boxes are truncated to whole pixels.
+        """
+        x, y = self.pos
+        top = y - 16 - 1
+        if self.flip:
+            return (x - SIGHT_RANGE - 1, top, SIGHT_RANGE + 2, 32 + 2)
+        return (x - 1, top, SIGHT_RANGE + 2, 32 + 2)
+
+    def end_update(self, movement):
+        super().end_update(movement)
 
         # Setting the enemy to the correct animation sprite
         if movement[0] != 0:
@@ -135,16 +232,21 @@ class Enemy(PhysicsEntity):
         else:
             self.set_action('idle')
 
-    def render(self, surface, offset=(0, 0)):
+    def render(self, surface, offset=(0, 0), alpha=1):
         """Render the Enemy object (with a gun)"""
-        super().render(surface, offset=offset)
+        super().render(surface, offset=offset, alpha=alpha)
 
+        gun = self.game.assets['gun']
+        x, y = self.render_pos(alpha)
+        centerx, centery = int(x) + self.size[0] // 2, int(y) + self.size[1] // 2
         if self.flip:
-            surface.blit(pygame.transform.flip(self.game.assets['gun'], True, False), (self.rect().centerx - 4 - self.game.assets['gun'].get_width() - offset[0], self.rect().centery + self.game.assets['gun'].get_height() - offset[1]))
+            surface.blit(flipped(gun), (centerx - 4 - gun.get_width() - offset[0], centery + gun.get_height() - offset[1]))
         else:
-            surface.blit(self.game.assets['gun'], (self.rect().centerx + 4 - offset[0], self.rect().centery + self.game.assets['gun'].get_height() - offset[1]))
+            surface.blit(gun, (centerx + 4 - offset[0], centery + gun.get_height() - offset[1]))
 
 class Player(PhysicsEntity):
+    __slots__ = ('air_time', 'jumps', 'wall_slide', 'dashing')
+
     def __init__(self, game, pos, size):
         """Initialize the Player object"""
         super().__init__(game, 'player', pos, size)
@@ -157,17 +259,17 @@ class Player(PhysicsEntity):
         """Update the Player's movement and sprite"""
         super().update(tilemap, movement=movement)
         self.air_time += 1
-        if self.collisions['down']: # If we collide with the ground, air_time and jumps counter are reset
+        if self.collision_flags & COLLIDE_DOWN: # If we collide with the ground, air_time and jumps counter are reset
             self.air_time = 0
             self.jumps = 1
 
         # WALL-SLIDING LOGIC
         self.wall_slide = False
-        if (self.collisions['right'] or self.collisions['left']) and self.air_time > 4:
+        if self.collision_flags & (COLLIDE_RIGHT | COLLIDE_LEFT) and self.air_time > 4:
             self.wall_slide = True
             self.velocity[1] = min(self.velocity[1], 0.5)
             # Animate in the correct direction while sliding down the wall
-            if self.collisions['right']:
+            if self.collision_flags & COLLIDE_RIGHT:
                 self.flip = False
             else:
                 self.flip = True
@@ -190,7 +292,7 @@ class Player(PhysicsEntity):
                 angle = random.random() * math.pi * 2
                 speed = random.random() * 0.5 + 0.5
                 pvelocity = [math.cos(angle) * speed, math.sin(angle) * speed]
-                self.game.particles.append(Particle(self.game, 'particle', self.rect().center, velocity=pvelocity, frame=random.randint(0, 7)))
+                self.game.particles.spawn('particle', self.rect().center, velocity=pvelocity, frame=random.randint(0, 7))
         # Gradually bring the dashing speed back down to zero from either direction
         if self.dashing > 0:
             self.dashing = max(0, self.dashing - 1)
@@ -202,7 +304,7 @@ class Player(PhysicsEntity):
             if abs(self.dashing) == 51:
                 self.velocity[0] *= 0.1
             pvelocity = [abs(self.dashing) / self.dashing * random.random() * 3, 0]
-            self.game.particles.append(Particle(self.game, 'particle', self.rect().center, velocity=pvelocity, frame=random.randint(0, 7)))
+            self.game.particles.spawn('particle', self.rect().center, velocity=pvelocity, frame=random.randint(0, 7))
 
         # Reduce horizontal speed down to zero over time from either direction (like friction or air resistance)
         if self.velocity[0] > 0:
@@ -210,9 +312,9 @@ class Player(PhysicsEntity):
         else:
             self.velocity[0] = min(self.velocity[0] + 0.1, 0)
 
-    def render(self, surface, offset=(0, 0)):
+    def render(self, surface, offset=(0, 0), alpha=1):
         if abs(self.dashing <= 50):
-            super().render(surface, offset=offset)
+            super().render(surface, offset=offset, alpha=alpha)
 
     def jump(self):
         """Jumping away from a wall we're sliding on or up from the ground
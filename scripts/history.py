@@ -0,0 +1,191 @@
+from collections import deque
+
+# The most cell changes the undo history holds on to; past this the oldest commands are folded together or forgotten
+HISTORY_LIMIT = 200000
+
+class EditCommand:
+    __slots__ = ('label', 'grid', 'offgrid')
+
+    def __init__(self, label=''):
+        """One undoable step: the net change it made to each cell and off-grid tile it touched
+
+        Only a before and an after is kept per cell, however many times the cell changed in between,
+        so a stroke that paints over the same cells every frame costs no more than painting them once.
+
+        :param label -- what the step was, e.g. 'paint'
+        """
+        self.label = label
+        self.grid = {} # (x, y) -> [(type, variant) or None before, the same after]
+        self.offgrid = {} # tile id -> [tile dict or None before, the same after]
+
+    def __len__(self):
+        return len(self.grid) + len(self.offgrid)
+
+    def record(self, kind, changes):
+        """Fold a batch of (key, before, after) changes, as a Tilemap listener gets them, into this command"""
+        net = self.grid if kind == 'grid' else self.offgrid
+        if not net:
+            # Nothing to fold into yet (a batch names each key only once), so a bulk edit goes straight in
+            net.update({key : [before, after] for key, before, after in changes if before != after})
+            return
+        for key, before, after in changes:
+            change = net.get(key)
+            if change is not None:
+                change[1] = after
+                # Changed and then changed back within the same step is no change at all
+                if change[0] == after:
+                    del net[key]
+            elif before != after:
+                net[key] = [before, after]
+
+    def overlaps(self, later):
+        """Whether a later command touched any cell or off-grid tile this one did"""
+        return not (self.grid.keys().isdisjoint(later.grid) and self.offgrid.keys().isdisjoint(later.offgrid))
+
+    def fold(self, later):
+        """Fold a command that came straight after this one into it, leaving the net change of both"""
+        self.record('grid', [(key, before, after) for key, (before, after) in later.grid.items()])
+        self.record('offgrid', [(key, before, after) for key, (before, after) in later.offgrid.items()])
+
+class EditHistory:
+    def __init__(self, tilemap, limit=HISTORY_LIMIT):
+        """Undo and redo for the edits made to a tilemap
+
+        Every change the tilemap reports goes into the open command; begin() and end() bracket the
+        changes that should come undone together (a whole mouse drag, say), and anything recorded
+        outside of them becomes a command of its own. Undoing writes the before side of each change
+        back, so it costs as much as the command is big, whatever the size of the map.
+
+        :param tilemap -- the Tilemap to watch, see Tilemap.add_listener()
+        :param limit -- the most cell changes to keep; past this the oldest commands are compacted, see _push()
+        """
+        self.tilemap = tilemap
+        self.limit = limit
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.size = 0 # cell changes held by undo_stack
+        self.current = None # the command being recorded
+        self.depth = 0 # how many begin()s are open
+        self.replaying = False
+        tilemap.add_listener(self.record)
+
+    def begin(self, label=''):
+        """Start grouping the following changes into one command (calls can nest; the outermost one counts)"""
+        if not self.depth:
+            self.current = EditCommand(label)
+        self.depth += 1
+
+    def end(self):
+        """Close the command opened with begin() and make it the one undo() takes back next"""
+        if not self.depth:
+            return
+        self.depth -= 1
+        if not self.depth:
+            command, self.current = self.current, None
+            self._push(command)
+
+    def _push(self, command):
+        """Add a command to the undo stack, compacting the oldest ones once it holds more than `limit` changes
+
+        The two oldest commands are folded into one snapshot of their net change when they touched
+        any of the same cells, which shrinks it, and keeps the whole history while the same area gets
+        reworked over and over; only the in-between state is lost. When they didn't, folding saves
+        nothing, so the oldest command is forgotten instead.
+        """
+        if not len(command):
+            return
+        self.undo_stack.append(command)
+        self.size += len(command)
+        self.redo_stack.clear()
+        while self.size > self.limit and len(self.undo_stack) > 1:
+            oldest = self.undo_stack.popleft()
+            if oldest.overlaps(self.undo_stack[0]):
+                later = self.undo_stack.popleft()
+                self.size -= len(oldest) + len(later)
+                oldest.fold(later)
+                # ...unless the second one put everything back the way it was
+                if len(oldest):
+                    self.undo_stack.appendleft(oldest)
+                    self.size += len(oldest)
+            else:
+                self.size -= len(oldest)
+
+    def record(self, kind, changes):
+        """The tilemap listener: add changes to the open command, or make them a command of their own"""
+        if self.replaying:
+            return
+        if self.current is not None:
+            self.current.record(kind, changes)
+            return
+        command = EditCommand()
+        command.record(kind, changes)
+        self._push(command)
+
+    def clear(self):
+        """Forget everything, e.g. after loading another map"""
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.size = 0
+
+    def can_undo(self):
+        return bool(self.undo_stack)
+
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    def _apply(self, command, side):
+        """Write one side (0 for before, 1 for after) of every change in a command back into the tilemap"""
+        tilemap = self.tilemap
+        # Putting cells back is not an edit to autotile around; the variants are restored as they were
+        dirty_cells = {key : mask.copy() for key, mask in tilemap.dirty_cells.items()}
+        self.replaying = True
+        try:
+            cells = []
+            for (x, y), change in command.grid.items():
+                tile = change[side]
+                cells.append((x, y, None, 0) if tile is None else (x, y, tile[0], tile[1]))
+            tilemap.set_cells(cells)
+            # Removals first, so a tile id is free again before anything is put back under it
+            for tile_id, change in command.offgrid.items():
+                if change[side] is None:
+                    tilemap.remove_offgrid(tile_id)
+            for tile_id, change in command.offgrid.items():
+                if change[side] is not None:
+                    tilemap.add_offgrid(change[side], tile_id)
+        finally:
+            self.replaying = False
+            tilemap.dirty_cells = dirty_cells
+
+    def undo(self):
+        """Take back the last command
+
+        :return -- the command that was undone, or None if there was nothing to undo
+        """
+        self.end_all()
+        if not self.undo_stack:
+            return None
+        command = self.undo_stack.pop()
+        self.size -= len(command)
+        self._apply(command, 0)
+        self.redo_stack.append(command)
+        return command
+
+    def redo(self):
+        """Do the last undone command again
+
+        :return -- the command that was redone, or None if there was nothing to redo
+        """
+        self.end_all()
+        if not self.redo_stack:
+            return None
+        command = self.redo_stack.pop()
+        self._apply(command, 1)
+        self.undo_stack.append(command)
+        self.size += len(command)
+        return command
+
+    def end_all(self):
+        """Close whatever command is open, however deeply nested"""
+        if self.depth:
+            self.depth = 1
+            self.end()
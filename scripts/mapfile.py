@@ -0,0 +1,182 @@
+import os
+import sys
+import mmap
+import struct
+from array import array
+
+# Binary map layout (all little-endian):
+#   header       HEADER
+#   type table   n_types x (u8 length, utf-8 name)
+#   chunk index  n_chunks x CHUNK_ENTRY
+#   chunk data   per chunk with tiles: chunk_size^2 int16 type ids (-1 = empty), then chunk_size^2 uint8 variants
+#   offgrid      per chunk with decor: OFFGRID_RECORD for every off-grid tile whose position falls in that chunk
+MAGIC = b'PTMP'
+VERSION = 1
+HEADER = struct.Struct('<4sHHHHI') # magic, version, tile_size, chunk_size, n_types, n_chunks
+CHUNK_ENTRY = struct.Struct('<iiQQIHQ') # chunk x, chunk y, tile data offset (0 = none), offgrid offset, offgrid count, tile count, bitmask of the grid and off-grid types
+OFFGRID_RECORD = struct.Struct('<IhHdd') # placement order (off-grid tiles are drawn in it), type id, variant, x, y
+
+def write_atomic(path, data):
+    """Write a whole file so that a crash partway through never leaves it half written
+
+    The data goes to a temporary file next to it first, which then gets renamed over the old file in one step.
+
+    :param path -- the file to write
+    :param data -- its new contents, as bytes
+    """
+    temp_path = path + '.tmp'
+    f = open(temp_path, 'wb')
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.replace(temp_path, path)
+
+def is_map_file(path):
+    """Check whether a file is in the binary map format (rather than JSON)"""
+    f = open(path, 'rb')
+    magic = f.read(len(MAGIC))
+    f.close()
+    return magic == MAGIC
+
+def type_mask(type_ids):
+    """Bitmask of which type ids are present, for skipping chunks without reading them (ids past 62 share bit 63)"""
+    mask = 0
+    for type_id in type_ids:
+        if type_id >= 0:
+            mask |= 1 << min(type_id, 63)
+    return mask
+
+class MapFile:
+    def __init__(self, path):
+        """A binary map opened through mmap; chunks are only decoded when asked for
+
+        :param path -- the file path of the binary map
+        """
+        self.path = path
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.tile_size, self.chunk_size, n_types, n_chunks = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a binary map' % path)
+        if version != VERSION:
+            raise ValueError('%s is map format version %d, expected %d' % (path, version, VERSION))
+        self.chunk_area = self.chunk_size * self.chunk_size
+
+        offset = HEADER.size
+        self.type_names = []
+        for i in range(n_types):
+            length = self.data[offset]
+            self.type_names.append(self.data[offset + 1:offset + 1 + length].decode('utf-8'))
+            offset += 1 + length
+
+        self.index = {} # (chunk_x, chunk_y) -> (tile data offset, offgrid offset, offgrid count, tile count, type bitmask)
+        for i in range(n_chunks):
+            cx, cy, *entry = CHUNK_ENTRY.unpack_from(self.data, offset)
+            self.index[(cx, cy)] = tuple(entry)
+            offset += CHUNK_ENTRY.size
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def read_chunk(self, key):
+        """Decode the grid tiles of one chunk
+
+        :param key -- the (chunk_x, chunk_y) to read
+        :return -- (type id array, variant array, tile count), or None if the file has no tiles there
+        """
+        entry = self.index.get(key)
+        if entry is None or not entry[0]:
+            return None
+        offset = entry[0]
+        types = array('h')
+        types.frombytes(self.data[offset:offset + self.chunk_area * 2])
+        if sys.byteorder == 'big':
+            types.byteswap()
+        variants = array('B', self.data[offset + self.chunk_area * 2:offset + self.chunk_area * 3])
+        return types, variants, entry[3]
+
+    def read_offgrid(self, key):
+        """Decode the off-grid tiles whose position falls inside one chunk
+
+        :param key -- the (chunk_x, chunk_y) to read
+        :return -- a list of (placement order, {'type', 'variant', 'pos'}) pairs, with 'pos' in pixels
+        """
+        entry = self.index.get(key)
+        if entry is None:
+            return []
+        tiles = []
+        for order, type_id, variant, x, y in OFFGRID_RECORD.iter_unpack(self.data[entry[1]:entry[1] + entry[2] * OFFGRID_RECORD.size]):
+            tiles.append((order, {'type' : self.type_names[type_id], 'variant' : variant, 'pos' : [x, y]}))
+        return tiles
+
+def save_map_file(tilemap, path):
+    """Write a tilemap in the binary map format
+
+    :param tilemap -- the Tilemap to save (any lazily loaded chunks get read in first)
+    :param path -- the file path wherein the binary map will reside
+    """
+    chunks = dict(tilemap.all_chunks())
+    chunk_size = tilemap.chunk_size
+    pixel_chunk = chunk_size * tilemap.tile_size
+    offgrid = {}
+    for order, tile in enumerate(tilemap.offgrid_tiles):
+        key = (int(tile['pos'][0] // pixel_chunk), int(tile['pos'][1] // pixel_chunk))
+        offgrid.setdefault(key, []).append((order, tile))
+        tilemap.type_id(tile['type'])
+
+    type_table = b''.join(bytes([len(name.encode('utf-8'))]) + name.encode('utf-8') for name in tilemap.type_names)
+    keys = sorted(set(chunks) | set(offgrid))
+    offset = HEADER.size + len(type_table) + CHUNK_ENTRY.size * len(keys)
+
+    index = []
+    body = []
+    for key in keys:
+        tiles_offset = 0
+        count = 0
+        mask = 0
+        chunk = chunks.get(key)
+        if chunk is not None:
+            types = array('h', chunk.types)
+            if sys.byteorder == 'big':
+                types.byteswap()
+            body.append(types.tobytes() + chunk.variants.tobytes())
+            tiles_offset = offset
+            offset += chunk_size * chunk_size * 3
+            count = chunk.count
+            mask = type_mask(chunk.types)
+
+        decor = offgrid.get(key, [])
+        mask |= type_mask(tilemap.type_ids[tile['type']] for order, tile in decor)
+        body.append(b''.join(OFFGRID_RECORD.pack(order, tilemap.type_ids[tile['type']], tile['variant'], tile['pos'][0], tile['pos'][1]) for order, tile in decor))
+        index.append(CHUNK_ENTRY.pack(key[0], key[1], tiles_offset, offset, len(decor), count, mask))
+        offset += OFFGRID_RECORD.size * len(decor)
+
+    header = HEADER.pack(MAGIC, VERSION, tilemap.tile_size, chunk_size, len(tilemap.type_names), len(keys))
+    write_atomic(path, header + type_table + b''.join(index) + b''.join(body))
+
+def convert(source, destination):
+    """Convert a map between the JSON and binary formats, in whichever direction the source calls for
+
+    :param source -- the map to read, either format
+    :param destination -- where to write it, in the other format
+    """
+    from scripts.tilemaps import Tilemap
+
+    tilemap = Tilemap(None)
+    tilemap.load(source)
+    if is_map_file(source):
+        tilemap.save(destination)
+    else:
+        save_map_file(tilemap, destination)
+    tilemap.close()
+
+if __name__ == '__main__':
+    # python -m scripts.mapfile map.json map.bin  (or the other way around)
+    if len(sys.argv) != 3:
+        print('usage: python -m scripts.mapfile SOURCE DESTINATION')
+        sys.exit(1)
+    convert(sys.argv[1], sys.argv[2])
+    print('%s (%d bytes) -> %s (%d bytes)' % (sys.argv[1], os.path.getsize(sys.argv[1]), sys.argv[2], os.path.getsize(sys.argv[2])))
@@ -0,0 +1,147 @@
+import bisect
+
+import pygame
+
+# Layers are pre-rendered in columns this wide, in pixels; only the columns on screen get drawn
+SLICE_WIDTH = 256
+# A layer with no more images than this on it is quicker to draw image by image (skipping those off screen) than from its picture
+DIRECT_LIMIT = 8
+# The colour that stands for see-through on the pre-rendered layers, as it does on the images
+COLORKEY = (0, 0, 0)
+
+class ParallaxLayer:
+    def __init__(self, size, depth, speed=0):
+        """A picture that repeats in every direction and scrolls past at a fraction of the camera's speed
+
+        Everything placed on the layer is drawn once into a cached picture, cut into columns of
+        SLICE_WIDTH pixels that are each cropped to what's drawn on them, so drawing the layer costs
+        as much as the columns on screen, however many images went into it. Layers with only a few
+        images (DIRECT_LIMIT) are drawn image by image instead, leaving out the ones off screen.
+
+        :param size -- the width and height of the picture; it repeats every that many pixels
+        :param depth -- how far the layer moves for every pixel the camera moves: 0 stays put, 1 moves with the level
+        :param speed -- how far the layer drifts to the right by itself every tick
+        """
+        self.size = (int(size[0]), int(size[1]))
+        self.depth = depth
+        self.speed = speed
+        self.drift = 0
+        self.items = [] # (image, (x, y)) placed on the picture
+        self.slices = None # per column: (surface, x, y) of what's drawn in it, or None if it's empty
+
+    def add(self, img, pos):
+        """Place an image on the layer; positions wrap around, and so do images that cross the picture's edge"""
+        self.items.append((img, (int(pos[0]) % self.size[0], int(pos[1]) % self.size[1])))
+        self.slices = None
+
+    def build(self):
+        """Pre-render the picture, as columns cropped to what's drawn in them"""
+        w, h = self.size
+        picture = pygame.Surface((w, h))
+        picture.fill(COLORKEY)
+        picture.set_colorkey(COLORKEY)
+        for img, (x, y) in self.items:
+            # Whatever sticks out past the right or bottom edge comes back in on the left or top
+            for dx in (0, -w):
+                for dy in (0, -h):
+                    picture.blit(img, (x + dx, y + dy))
+
+        self.slices = []
+        for left in range(0, w, SLICE_WIDTH):
+            column = picture.subsurface((left, 0, min(SLICE_WIDTH, w - left), h))
+            bounds = column.get_bounding_rect()
+            if not (bounds.w and bounds.h):
+                self.slices.append(None)
+                continue
+            piece = column.subsurface(bounds).copy()
+            # Run-length encoding makes blitting the mostly see-through pieces cheap
+            piece.set_colorkey(COLORKEY, pygame.RLEACCEL)
+            self.slices.append((piece, left + bounds.x, bounds.y))
+
+    def update(self):
+        self.drift = (self.drift + self.speed) % self.size[0]
+
+    def render(self, surface, offset=(0, 0)):
+        w, h = self.size
+        surface_w, surface_h = surface.get_size()
+        # Where the top left corner of the surface falls on the picture
+        start_x = int(offset[0] * self.depth - self.drift) % w
+        start_y = int(offset[1] * self.depth) % h
+
+        blits = []
+        if len(self.items) <= DIRECT_LIMIT:
+            # Every repeat of each image that lands on the surface, starting from the one just left of and above it
+            for img, (x, y) in self.items:
+                img_w, img_h = img.get_size()
+                first_x = (x - start_x) % w - w
+                for draw_y in range((y - start_y) % h - h, surface_h, h):
+                    if draw_y + img_h > 0:
+                        for draw_x in range(first_x, surface_w, w):
+                            if draw_x + img_w > 0:
+                                blits.append((img, (draw_x, draw_y)))
+            surface.blits(blits, doreturn=False)
+            return
+
+        if self.slices is None:
+            self.build()
+        # The surface is covered by the repeats of the picture that overlap it, and of each only the columns on screen are drawn
+        for base_y in range(-start_y, surface_h, h):
+            for base_x in range(-start_x, surface_w, w):
+                first = max(0, -base_x) // SLICE_WIDTH
+                last = (min(w, surface_w - base_x) - 1) // SLICE_WIDTH
+                for piece in self.slices[first:last + 1]:
+                    if piece is not None:
+                        img, x, y = piece
+                        if base_y + y < surface_h and base_y + y + img.get_height() > 0:
+                            blits.append((img, (base_x + x, base_y + y)))
+        surface.blits(blits, doreturn=False)
+
+class Parallax:
+    def __init__(self, layers=(), background=None):
+        """A backdrop: a background picture with any number of parallax layers in front of it, drawn far to near
+
+        :param layers -- the ParallaxLayers to start with
+        :param background -- an image that fills the surface behind everything, or None
+        """
+        self.layers = []
+        self.depths = [] # the depth of each layer, to keep them in order
+        self.background = background
+        self.backdrop = None # the background as it's drawn: opaque and the size of the surface
+        for layer in layers:
+            self.add(layer)
+
+    def add(self, layer):
+        """Add a layer, in front of the ones further away and behind the ones nearer"""
+        i = bisect.bisect_right(self.depths, layer.depth)
+        self.depths.insert(i, layer.depth)
+        self.layers.insert(i, layer)
+
+    def update(self):
+        for layer in self.layers:
+            layer.update()
+
+    def render_background(self, surface):
+        """Fill the surface with the background, which clears whatever was drawn on it before"""
+        if self.background is None:
+            return
+        if self.backdrop is None or self.backdrop.get_size() != surface.get_size():
+            # Made once per surface size, and without a colorkey: covering everything, it can be copied straight across
+            self.backdrop = pygame.Surface(surface.get_size())
+            width, height = self.background.get_size()
+            # Scaled up or down to cover the surface without stretching, and centred
+            scale = max(surface.get_width() / width, surface.get_height() / height)
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            img = self.background if size == (width, height) else pygame.transform.scale(self.background, size)
+            img = img.copy()
+            img.set_colorkey(None)
+            self.backdrop.blit(img, ((surface.get_width() - size[0]) // 2, (surface.get_height() - size[1]) // 2))
+        surface.blit(self.backdrop, (0, 0))
+
+    def render(self, surface, offset=(0, 0)):
+        """Draw the layers, far to near
+
+        :param surface -- the surface to draw on
+        :param offset -- the camera scroll
+        """
+        for layer in self.layers:
+            layer.render(surface, offset=offset)
@@ -1,24 +1,123 @@
-class Particle:
-    def __init__(self, game, particle_type, position, velocity=[0, 0], frame=0):
+import numpy as np
+
+# How fast the sine sway of drifting particles (like leaves) oscillates, per animation frame
+SWAY_RATE = 0.035
+
+class ParticleSystem:
+    def __init__(self, game, sway=None, capacity=256):
+        """A pool of particles stored as parallel NumPy arrays instead of one object per particle
+
+        Every 'particle/<type>' AnimationClip in the game assets becomes a particle type.
+
+        :param game -- the game object holding the assets
+        :param sway -- optional {particle_type: amplitude} of the horizontal sine sway, e.g. {'leaf': 0.3}
+        :param capacity -- how many particles to make room for up front (the pool grows as needed)
+        """
         self.game = game
-        self.type = particle_type
-        self.position = list(position)
-        self.velocity = list(velocity)
-        self.animation = self.game.assets['particle/' + particle_type].copy()
-        self.animation.frame = frame
+        sway = sway or {}
+
+        # Flatten every particle animation into one image list, with each type's frames starting at its base index
+        # Likewise their frame-index tables go into one flat table, so a particle's image is frame_table[type_start + frame]
+        self.types = {}
+        self.images = []
+        frame_table, starts, lengths, loops, amplitudes = [], [], [], [], []
+        for key in sorted(game.assets):
+            if not key.startswith('particle/'):
+                continue
+            clip = game.assets[key]
+            particle_type = key[len('particle/'):]
+            self.types[particle_type] = len(starts)
+            starts.append(len(frame_table))
+            frame_table.extend(len(self.images) + index for index in clip.frame_index)
+            lengths.append(clip.length)
+            loops.append(clip.loop)
+            amplitudes.append(sway.get(particle_type, 0))
+            self.images.extend(clip.images)
+
+        self.frame_table = np.array(frame_table, dtype=np.int32)
+        self.type_start = np.array(starts, dtype=np.int32)
+        self.type_length = np.array(lengths, dtype=np.int32)
+        self.type_loop = np.array(loops, dtype=bool)
+        self.type_sway = np.array(amplitudes, dtype=np.float64)
+        # Images are drawn centred on the particle position
+        self.half_sizes = np.array([(img.get_width() // 2, img.get_height() // 2) for img in self.images], dtype=np.float64).reshape(-1, 2)
+
+        self.count = 0
+        self.position = np.zeros((capacity, 2))
+        self.velocity = np.zeros((capacity, 2))
+        self.frame = np.zeros(capacity, dtype=np.int32)
+        self.type = np.zeros(capacity, dtype=np.int32)
+        self.done = np.zeros(capacity, dtype=bool) # the animation has played out
+        self.dying = np.zeros(capacity, dtype=bool) # it was already done when last updated, so it goes away next update
+        self.updated_count = 0 # particles spawned after the last update haven't been drawn yet
+
+    def __len__(self):
+        return self.count
+
+    def _grow(self, capacity):
+        for name in ('position', 'velocity', 'frame', 'type', 'done', 'dying'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def spawn(self, particle_type, position, velocity=(0, 0), frame=0):
+        """Add a particle to the pool
+
+        :param particle_type -- e.g. 'leaf' or 'particle'
+        :param position -- the X and Y pixel position
+        :param velocity -- the X and Y movement per frame
+        :param frame -- the animation frame to start on
+        """
+        if self.count == len(self.frame):
+            self._grow(len(self.frame) * 2)
+        i = self.count
+        self.position[i] = position
+        self.velocity[i] = velocity
+        self.frame[i] = frame
+        self.type[i] = self.types[particle_type]
+        self.done[i] = False
+        self.dying[i] = False
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+        self.updated_count = 0
 
     def update(self):
-        kill = False
-        if self.animation.done:
-            kill = True
+        """Move and animate every particle, and drop the ones whose animation finished"""
+        # Sway is applied after a particle has been drawn, so it lands here, before the next move
+        n = self.updated_count
+        if n and self.type_sway.any():
+            amplitude = self.type_sway[self.type[:n]]
+            self.position[:n, 0] += np.sin(self.frame[:n] * SWAY_RATE) * amplitude
+
+        # Anything that was done last update got its final draw, so it can go now
+        n = self.count
+        if self.dying[:n].any():
+            keep = np.flatnonzero(~self.dying[:n])
+            for array in (self.position, self.velocity, self.frame, self.type, self.done):
+                array[:len(keep)] = array[keep]
+            n = self.count = len(keep)
 
-        self.position[0] += self.velocity[0]
-        self.position[1] += self.velocity[1]
+        self.dying[:n] = self.done[:n]
+        self.position[:n] += self.velocity[:n]
 
-        self.animation.update()
+        # Advance the animations: looping ones wrap around, the others stop on their last frame
+        types = self.type[:n]
+        length = self.type_length[types]
+        frame = self.frame[:n] + 1
+        loop = self.type_loop[types]
+        self.frame[:n] = np.where(loop, frame % length, np.minimum(frame, length - 1))
+        self.done[:n] |= ~loop & (self.frame[:n] >= length - 1)
 
-        return kill
+        self.updated_count = n
 
     def render(self, surface, offset=(0, 0)):
-        img = self.animation.img()
-        surface.blit(img, (self.position[0] - offset[0] - img.get_width() // 2, self.position[1] - offset[1] - img.get_height() // 2))
+        n = self.count
+        if not n:
+            return
+        image_index = self.frame_table[self.type_start[self.type[:n]] + self.frame[:n]]
+        positions = self.position[:n] - self.half_sizes[image_index] - offset
+        images = self.images
+        surface.blits(zip(map(images.__getitem__, image_index.tolist()), positions.tolist()), doreturn=False)
@@ -0,0 +1,129 @@
+import numpy as np
+
+from scripts.entities import COLLIDE_UP, COLLIDE_DOWN, COLLIDE_RIGHT, COLLIDE_LEFT
+from scripts.tilemaps import NEIGHBOR_OFFSETS
+
+# Below this many entities the per-entity update is faster than setting up the arrays
+MIN_BATCH = 32
+
+NEIGHBOR_X = np.array([offset[0] for offset in NEIGHBOR_OFFSETS], dtype=np.int64)
+NEIGHBOR_Y = np.array([offset[1] for offset in NEIGHBOR_OFFSETS], dtype=np.int64)
+
+class BatchPhysics:
+    def __init__(self, min_batch=MIN_BATCH):
+        """Moves a whole group of PhysicsEntity objects at once, in NumPy passes over arrays
+
+        The positions, velocities, sizes and collision flags of the group are copied into arrays
+        (kept between ticks, so they are only reallocated when the group outgrows them), every
+        entity is moved and collided against the solid cells of the tilemap together, and the
+        results are written back. It follows PhysicsEntity.update() step by step, so the outcome
+        is the same as updating the entities one at a time.
+
+        :param min_batch -- groups smaller than this are just updated one at a time
+        """
+        self.min_batch = min_batch
+        self.capacity = 0
+
+    def _reserve(self, n):
+        if n <= self.capacity:
+            return
+        self.capacity = max(n, self.capacity * 2)
+        self.pos = np.zeros((self.capacity, 2))
+        self.velocity = np.zeros((self.capacity, 2))
+        self.size = np.zeros((self.capacity, 2), dtype=np.int64)
+        self.movement = np.zeros((self.capacity, 2))
+        self.flags = np.zeros(self.capacity, dtype=np.int64)
+
+    def _collide_axis(self, tilemap, n, axis):
+        """Move everyone along one axis and push them out of the solid tiles they end up in
+
+        The nine neighbouring cells are visited in NEIGHBOR_OFFSETS order, one vectorized pass per
+        cell, since each push moves the hit box that the next cells are tested against.
+        """
+        pos = self.pos[:n]
+        size = self.size[:n]
+        move = self.movement[:n, axis] + self.velocity[:n, axis]
+        pos[:, axis] += move
+
+        tile_size = tilemap.tile_size
+        # The hit box as pygame.Rect would have it: the position truncated toward zero
+        box = np.trunc(pos).astype(np.int64)
+        tiles = np.floor_divide(pos, tile_size).astype(np.int64)
+        cells_x = tiles[:, 0, None] + NEIGHBOR_X
+        cells_y = tiles[:, 1, None] + NEIGHBOR_Y
+        solid = tilemap.solid_cells(cells_x.ravel(), cells_y.ravel()).reshape(n, len(NEIGHBOR_OFFSETS))
+        if not solid.any():
+            return
+
+        edge = box[:, axis]
+        forward = move > 0
+        backward = move < 0
+        flags = self.flags[:n]
+        for k in range(len(NEIGHBOR_OFFSETS)):
+            if not solid[:, k].any():
+                continue
+            tile_x = cells_x[:, k] * tile_size
+            tile_y = cells_y[:, k] * tile_size
+            left = edge if axis == 0 else box[:, 0]
+            top = edge if axis == 1 else box[:, 1]
+            hit = (solid[:, k] & (left < tile_x + tile_size) & (left + size[:, 0] > tile_x)
+                   & (top < tile_y + tile_size) & (top + size[:, 1] > tile_y))
+            if not hit.any():
+                continue
+            tile = tile_x if axis == 0 else tile_y
+            edge = np.where(hit & forward, tile - size[:, axis], edge)
+            edge = np.where(hit & backward, tile + tile_size, edge)
+            flags |= np.where(hit & forward, COLLIDE_RIGHT if axis == 0 else COLLIDE_DOWN, 0)
+            flags |= np.where(hit & backward, COLLIDE_LEFT if axis == 0 else COLLIDE_UP, 0)
+            # Any collision snaps the position onto the (integer) hit box, even without movement on this axis
+            pos[:, axis] = np.where(hit, edge, pos[:, axis])
+
+    def step(self, entities, movements, tilemap):
+        """Apply movement, axis-separated tile collision and gravity to a group of entities
+
+        :param entities -- the PhysicsEntity objects to move
+        :param movements -- the movement of each one this tick, as (x, y) pairs
+        :param tilemap -- Tilemap object of the current room
+        """
+        n = len(entities)
+        if not n:
+            return
+        self._reserve(n)
+        self.pos[:n] = [entity.pos for entity in entities]
+        self.velocity[:n] = [entity.velocity for entity in entities]
+        self.size[:n] = [entity.size for entity in entities]
+        self.movement[:n] = [movement[:2] for movement in movements]
+        self.flags[:n] = 0
+
+        self._collide_axis(tilemap, n, 0)
+        self._collide_axis(tilemap, n, 1)
+
+        # Applying gravity and cap at terminal velocity, and stop when we hit the ground or the ceiling
+        velocity = self.velocity[:n]
+        velocity[:, 1] = np.minimum(5, velocity[:, 1] + 0.1)
+        velocity[:, 1] = np.where(self.flags[:n] & (COLLIDE_DOWN | COLLIDE_UP), 0, velocity[:, 1])
+
+        for entity, pos, vel, flags in zip(entities, self.pos[:n].tolist(), velocity.tolist(), self.flags[:n].tolist()):
+            entity.prev_pos = (entity.pos[0], entity.pos[1])
+            entity.pos[0], entity.pos[1] = pos
+            entity.velocity[0], entity.velocity[1] = vel
+            entity.collision_flags = flags
+
+    def update(self, entities, tilemap):
+        """Update a group of enemies like calling Enemy.update(tilemap) on each of them, with the physics batched
+
+        The AI runs first for everyone (in order, so the random rolls and shots come out the same),
+        then the physics for the whole group, then the animations.
+
+        :param entities -- the Enemy objects to update
+        :param tilemap -- Tilemap object of the current room
+        """
+        if len(entities) < self.min_batch:
+            for entity in entities:
+                entity.update(tilemap, (0, 0))
+            return
+
+        movements = [entity.control(tilemap, (0, 0)) for entity in entities]
+        self.step(entities, movements, tilemap)
+        for entity, movement in zip(entities, movements):
+            entity.end_update(movement)
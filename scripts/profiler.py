@@ -0,0 +1,122 @@
+import os
+import json
+import time
+from collections import deque
+
+import pygame
+
+class FrameProfiler:
+    def __init__(self, enabled=False, history=240, max_trace_events=200000):
+        """Times each stage of the game loop, frame by frame
+
+        Call start_frame() at the top of the loop and mark(stage) right after each stage
+        finishes; the time since the previous mark is charged to that stage.
+
+        :param enabled -- whether to record anything (when off, every call returns straight away)
+        :param history -- how many frames of timings to keep per stage
+        :param max_trace_events -- cap on the trace events kept for export, oldest dropped first
+        """
+        self.enabled = enabled
+        self.history = history
+        self.overlay = enabled
+        self.timings = {} # stage -> deque of the last `history` durations in ms
+        self.counts = {} # name -> latest value, e.g. number of enemies
+        self.trace = deque(maxlen=max_trace_events)
+        self.frame_start = 0
+        self.last_mark = 0
+        self.font = None
+        self.pid = os.getpid()
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self.overlay = self.enabled
+        # We may be switched on halfway through a frame, so start timing from here
+        self.frame_start = self.last_mark = time.perf_counter_ns()
+
+    def start_frame(self):
+        if not self.enabled:
+            return
+        self.frame_start = self.last_mark = time.perf_counter_ns()
+
+    def mark(self, stage):
+        """Charge the time since the previous mark to a stage
+
+        :param stage -- the name of the stage that just finished, e.g. 'tilemap'
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter_ns()
+        if stage not in self.timings:
+            self.timings[stage] = deque(maxlen=self.history)
+        self.timings[stage].append((now - self.last_mark) / 1e6)
+        self.trace.append(('X', stage, self.last_mark, now - self.last_mark))
+        self.last_mark = now
+
+    def count(self, name, value):
+        """Record how many of something there were this frame
+
+        :param name -- what is being counted, e.g. 'particles'
+        :param value -- how many there are
+        """
+        if not self.enabled:
+            return
+        self.counts[name] = value
+        self.trace.append(('C', name, self.last_mark, value))
+
+    def end_frame(self):
+        if not self.enabled:
+            return
+        now = time.perf_counter_ns()
+        if 'frame' not in self.timings:
+            self.timings['frame'] = deque(maxlen=self.history)
+        self.timings['frame'].append((now - self.frame_start) / 1e6)
+        self.trace.append(('X', 'frame', self.frame_start, now - self.frame_start))
+
+    def stats(self):
+        """Summarize the recent timings of every stage
+
+        :return -- {stage: {'mean', 'p95', 'max'}} in milliseconds
+        """
+        summary = {}
+        for stage, samples in self.timings.items():
+            ordered = sorted(samples)
+            summary[stage] = {
+                'mean' : sum(ordered) / len(ordered),
+                'p95' : ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                'max' : ordered[-1],
+            }
+        return summary
+
+    def render(self, surface):
+        """Draw the debug overlay: a bar and the mean/p95 time of every stage, plus the entity counts"""
+        if not self.overlay:
+            return
+        if self.font is None:
+            self.font = pygame.font.Font(None, 12)
+
+        y = 2
+        for stage, stat in self.stats().items():
+            # A full-width bar is one 60 FPS frame (16.7 ms)
+            pygame.draw.rect(surface, (60, 200, 90) if stage != 'frame' else (220, 200, 60), (2, y + 2, min(60, stat['mean'] / 16.7 * 60), 5))
+            surface.blit(self.font.render(stage, False, (255, 255, 255), (0, 0, 0)), (64, y))
+            surface.blit(self.font.render('%.2f / %.2f ms' % (stat['mean'], stat['p95']), False, (255, 255, 255), (0, 0, 0)), (150, y))
+            y += 9
+        for name, value in self.counts.items():
+            surface.blit(self.font.render('%s: %d' % (name, value), False, (255, 255, 255), (0, 0, 0)), (64, y))
+            y += 9
+
+    def export_trace(self, path):
+        """Write the recorded frames as Chrome trace-event JSON, for chrome://tracing or Perfetto
+
+        :param path -- the file path wherein the .json trace will reside
+        """
+        events = []
+        for kind, name, start, value in self.trace:
+            if kind == 'X':
+                events.append({'name' : name, 'ph' : 'X', 'ts' : start / 1000, 'dur' : value / 1000, 'pid' : self.pid, 'tid' : 0 if name == 'frame' else 1})
+            else:
+                events.append({'name' : name, 'ph' : 'C', 'ts' : start / 1000, 'pid' : self.pid, 'args' : {name : value}})
+
+        f = open(path, 'w')
+        json.dump({'traceEvents' : events, 'displayTimeUnit' : 'ms'}, f)
+        f.close()
@@ -0,0 +1,84 @@
+import numpy as np
+
+class ProjectileSystem:
+    def __init__(self, game, img, capacity=1024, lifetime=360):
+        """A fixed-size pool of projectiles stored as parallel NumPy arrays
+
+        :param game -- the game object
+        :param img -- the projectile sprite
+        :param capacity -- the most projectiles that can be in flight at once
+        :param lifetime -- how many frames a projectile flies before it disappears
+        """
+        self.game = game
+        self.img = img
+        self.lifetime = lifetime
+        self.half_size = np.array((img.get_width() / 2, img.get_height() / 2))
+
+        self.count = 0
+        self.position = np.zeros((capacity, 2))
+        self.speed = np.zeros(capacity) # horizontal movement per frame, the sign is the direction
+        self.timer = np.zeros(capacity, dtype=np.int32)
+        self.dead = np.zeros(capacity, dtype=bool) # hit something or timed out, removed on the next update
+
+    def __len__(self):
+        return self.count
+
+    def spawn(self, pos, direction):
+        """Fire a projectile
+
+        :param pos -- the X and Y pixel position it starts from
+        :param direction -- its horizontal speed, negative for travelling left
+        :return -- True if it was fired, False if the pool is full
+        """
+        if self.count == len(self.timer):
+            return False
+        i = self.count
+        self.position[i] = pos
+        self.speed[i] = direction
+        self.timer[i] = 0
+        self.dead[i] = False
+        self.count += 1
+        return True
+
+    def clear(self):
+        self.count = 0
+
+    def _remove_dead(self):
+        """Swap-remove the dead slots, moving live projectiles from the end of the pool into the holes"""
+        n = self.count
+        dead = np.flatnonzero(self.dead[:n])
+        if not len(dead):
+            return
+        m = n - len(dead)
+        holes = dead[dead < m]
+        fillers = np.flatnonzero(~self.dead[m:n]) + m
+        for array in (self.position, self.speed, self.timer, self.dead):
+            array[holes] = array[fillers]
+        self.count = m
+
+    def update(self, tilemap):
+        """Move every projectile and flag the ones that flew into a wall or ran out of time
+
+        :param tilemap -- Tilemap object of the current room
+        """
+        self._remove_dead()
+        n = self.count
+        if not n:
+            return
+        self.position[:n, 0] += self.speed[:n]
+        self.timer[:n] += 1
+        self.dead[:n] = tilemap.solid_check_many(self.position[:n]) | (self.timer[:n] > self.lifetime)
+
+    def render(self, surface, offset=(0, 0), alpha=1):
+        """Draw every projectile
+
+        :param alpha -- how far into the next update we are, to draw them part of the way back along their last move
+        """
+        n = self.count
+        if not n:
+            return
+        positions = self.position[:n] - self.half_size - offset
+        if alpha != 1:
+            positions[:, 0] -= self.speed[:n] * (1 - alpha)
+        positions = positions.tolist()
+        surface.blits([(self.img, pos) for pos in positions], doreturn=False)
@@ -0,0 +1,182 @@
+import math
+
+class SpatialHash:
+    def __init__(self, cell_size=64):
+        """A uniform grid of buckets for finding things by where they are, instead of scanning all of them
+
+        :param cell_size -- the width and height of a bucket in pixels
+        """
+        self.cell_size = cell_size
+        self.cells = {} # (cell_x, cell_y) -> {item_id: None}, a dict used as an ordered set
+        self.items = {} # item_id -> [obj, (x, y, w, h), list of cells it sits in]
+        self.next_id = 0
+        self.reordered = False # whether the dict order of items has fallen out of id order
+
+    def __len__(self):
+        return len(self.items)
+
+    def cells_for(self, rect):
+        """All the bucket keys a rectangle overlaps, as (x, y) bucket coordinates"""
+        x0, y0 = int(rect[0] // self.cell_size), int(rect[1] // self.cell_size)
+        # Rects are half-open, and a zero sized one still lives in the bucket of its top left corner
+        x1 = max(x0, math.ceil((rect[0] + rect[2]) / self.cell_size) - 1)
+        y1 = max(y0, math.ceil((rect[1] + rect[3]) / self.cell_size) - 1)
+        return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+    def insert(self, obj, rect, item_id=None):
+        """Add something to the index
+
+        :param obj -- whatever should be handed back by queries
+        :param rect -- its bounding box as (x, y, w, h) in pixels
+        :param item_id -- put it back under an id it had before it was removed (e.g. to undo the removal), so it keeps its place in the order
+        :return -- the id used to move or remove it later
+        """
+        if item_id is None:
+            item_id = self.next_id
+            self.next_id += 1
+        elif item_id in self.items:
+            raise KeyError('id %d is already in use' % item_id)
+        else:
+            # Iteration goes by id, which the dict order no longer matches once an old id comes back
+            if self.items and item_id < self.next_id - 1:
+                self.reordered = True
+            self.next_id = max(self.next_id, item_id + 1)
+        cells = self.cells_for(rect)
+        for cell in cells:
+            if cell not in self.cells:
+                self.cells[cell] = {}
+            self.cells[cell][item_id] = None
+        self.items[item_id] = [obj, tuple(rect), cells]
+        return item_id
+
+    def remove(self, item_id):
+        """Take something out of the index
+
+        :param item_id -- the id returned by insert()
+        :return -- the object that was stored
+        """
+        obj, rect, cells = self.items.pop(item_id)
+        for cell in cells:
+            bucket = self.cells[cell]
+            del bucket[item_id]
+            if not bucket:
+                del self.cells[cell]
+        return obj
+
+    def move(self, item_id, rect):
+        """Update the bounding box of something already in the index
+
+        :param item_id -- the id returned by insert()
+        :param rect -- the new bounding box as (x, y, w, h)
+        """
+        item = self.items[item_id]
+        cells = self.cells_for(rect)
+        if cells != item[2]:
+            for cell in item[2]:
+                bucket = self.cells[cell]
+                del bucket[item_id]
+                if not bucket:
+                    del self.cells[cell]
+            for cell in cells:
+                if cell not in self.cells:
+                    self.cells[cell] = {}
+                self.cells[cell][item_id] = None
+            item[2] = cells
+        item[1] = tuple(rect)
+
+    def copy(self):
+        """A separate index holding the same things under the same ids (the things themselves are shared)"""
+        other = SpatialHash(self.cell_size)
+        other.cells = {cell : dict(bucket) for cell, bucket in self.cells.items()}
+        other.items = {item_id : [obj, rect, list(cells)] for item_id, (obj, rect, cells) in self.items.items()}
+        other.next_id = self.next_id
+        other.reordered = self.reordered
+        return other
+
+    def clear(self):
+        self.cells = {}
+        self.items = {}
+        self.reordered = False
+
+    def get(self, item_id):
+        return self.items[item_id][0]
+
+    def rect(self, item_id):
+        return self.items[item_id][1]
+
+    def query_rect(self, rect):
+        """Find everything overlapping a rectangle
+
+        :param rect -- the area to search as (x, y, w, h)
+        :return -- a list of (item_id, obj) pairs, in the order they were inserted
+        """
+        found = set()
+        for cell in self.cells_for(rect):
+            if cell in self.cells:
+                found.update(self.cells[cell])
+
+        hits = []
+        for item_id in sorted(found):
+            obj, r, cells = self.items[item_id]
+            if r[0] < rect[0] + rect[2] and r[0] + r[2] > rect[0] and r[1] < rect[1] + rect[3] and r[1] + r[3] > rect[1]:
+                hits.append((item_id, obj))
+        return hits
+
+    def query_point(self, pos):
+        """Find everything whose bounding box contains a point
+
+        :param pos -- the X and Y pixel position
+        :return -- a list of (item_id, obj) pairs, in the order they were inserted
+        """
+        cell = (int(pos[0] // self.cell_size), int(pos[1] // self.cell_size))
+        hits = []
+        for item_id in sorted(self.cells.get(cell, ())):
+            obj, r, cells = self.items[item_id]
+            if r[0] <= pos[0] < r[0] + r[2] and r[1] <= pos[1] < r[1] + r[3]:
+                hits.append((item_id, obj))
+        return hits
+
+    def query_radius(self, pos, radius):
+        """Find everything whose bounding box comes within a distance of a point
+
+        :param pos -- the X and Y pixel position
+        :param radius -- the distance in pixels
+        :return -- a list of (item_id, obj) pairs, in the order they were inserted
+        """
+        hits = []
+        for item_id, obj in self.query_rect((pos[0] - radius, pos[1] - radius, radius * 2, radius * 2)):
+            r = self.items[item_id][1]
+            # Distance from the point to the closest point of the box
+            dx = max(r[0] - pos[0], 0, pos[0] - (r[0] + r[2]))
+            dy = max(r[1] - pos[1], 0, pos[1] - (r[1] + r[3]))
+            if dx * dx + dy * dy <= radius * radius:
+                hits.append((item_id, obj))
+        return hits
+
+    def pairs(self):
+        """Find every pair of things whose bounding boxes overlap, each pair once
+
+        Only things sharing a bucket get compared, so this stays cheap as long as the buckets do.
+
+        :return -- a list of ((item_id, obj), (item_id, obj)) pairs, the lower id first, sorted by id
+        """
+        found = set()
+        for bucket in self.cells.values():
+            if len(bucket) < 2:
+                continue
+            ids = list(bucket)
+            for i, a in enumerate(ids):
+                ra = self.items[a][1]
+                for b in ids[i + 1:]:
+                    rb = self.items[b][1]
+                    if ra[0] < rb[0] + rb[2] and ra[0] + ra[2] > rb[0] and ra[1] < rb[1] + rb[3] and ra[1] + ra[3] > rb[1]:
+                        found.add((a, b) if a < b else (b, a))
+        return [((a, self.items[a][0]), (b, self.items[b][0])) for a, b in sorted(found)]
+
+    def __iter__(self):
+        """Iterate over (item_id, obj) pairs in id order, which is the order they were first inserted"""
+        if self.reordered:
+            self.items = dict(sorted(self.items.items()))
+            self.reordered = False
+        for item_id, item in list(self.items.items()):
+            yield item_id, item[0]
@@ -0,0 +1,219 @@
+import queue
+import threading
+
+import pygame
+
+from scripts.mapfile import MapFile
+from scripts.tilemaps import CHUNK_MASK, CHUNK_SHIFT, CHUNK_SIZE, EMPTY
+
+# How many chunks past the edge of the screen stay active, so enemies just off screen still have ground to stand on
+ACTIVE_MARGIN = 1
+# How far ahead of the camera to prefetch, in ticks of its current velocity
+PREFETCH_TICKS = 90
+# How long a chunk may sit off screen before it is unloaded, in ticks (5 s at 60 FPS)
+UNLOAD_AFTER = 300
+
+class WorldStreamer:
+    def __init__(self, game, path, margin=ACTIVE_MARGIN, prefetch_ticks=PREFETCH_TICKS, unload_after=UNLOAD_AFTER):
+        """Streams the chunks of a binary map in and out of the game around the camera
+
+        A chunk becomes active (its tiles go into the tilemap, its trees become leaf spawners and
+        its enemy spawners spawn enemies) as soon as it comes within `margin` chunks of the screen,
+        which only depends on the camera, so headless runs stay deterministic. A background thread
+        decodes the chunks the camera is heading for before they are needed; if one isn't ready in
+        time it is decoded on the spot.
+
+        :param game -- the game to stream into (its tilemap is emptied and takes the map's type table)
+        :param path -- the file path of the binary map, see scripts/mapfile.py
+        :param margin -- how many chunks around the screen are kept active
+        :param prefetch_ticks -- how far ahead of the camera to prefetch, in ticks of its current velocity
+        :param unload_after -- how many ticks a chunk may be off screen before it gets unloaded
+        """
+        self.game = game
+        self.map_file = MapFile(path)
+        if self.map_file.chunk_size != CHUNK_SIZE:
+            self.map_file.close()
+            raise ValueError('%s uses %d-cell chunks, expected %d' % (path, self.map_file.chunk_size, CHUNK_SIZE))
+        self.margin = margin
+        self.prefetch_ticks = prefetch_ticks
+        self.unload_after = unload_after
+
+        self.tilemap = game.tilemap
+        self.tilemap.use_type_table(self.map_file.type_names)
+        self.tilemap.tile_size = self.map_file.tile_size
+        self.chunk_pixels = CHUNK_SIZE * self.map_file.tile_size
+        # Spawners can sit on the grid as well as off it; either way they never go into the tilemap
+        self.spawner_id = self.tilemap.type_ids.get('spawners')
+
+        self.decoded = {} # key -> (grid data, offgrid tiles) ready to activate, filled by the prefetch thread
+        self.pending = set() # keys handed to the prefetch thread that haven't come back yet
+        self.active = {} # key -> {'offgrid', 'spawners', 'enemies'} of everything the chunk put into the game
+        self.last_seen = {} # key -> tick the chunk was last near the screen, for active and decoded chunks
+        self.last_scroll = None
+
+        # The prefetch thread only ever decodes; everything that touches the game happens in update()
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.thread = threading.Thread(target=self._prefetch_worker, daemon=True)
+        self.thread.start()
+
+    def _decode(self, key):
+        return self.map_file.read_chunk(key), self.map_file.read_offgrid(key)
+
+    def _prefetch_worker(self):
+        while True:
+            key = self.requests.get()
+            if key is None:
+                return
+            self.results.put((key, self._decode(key)))
+
+    def close(self):
+        """Stop the prefetch thread and let go of the map file"""
+        self.requests.put(None)
+        self.thread.join()
+        self.map_file.close()
+
+    def player_spawn(self):
+        """Find where the player starts, looking only in the chunks whose type bitmask has spawners in it
+
+        :return -- the pixel position of the player spawner, or None if the map has none
+        """
+        spawner_id = self.spawner_id
+        if spawner_id is None:
+            return None
+        bit = 1 << min(spawner_id, 63)
+        for key, entry in sorted(self.map_file.index.items()):
+            if entry[4] & bit:
+                for order, tile in self.map_file.read_offgrid(key):
+                    if tile['type'] == 'spawners' and tile['variant'] == 0:
+                        return tile['pos']
+                for i, pos, variant in self._grid_spawners(key, self.map_file.read_chunk(key)):
+                    if variant == 0:
+                        return pos
+        return None
+
+    def _grid_spawners(self, key, grid):
+        """Find the spawners on the grid of a decoded chunk
+
+        :param key -- the chunk
+        :param grid -- its (types, variants, count) as read from the map file, or None
+        :return -- a list of (flat index in the chunk, pixel position, variant)
+        """
+        if grid is None or self.spawner_id is None or self.spawner_id not in grid[0]:
+            return []
+        types, variants, count = grid
+        size = self.map_file.tile_size
+        return [(i, [((key[0] << CHUNK_SHIFT) | (i & CHUNK_MASK)) * size, ((key[1] << CHUNK_SHIFT) | (i >> CHUNK_SHIFT)) * size], variants[i])
+                for i in range(len(types)) if types[i] == self.spawner_id]
+
+    def chunks_in_rect(self, rect):
+        """List the keys of the chunks in the map file that overlap a pixel area
+
+        :param rect -- the (x, y, w, h) area in pixels
+        """
+        size = self.chunk_pixels
+        keys = []
+        for cx in range(int(rect[0] // size), int((rect[0] + rect[2]) // size) + 1):
+            for cy in range(int(rect[1] // size), int((rect[1] + rect[3]) // size) + 1):
+                if (cx, cy) in self.map_file.index:
+                    keys.append((cx, cy))
+        return keys
+
+    def _activate(self, key, data):
+        """Put a decoded chunk into the game: its tiles, its decor, its leaf spawners and its enemies"""
+        grid, offgrid = data
+        record = {'offgrid' : [], 'spawners' : [], 'enemies' : []}
+        if grid is not None:
+            types, variants, count = grid
+            # Spawners on the grid come out of the chunk before it goes in, like Game.__init__ extracts them from a loaded map
+            for i, pos, variant in self._grid_spawners(key, grid):
+                if variant == 1:
+                    record['enemies'].append(self.game.spawn_enemy(pos))
+                types[i] = EMPTY
+                variants[i] = 0
+                count -= 1
+            if count:
+                self.tilemap.install_chunk(key, types, variants, count)
+
+        for order, tile in offgrid:
+            if tile['type'] == 'spawners':
+                # The player spawner was used once at the start, enemies respawn whenever their chunk comes back
+                if tile['variant'] == 1:
+                    enemy = self.game.spawn_enemy(tile['pos'])
+                    record['enemies'].append(enemy)
+                continue
+            record['offgrid'].append(self.tilemap.add_offgrid(tile))
+            if (tile['type'], tile['variant']) == ('large_decor', 2):
+                rect = pygame.Rect(4 + tile['pos'][0], 4 + tile['pos'][1], 23, 13)
+                record['spawners'].append(rect)
+                self.game.leaf_spawners.append(rect)
+        self.active[key] = record
+
+    def _deactivate(self, key):
+        """Take everything a chunk put into the game back out again"""
+        record = self.active.pop(key)
+        self.tilemap.drop_chunk(key)
+        for tile_id in record['offgrid']:
+            self.tilemap.remove_offgrid(tile_id)
+        if record['spawners']:
+            dropped = set(map(id, record['spawners']))
+            self.game.leaf_spawners = [rect for rect in self.game.leaf_spawners if id(rect) not in dropped]
+        if record['enemies']:
+            dropped = set(map(id, record['enemies']))
+            self.game.enemies = [enemy for enemy in self.game.enemies if id(enemy) not in dropped]
+
+    def update(self):
+        """Activate the chunks around the camera, prefetch the ones it is heading for, and unload the stale ones"""
+        game = self.game
+        ticks = game.ticks
+        view = (game.scroll[0], game.scroll[1], game.display.get_width(), game.display.get_height())
+
+        # Collect whatever the prefetch thread finished since last tick
+        while True:
+            try:
+                key, data = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.pending.discard(key)
+            if key not in self.active:
+                self.decoded[key] = data
+                self.last_seen.setdefault(key, ticks)
+
+        # Everything within the margin of the screen has to be active this tick
+        size = self.chunk_pixels
+        m = self.margin * size
+        area = (view[0] - m, view[1] - m, view[2] + m * 2, view[3] + m * 2)
+        for key in self.chunks_in_rect(area):
+            self.last_seen[key] = ticks
+            if key not in self.active:
+                data = self.decoded.pop(key, None)
+                if data is None:
+                    # The prefetch didn't get there in time (or the camera jumped), so decode it right now
+                    data = self._decode(key)
+                self._activate(key, data)
+
+        # Ask for the chunks the camera will reach if it keeps moving the way it is
+        if self.last_scroll is not None:
+            ahead = ((view[0] - self.last_scroll[0]) * self.prefetch_ticks, (view[1] - self.last_scroll[1]) * self.prefetch_ticks)
+            if ahead[0] or ahead[1]:
+                for key in self.chunks_in_rect((view[0] + ahead[0] - m, view[1] + ahead[1] - m, view[2] + m * 2, view[3] + m * 2)):
+                    if key not in self.active and key not in self.decoded and key not in self.pending:
+                        self.pending.add(key)
+                        self.requests.put(key)
+        self.last_scroll = (view[0], view[1])
+
+        # Enemies that wandered out of the active chunks have nothing to walk on, so they go too
+        area = pygame.Rect(area)
+        stray = [enemy for enemy in game.enemies
+                 if not area.collidepoint(enemy.pos) and (int(enemy.pos[0] // size), int(enemy.pos[1] // size)) not in self.active]
+        if stray:
+            dropped = set(map(id, stray))
+            game.enemies = [enemy for enemy in game.enemies if id(enemy) not in dropped]
+
+        # Unload whatever has been away from the screen for too long
+        for key, seen in list(self.last_seen.items()):
+            if ticks - seen > self.unload_after:
+                del self.last_seen[key]
+                if key in self.active:
+                    self._deactivate(key)
+                self.decoded.pop(key, None)
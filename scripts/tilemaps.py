@@ -1,6 +1,13 @@
 import json
+from array import array
+from collections import OrderedDict
+
+import numpy as np
 import pygame
 
+from scripts.spatial import SpatialHash
+from scripts.mapfile import MapFile, is_map_file, save_map_file, type_mask, write_atomic
+
 # Rules for neighboring tiles and autotiling
 AUTOTILE_MAP = {
     tuple(sorted([(1, 0), (0, 1)])) : 0,
@@ -18,35 +25,638 @@ NEIGHBOR_OFFSETS = [(-1, 0), (-1, -1), (0, -1), (1, -1), (1, 0), (0, 0), (-1, 1)
 PHYSICS_TILES = {'grass', 'stone'}
 # Auto-tiling assets
 AUTOTILE_TYPES = {'grass', 'stone'}
+# The same rules as a lookup table indexed by a bitmask of matching neighbours, one bit per entry of AUTOTILE_SHIFTS
+AUTOTILE_SHIFTS = [(1, 0), (-1, 0), (0, -1), (0, 1)]
+AUTOTILE_LUT = [AUTOTILE_MAP.get(tuple(sorted(shift for bit, shift in enumerate(AUTOTILE_SHIFTS) if mask & (1 << bit))))
+                for mask in range(1 << len(AUTOTILE_SHIFTS))]
+# ...and as an array for autotiling whole chunks at once, with -1 where the rules leave the variant alone
+AUTOTILE_VARIANTS = np.array([-1 if variant is None else variant for variant in AUTOTILE_LUT], dtype=np.int16)
+
+# Grid tiles are stored in square chunks of CHUNK_SIZE x CHUNK_SIZE cells
+CHUNK_SHIFT = 4
+CHUNK_SIZE = 1 << CHUNK_SHIFT
+CHUNK_MASK = CHUNK_SIZE - 1
+CHUNK_AREA = CHUNK_SIZE * CHUNK_SIZE
+# NEIGHBOR_OFFSETS as (bit, index delta) pairs within a chunk's flat arrays
+NEIGHBOR_DELTAS = [(1 << i, (offset[1] << CHUNK_SHIFT) + offset[0]) for i, offset in enumerate(NEIGHBOR_OFFSETS)]
+# Type id of a cell with no tile in it
+EMPTY = -1
+# How many pre-rendered chunk surfaces to keep around before evicting the least recently used one
+CHUNK_CACHE_SIZE = 64
+# Bucket size of the spatial index over the off-grid decor, in pixels
+OFFGRID_CELL_SIZE = 64
+# The most cells a single flood fill may cover
+FLOOD_FILL_LIMIT = 1000000
+# How far from where it starts a flood fill may reach, in cells, so the area it searches stays small on a huge map
+FLOOD_FILL_REACH = 2048
+
+class Chunk:
+    __slots__ = ('types', 'variants', 'count', 'solid')
+
+    def __init__(self):
+        """A block of grid cells stored as flat integer arrays, indexed by (y * CHUNK_SIZE + x) inside the chunk"""
+        self.types = array('h', [EMPTY]) * CHUNK_AREA # index into Tilemap.type_names, or EMPTY
+        self.variants = array('B', bytes(CHUNK_AREA))
+        self.count = 0 # number of non-empty cells, so empty chunks can be dropped
+        self.solid = None # cached NumPy occupancy mask of the physics tiles, rebuilt after edits
 
 class Tilemap:
     def __init__(self, game, tile_size=16):
         self.game = game
         self.tile_size = tile_size
-        self.tilemap = {}
-        self.offgrid_tiles = []
+        self.chunk_size = CHUNK_SIZE
+        self.chunks = {} # (chunk_x, chunk_y) -> Chunk
+
+        # A binary map is opened with mmap and its chunks only get decoded the first time something touches them
+        self.map_file = None
+        self.lazy_chunks = set() # keys of the chunks still sitting undecoded in map_file
+        self.offgrid = SpatialHash(OFFGRID_CELL_SIZE) # off-grid decor, indexed by the area its image covers
+
+        # Tile type names are interned as small integers, so the grid never stores strings
+        self.type_names = []
+        self.type_ids = {}
+        self.solid_types = [] # per type id: is it one of the PHYSICS_TILES?
+        self.autotile_types = [] # per type id: is it one of the AUTOTILE_TYPES?
+
+        # Cells whose autotile variant may be stale, every edited cell and its 4 neighbours, as
+        # (chunk_x, chunk_y) -> NumPy bool array flagging them by their flat index in the chunk
+        self.dirty_cells = {}
+
+        # Functions told about every edit, e.g. the editor's undo history; see add_listener()
+        self.listeners = []
+
+        # Static grid geometry gets baked into one surface per chunk, built lazily when it first comes into view
+        self.chunk_surfaces = OrderedDict() # (chunk_x, chunk_y) -> Surface, or None for chunks with nothing to draw
+        self.chunk_cache_size = CHUNK_CACHE_SIZE
+
+    def type_id(self, tile_type):
+        """Look up (or register) the integer id of a tile type name
+
+        :param tile_type -- the tile type name, e.g. 'grass'
+        :return -- the id stored in the chunk arrays
+        """
+        if tile_type not in self.type_ids:
+            self.type_ids[tile_type] = len(self.type_names)
+            self.type_names.append(tile_type)
+            self.solid_types.append(tile_type in PHYSICS_TILES)
+            self.autotile_types.append(tile_type in AUTOTILE_TYPES)
+        return self.type_ids[tile_type]
+
+    def _read_chunk(self, key):
+        """Decode a chunk out of the binary map file
+
+        :param key -- the (chunk_x, chunk_y) to decode
+        :return -- the Chunk, or None if the file has no tiles there
+        """
+        self.lazy_chunks.discard(key)
+        data = self.map_file.read_chunk(key)
+        if data is None:
+            return None
+        chunk = self.chunks[key] = Chunk()
+        chunk.types, chunk.variants, chunk.count = data
+        return chunk
+
+    def _chunk(self, key):
+        """The chunk stored under a key (decoding it first if it was lazily loaded), or None"""
+        chunk = self.chunks.get(key)
+        if chunk is None and key in self.lazy_chunks:
+            chunk = self._read_chunk(key)
+        return chunk
+
+    def install_chunk(self, key, types, variants, count):
+        """Put a chunk decoded elsewhere (e.g. by the world streamer) into the map
+
+        :param key -- the (chunk_x, chunk_y) it goes to
+        :param types -- its array('h') of type ids, numbered like this map's type table
+        :param variants -- its array('B') of variants
+        :param count -- how many of its cells hold a tile
+        """
+        chunk = self.chunks[key] = Chunk()
+        chunk.types, chunk.variants, chunk.count = types, variants, count
+        self.invalidate((key[0] << CHUNK_SHIFT, key[1] << CHUNK_SHIFT))
+
+    def drop_chunk(self, key):
+        """Take a chunk out of the map along with the cached surfaces it is drawn onto
+
+        :param key -- the (chunk_x, chunk_y) to drop
+        :return -- the dropped Chunk, or None if there wasn't one
+        """
+        chunk = self.chunks.pop(key, None)
+        if chunk is not None:
+            self.invalidate((key[0] << CHUNK_SHIFT, key[1] << CHUNK_SHIFT))
+        return chunk
+
+    def use_type_table(self, type_names):
+        """Start over with an empty map whose type ids are numbered like a binary map's type table
+
+        :param type_names -- the tile type names, in id order
+        """
+        self._reset()
+        for tile_type in type_names:
+            self.type_id(tile_type)
+
+    def all_chunks(self):
+        """Decode whatever is still lazily loaded and list every (key, Chunk) pair"""
+        for key in list(self.lazy_chunks):
+            self._read_chunk(key)
+        return list(self.chunks.items())
+
+    def _type_at(self, x, y):
+        """Type id of the grid cell (x, y), or EMPTY"""
+        key = (x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            # This is the hottest lookup there is, so the lazy path is inlined rather than going through _chunk()
+            if key not in self.lazy_chunks:
+                return EMPTY
+            chunk = self._read_chunk(key)
+            if chunk is None:
+                return EMPTY
+        return chunk.types[((y & CHUNK_MASK) << CHUNK_SHIFT) | (x & CHUNK_MASK)]
+
+    def add_listener(self, listener):
+        """Have a function called after every change to a tile (loading a map doesn't count)
+
+        It is called as listener(kind, changes), where changes is a list of (key, before, after) for one
+        edit, naming each key once, so a bulk edit costs a single call:
+            'grid', (x, y), (type, variant) or None, (type, variant) or None -- a grid cell changed
+            'offgrid', tile id, tile dict or None, tile dict or None -- an off-grid tile was added or removed
+
+        :param listener -- the function to call
+        """
+        self.listeners.append(listener)
+
+    def _notify(self, kind, changes):
+        for listener in self.listeners:
+            listener(kind, changes)
+
+    def _dirty_mask(self, key):
+        mask = self.dirty_cells.get(key)
+        if mask is None:
+            mask = self.dirty_cells[key] = np.zeros(CHUNK_AREA, dtype=bool)
+        return mask
+
+    def _mark_dirty(self, x, y):
+        for x, y in ((x, y), (x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+            self._dirty_mask((x >> CHUNK_SHIFT, y >> CHUNK_SHIFT))[((y & CHUNK_MASK) << CHUNK_SHIFT) | (x & CHUNK_MASK)] = True
+
+    def invalidate(self, pos):
+        """Throw away the cached chunk surfaces that a grid cell is drawn onto
+
+        :param pos -- the X and Y grid position that changed
+        """
+        cx, cy = int(pos[0]) >> CHUNK_SHIFT, int(pos[1]) >> CHUNK_SHIFT
+        # Tile images can be bigger than a cell, so they may spill over into the chunks to the right and below
+        for key in ((cx, cy), (cx + 1, cy), (cx, cy + 1), (cx + 1, cy + 1)):
+            self.chunk_surfaces.pop(key, None)
+
+    def _tile_dict(self, x, y, chunk, i):
+        return {'type' : self.type_names[chunk.types[i]], 'variant' : chunk.variants[i], 'pos' : [x, y]}
+
+    def get_tile(self, pos):
+        """Get the tile at a grid position
+
+        :param pos -- the X and Y grid position
+        :return -- the tile as a {'type', 'variant', 'pos'} dict, or None if the cell is empty
+        """
+        x, y = int(pos[0]), int(pos[1])
+        chunk = self._chunk((x >> CHUNK_SHIFT, y >> CHUNK_SHIFT))
+        if chunk is not None:
+            i = ((y & CHUNK_MASK) << CHUNK_SHIFT) | (x & CHUNK_MASK)
+            if chunk.types[i] != EMPTY:
+                return self._tile_dict(x, y, chunk, i)
+
+    def set_tile(self, pos, tile_type, variant=0):
+        """Place a tile on the grid, replacing whatever was there
+
+        :param pos -- the X and Y grid position
+        :param tile_type -- the tile type name
+        :param variant -- index of the tile image within its type
+        """
+        x, y = int(pos[0]), int(pos[1])
+        key = (x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+        chunk = self._chunk(key)
+        if chunk is None:
+            chunk = self.chunks[key] = Chunk()
+        i = ((y & CHUNK_MASK) << CHUNK_SHIFT) | (x & CHUNK_MASK)
+        type_id = self.type_id(tile_type)
+        if chunk.types[i] == type_id and chunk.variants[i] == variant:
+            return # nothing changes, so don't throw away any caches
+        if chunk.types[i] == EMPTY:
+            chunk.count += 1
+            before = None
+        else:
+            before = (self.type_names[chunk.types[i]], chunk.variants[i])
+        chunk.types[i] = type_id
+        chunk.variants[i] = variant
+        chunk.solid = None
+        self.invalidate((x, y))
+        self._mark_dirty(x, y)
+        if self.listeners:
+            self._notify('grid', [((x, y), before, (tile_type, variant))])
+
+    def remove_tile(self, pos):
+        """Remove the tile at a grid position, if any
+
+        :param pos -- the X and Y grid position
+        :return -- the removed tile, or None if the cell was already empty
+        """
+        x, y = int(pos[0]), int(pos[1])
+        key = (x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+        chunk = self._chunk(key)
+        if chunk is None:
+            return None
+        i = ((y & CHUNK_MASK) << CHUNK_SHIFT) | (x & CHUNK_MASK)
+        if chunk.types[i] == EMPTY:
+            return None
+        tile = self._tile_dict(x, y, chunk, i)
+        chunk.types[i] = EMPTY
+        chunk.variants[i] = 0
+        chunk.count -= 1
+        chunk.solid = None
+        if not chunk.count:
+            del self.chunks[key]
+        self.invalidate((x, y))
+        self._mark_dirty(x, y)
+        if self.listeners:
+            self._notify('grid', [((x, y), (tile['type'], tile['variant']), None)])
+        return tile
+
+    @property
+    def offgrid_tiles(self):
+        """All the off-grid tiles, in the order they were placed"""
+        return [tile for tile_id, tile in self.offgrid]
+
+    def _offgrid_rect(self, tile):
+        """The pixel area an off-grid tile's image covers"""
+        # A tilemap loaded without a game (e.g. by the map converter) has no art to measure
+        images = self.game.assets.get(tile['type']) if self.game is not None else None
+        if images:
+            img = images[tile['variant']]
+            return (tile['pos'][0], tile['pos'][1], img.get_width(), img.get_height())
+        # Tiles we have no art for (e.g. spawners in the game) still need a footprint
+        return (tile['pos'][0], tile['pos'][1], self.tile_size, self.tile_size)
+
+    def add_offgrid(self, tile, tile_id=None):
+        """Place a decorative tile that isn't snapped to the grid
+
+        :param tile -- a {'type', 'variant', 'pos'} dict, with 'pos' in pixels
+        :param tile_id -- put a removed tile back under the id it had, so it is drawn in the same order as before
+        :return -- the id used to remove it again
+        """
+        tile_id = self.offgrid.insert(tile, self._offgrid_rect(tile), tile_id)
+        if self.listeners:
+            self._notify('offgrid', [(tile_id, None, tile)])
+        return tile_id
+
+    def remove_offgrid(self, tile_id):
+        """Remove an off-grid tile
+
+        :param tile_id -- the id handed out by add_offgrid() or a query
+        :return -- the removed tile
+        """
+        tile = self.offgrid.remove(tile_id)
+        if self.listeners:
+            self._notify('offgrid', [(tile_id, tile, None)])
+        return tile
+
+    def offgrid_at(self, pos):
+        """Find the off-grid tiles whose image covers a pixel position
+
+        :param pos -- the X and Y pixel position
+        :return -- a list of (tile_id, tile) pairs
+        """
+        return self.offgrid.query_point(pos)
+
+    def offgrid_in_rect(self, rect):
+        """Find the off-grid tiles whose image overlaps an area
+
+        :param rect -- the (x, y, w, h) area in pixels
+        :return -- a list of (tile_id, tile) pairs, in the order they were placed
+        """
+        return self.offgrid.query_rect(rect)
+
+    # -- bulk editing --
+    # These write straight into the chunk arrays and settle the caches once per operation, rather than once per cell
+
+    def _cell_values(self, types, variants):
+        """The (type, variant) of some cells given as arrays of type ids and variants, or None for the empty ones
+
+        Cells holding the same tile share one tuple, so a fill of a single tile builds only one.
+        """
+        codes = ((types.astype(np.int32) << 8) | variants).tolist()
+        names = self.type_names
+        values = dict.fromkeys(codes)
+        for code in values:
+            values[code] = None if code >> 8 == EMPTY else (names[code >> 8], code & 0xff)
+        return list(map(values.__getitem__, codes))
+
+    def _by_chunk(self, xs, ys):
+        """Sort cells given as arrays of grid positions by the chunk they are in
+
+        :param xs -- int64 array of X grid positions
+        :param ys -- int64 array of Y grid positions
+        :return -- (order, cells, groups): the order that sorts the cells by chunk, their flat indices within
+                   their chunks in that order, and a (key, start, end) for each chunk's slice of them
+        """
+        cxs, cys = xs >> CHUNK_SHIFT, ys >> CHUNK_SHIFT
+        order = np.lexsort((cys, cxs))
+        cxs, cys = cxs[order], cys[order]
+        cells = (((ys & CHUNK_MASK) << CHUNK_SHIFT) | (xs & CHUNK_MASK))[order]
+        bounds = (np.flatnonzero((cxs[1:] != cxs[:-1]) | (cys[1:] != cys[:-1])) + 1).tolist()
+        groups = [((int(cxs[start]), int(cys[start])), start, end) for start, end in zip([0] + bounds, bounds + [len(cells)])]
+        return order, cells, groups
+
+    def _mark_dirty_cells(self, key, cells):
+        """_mark_dirty() for some cells of one chunk, given as an array of flat indices"""
+        edited = np.zeros(CHUNK_AREA, dtype=bool)
+        edited[cells] = True
+        edited = edited.reshape(CHUNK_SIZE, CHUNK_SIZE)
+        # The edited cells spread out to their 4 neighbours, on a grid with a ring of the neighbouring chunks' edge cells around it
+        marked = np.zeros((CHUNK_SIZE + 2, CHUNK_SIZE + 2), dtype=bool)
+        for dx, dy in [(0, 0)] + AUTOTILE_SHIFTS:
+            marked[1 + dy:CHUNK_SIZE + 1 + dy, 1 + dx:CHUNK_SIZE + 1 + dx] |= edited
+        self._dirty_mask(key)[:] |= marked[1:-1, 1:-1].ravel()
+        cx, cy = key
+        for other, edge, side in (((cx + 1, cy), marked[1:-1, -1], (slice(None), 0)), ((cx - 1, cy), marked[1:-1, 0], (slice(None), -1)),
+                                  ((cx, cy - 1), marked[0, 1:-1], (-1, slice(None))), ((cx, cy + 1), marked[-1, 1:-1], (0, slice(None)))):
+            if edge.any():
+                self._dirty_mask(other).reshape(CHUNK_SIZE, CHUNK_SIZE)[side] |= edge
+
+    def _write_cells(self, xs, ys, type_ids, variants):
+        """Write grid cells given as NumPy arrays, one chunk at a time
+
+        Each chunk's cells are compared and written with a few array operations on its type and
+        variant arrays, and its cached surface and solid mask are thrown away once.
+
+        :param xs -- int64 array of the X grid positions; no cell may be in it twice
+        :param ys -- int64 array of the Y grid positions
+        :param type_ids -- the type id to write to each cell, EMPTY to empty it (or one for all of them)
+        :param variants -- the variant to write to each cell (or one for all of them)
+        :return -- how many cells actually changed
+        """
+        if not len(xs):
+            return 0
+        type_ids = np.broadcast_to(np.asarray(type_ids, dtype=np.int16), xs.shape)
+        # Empty cells always hold variant 0
+        variants = np.where(type_ids == EMPTY, 0, variants).astype(np.uint8)
+        # Sorted by chunk, every chunk's cells are one slice of the arrays
+        order, cells, groups = self._by_chunk(xs, ys)
+        type_ids, variants = type_ids[order], variants[order]
+
+        chunks = self.chunks
+        changes = [] if self.listeners else None
+        written = 0
+        for key, start, end in groups:
+            chunk = self._chunk(key)
+            new_types = type_ids[start:end]
+            if chunk is None:
+                if (new_types == EMPTY).all():
+                    continue
+                chunk = chunks[key] = Chunk()
+            types = np.frombuffer(chunk.types, dtype=np.int16)
+            chunk_variants = np.frombuffer(chunk.variants, dtype=np.uint8)
+            i, new_variants = cells[start:end], variants[start:end]
+            old_types, old_variants = types[i], chunk_variants[i]
+            keep = (old_types != new_types) | (old_variants != new_variants)
+            if not keep.any():
+                continue
+            i, new_types, new_variants = i[keep], new_types[keep], new_variants[keep]
+            old_types, old_variants = old_types[keep], old_variants[keep]
+            types[i] = new_types
+            chunk_variants[i] = new_variants
+            chunk.count += int(np.count_nonzero(new_types != EMPTY)) - int(np.count_nonzero(old_types != EMPTY))
+            chunk.solid = None
+            if not chunk.count:
+                del chunks[key]
+            self.invalidate((key[0] << CHUNK_SHIFT, key[1] << CHUNK_SHIFT))
+
+            self._mark_dirty_cells(key, i)
+            written += len(i)
+            if changes is not None:
+                positions = zip(((key[0] << CHUNK_SHIFT) | (i & CHUNK_MASK)).tolist(), ((key[1] << CHUNK_SHIFT) | (i >> CHUNK_SHIFT)).tolist())
+                changes.extend(zip(positions, self._cell_values(old_types, old_variants), self._cell_values(new_types, new_variants)))
+
+        if changes:
+            self._notify('grid', changes)
+        return written
+
+    def _rect_cells(self, rect):
+        """The X and Y positions of every cell in an (x, y, w, h) grid area, as int64 arrays"""
+        x0, y0, w, h = rect
+        ys, xs = np.mgrid[y0:y0 + max(h, 0), x0:x0 + max(w, 0)].astype(np.int64)
+        return xs.ravel(), ys.ravel()
+
+    def set_cells(self, cells):
+        """Write many grid cells in one go
+
+        The cells are written a chunk at a time with array operations (see _write_cells()), and the
+        cells to autotile are worked out at the end (see autotile_dirty()). Listeners still hear
+        about every cell that changed, in a single call.
+
+        :param cells -- an iterable of (x, y, tile type or None to empty the cell, variant); if a
+                        cell is in it more than once, the last one wins
+        :return -- how many cells actually changed
+        """
+        cells = list(cells)
+        if not cells:
+            return 0
+        xs, ys, tile_types, variants = zip(*cells)
+        # Types are registered in the order they first come up, as they would be one cell at a time
+        ids = {tile_type : EMPTY if tile_type is None else self.type_id(tile_type) for tile_type in dict.fromkeys(tile_types)}
+        xs, ys = np.array(xs, dtype=np.int64), np.array(ys, dtype=np.int64)
+        type_ids = np.array([ids[tile_type] for tile_type in tile_types], dtype=np.int16)
+        variants = np.array(variants, dtype=np.uint8)
+        # Only the last write to each cell counts: the first of each in the reversed order
+        keys = ((xs << 32) | (ys & 0xffffffff))[::-1]
+        unique, first = np.unique(keys, return_index=True)
+        if len(unique) < len(cells):
+            last = len(cells) - 1 - first
+            xs, ys, type_ids, variants = xs[last], ys[last], type_ids[last], variants[last]
+        return self._write_cells(xs, ys, type_ids, variants)
+
+    def _offgrid_anchored_in(self, rect):
+        """The off-grid tiles whose position (their top left corner) lies inside a grid area"""
+        ts = self.tile_size
+        area = (rect[0] * ts, rect[1] * ts, rect[2] * ts, rect[3] * ts)
+        return [(tile_id, tile) for tile_id, tile in self.offgrid_in_rect(area)
+                if area[0] <= tile['pos'][0] < area[0] + area[2] and area[1] <= tile['pos'][1] < area[1] + area[3]]
+
+    def fill_rect(self, rect, tile_type, variant=0):
+        """Fill a rectangle of grid cells with one tile
+
+        :param rect -- the (x, y, w, h) area in grid cells
+        :param tile_type -- the tile type name
+        :param variant -- index of the tile image within its type
+        :return -- how many cells changed
+        """
+        xs, ys = self._rect_cells(rect)
+        return self._write_cells(xs, ys, self.type_id(tile_type), variant)
+
+    def erase_rect(self, rect):
+        """Empty a rectangle of grid cells, along with the off-grid tiles placed inside it
+
+        :param rect -- the (x, y, w, h) area in grid cells
+        :return -- how many grid cells and off-grid tiles were removed
+        """
+        xs, ys = self._rect_cells(rect)
+        removed = self._write_cells(xs, ys, EMPTY, 0)
+        for tile_id, tile in self._offgrid_anchored_in(rect):
+            self.remove_offgrid(tile_id)
+            removed += 1
+        return removed
+
+    def flood_fill(self, pos, tile_type, variant=0, limit=FLOOD_FILL_LIMIT):
+        """Fill the area of same-type cells around a grid cell (connected through their sides) with one tile
+
+        Filling empty cells that aren't enclosed would go on forever, so the fill gives up as soon
+        as it leaves the chunks the map occupies, reaches FLOOD_FILL_REACH cells away from `pos`, or
+        passes `limit` cells.
+
+        :param pos -- the X and Y grid position to start from
+        :param tile_type -- the tile type name to fill with
+        :param variant -- index of the tile image within its type
+        :param limit -- the most cells to fill
+        :return -- how many cells changed, or None if the area was too big (and nothing was filled)
+        """
+        x, y = int(pos[0]), int(pos[1])
+        target = self._type_at(x, y)
+        if target != EMPTY and self.type_names[target] == tile_type:
+            return 0
+
+        keys = set(self.chunks) | self.lazy_chunks
+        if not keys:
+            return None
+        # The search covers the chunks the map occupies, cut down to FLOOD_FILL_REACH cells around the start,
+        # with a ring of cells around that. Past the occupied chunks everything is empty and open to infinity,
+        # so a fill that gets into the ring either isn't enclosed or is reaching too far; either way it stops
+        x0 = max(min(key[0] for key in keys) << CHUNK_SHIFT, x - FLOOD_FILL_REACH) - 1
+        y0 = max(min(key[1] for key in keys) << CHUNK_SHIFT, y - FLOOD_FILL_REACH) - 1
+        x1 = min((max(key[0] for key in keys) + 1) << CHUNK_SHIFT, x + FLOOD_FILL_REACH + 1) + 1
+        y1 = min((max(key[1] for key in keys) + 1) << CHUNK_SHIFT, y + FLOOD_FILL_REACH + 1) + 1
+        if not (x0 < x < x1 - 1 and y0 < y < y1 - 1):
+            return None
+        w, h = x1 - x0, y1 - y0
+
+        # Copy the types of the area into one array, a chunk at a time, and mark the cells the fill may enter
+        types = np.full((h, w), EMPTY, dtype=np.int16)
+        for cy in range(y0 >> CHUNK_SHIFT, ((y1 - 1) >> CHUNK_SHIFT) + 1):
+            for cx in range(x0 >> CHUNK_SHIFT, ((x1 - 1) >> CHUNK_SHIFT) + 1):
+                chunk = self._chunk((cx, cy))
+                if chunk is None:
+                    continue
+                left, top = cx << CHUNK_SHIFT, cy << CHUNK_SHIFT
+                ax, bx = max(left, x0), min(left + CHUNK_SIZE, x1)
+                ay, by = max(top, y0), min(top + CHUNK_SIZE, y1)
+                block = np.frombuffer(chunk.types, dtype=np.int16).reshape(CHUNK_SIZE, CHUNK_SIZE)
+                types[ay - y0:by - y0, ax - x0:bx - x0] = block[ay - top:by - top, ax - left:bx - left]
+        # Row after row in one bytearray: 1 where the fill may still go, so find() can skip along in C
+        open_cells = (types == target).ravel()
+        grid = bytearray(open_cells.tobytes())
+
+        # Scanline fill: take a whole run of open cells of a row at once, then look for open runs in the rows above and below it
+        filled = 0
+        stack = [(y - y0) * w + (x - x0)]
+        while stack:
+            i = stack.pop()
+            if not grid[i]:
+                continue
+            row = i - i % w
+            left = grid.rfind(0, row, i)
+            left = row if left < 0 else left + 1
+            right = grid.find(0, i, row + w)
+            if right < 0:
+                right = row + w
+            if left == row or right == row + w or row == 0 or row == (h - 1) * w:
+                return None
+            grid[left:right] = bytes(right - left)
+            filled += right - left
+            if filled > limit:
+                return None
+            for start, end in ((left - w, right - w), (left + w, right + w)):
+                j = grid.find(1, start, end)
+                while j >= 0:
+                    stack.append(j)
+                    j = grid.find(0, j, end)
+                    if j < 0:
+                        break
+                    j = grid.find(1, j, end)
+
+        # The filled cells are the open ones the fill has closed
+        cells = np.flatnonzero(open_cells & ~np.frombuffer(grid, dtype=bool))
+        return self._write_cells(x0 + cells % w, y0 + cells // w, self.type_id(tile_type), variant)
+
+    def copy_region(self, rect):
+        """Copy a rectangle of the map into a stamp that paste() can put down anywhere
+
+        :param rect -- the (x, y, w, h) area in grid cells
+        :return -- {'size': (w, h), 'tiles': [(dx, dy, type, variant)], 'offgrid': [tile dicts]}, with
+                   the positions relative to the top left of the area (off-grid ones in pixels)
+        """
+        x0, y0, w, h = rect
+        tiles = []
+        for y in range(y0, y0 + h):
+            for x in range(x0, x0 + w):
+                tile_type = self._type_at(x, y)
+                if tile_type != EMPTY:
+                    chunk = self.chunks[(x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)]
+                    tiles.append((x - x0, y - y0, self.type_names[tile_type], chunk.variants[((y & CHUNK_MASK) << CHUNK_SHIFT) | (x & CHUNK_MASK)]))
+        origin = (x0 * self.tile_size, y0 * self.tile_size)
+        offgrid = [{'type' : tile['type'], 'variant' : tile['variant'], 'pos' : (tile['pos'][0] - origin[0], tile['pos'][1] - origin[1])}
+                   for tile_id, tile in self._offgrid_anchored_in(rect)]
+        return {'size' : (w, h), 'tiles' : tiles, 'offgrid' : offgrid}
+
+    def paste(self, stamp, pos):
+        """Put a stamp from copy_region() down; its tiles replace what's under them, its empty cells leave the map alone
+
+        :param stamp -- the stamp
+        :param pos -- the X and Y grid position of its top left corner
+        :return -- how many grid cells changed plus how many off-grid tiles were added
+        """
+        x0, y0 = int(pos[0]), int(pos[1])
+        changed = self.set_cells((x0 + dx, y0 + dy, tile_type, variant) for dx, dy, tile_type, variant in stamp['tiles'])
+        origin = (x0 * self.tile_size, y0 * self.tile_size)
+        for tile in stamp['offgrid']:
+            self.add_offgrid({'type' : tile['type'], 'variant' : tile['variant'], 'pos' : (tile['pos'][0] + origin[0], tile['pos'][1] + origin[1])})
+            changed += 1
+        return changed
+
+    def _chunk_tiles(self, chunks):
+        for (cx, cy), chunk in chunks:
+            types = chunk.types
+            for i in range(CHUNK_AREA):
+                if types[i] != EMPTY:
+                    yield self._tile_dict((cx << CHUNK_SHIFT) | (i & CHUNK_MASK), (cy << CHUNK_SHIFT) | (i >> CHUNK_SHIFT), chunk, i)
+
+    def tiles(self):
+        """Iterate over every tile on the grid as {'type', 'variant', 'pos'} dicts"""
+        return self._chunk_tiles(self.all_chunks())
 
     def extract(self, id_pairs, keep=False):
         matches = []
 
         # Look for matches in the offgrid tiles first
-        for tile in self.offgrid_tiles.copy():
+        for tile_id, tile in self.offgrid:
             if (tile['type'], tile['variant']) in id_pairs:
                 matches.append(tile.copy())
                 if not keep:
-                    self.offgrid_tiles.remove(tile)
+                    self.remove_offgrid(tile_id)
+
+        # Lazily loaded chunks only need decoding if the file says they hold one of the types we want
+        if self.lazy_chunks:
+            wanted = type_mask(self.type_ids[tile_type] for tile_type, variant in id_pairs if tile_type in self.type_ids)
+            for key in list(self.lazy_chunks):
+                if self.map_file.index[key][4] & wanted:
+                    self._read_chunk(key)
 
         # Then iterate through tilemap, searching for matches
-        for loc in self.tilemap:
-            tile = self.tilemap[loc]
+        for tile in self._chunk_tiles(list(self.chunks.items())):
             if (tile['type'], tile['variant']) in id_pairs:
-                matches.append(tile.copy())
-                matches[-1]['pos'] = matches[-1]['pos'].copy()
-                # Convert tile coordinates to pixel positions
-                matches[-1]['pos'][0] *= self.tile_size
-                matches[-1]['pos'][1] *= self.tile_size
                 if not keep:
-                    del self.tilemap[loc]
+                    self.remove_tile(tile['pos'])
+                # Convert tile coordinates to pixel positions
+                tile['pos'] = [tile['pos'][0] * self.tile_size, tile['pos'][1] * self.tile_size]
+                matches.append(tile)
 
         return matches
 
@@ -59,34 +669,126 @@ class Tilemap:
         tiles = []
 
         # convert the pixel position into a GRID position
-        tile_loc =(int(pos[0] // self.tile_size), int(pos[1] // self.tile_size))
+        tile_loc = (int(pos[0] // self.tile_size), int(pos[1] // self.tile_size))
         for offset in NEIGHBOR_OFFSETS:
-            check_loc = str(tile_loc[0] + offset[0]) + ';' + str(tile_loc[1] + offset[1]) # outputs X;Y
-            if check_loc in self.tilemap:
-                tiles.append(self.tilemap[check_loc])
+            tile = self.get_tile((tile_loc[0] + offset[0], tile_loc[1] + offset[1]))
+            if tile:
+                tiles.append(tile)
         return tiles
 
+    def close(self):
+        """Let go of the binary map file, if one is open (any chunks not read yet are lost)"""
+        if self.map_file is not None:
+            self.map_file.close()
+            self.map_file = None
+        self.lazy_chunks = set()
+
+    def snapshot(self):
+        """A detached copy of the map for saving on another thread while editing carries on
+
+        Only the compact chunk arrays get copied (a few bytes per cell), and the off-grid tile
+        dicts are shared, since edits replace them rather than change them. The copy has no game,
+        so it can be saved but not drawn.
+
+        :return -- the copy, as a Tilemap
+        """
+        copy = Tilemap(None, tile_size=self.tile_size)
+        for key, chunk in self.all_chunks():
+            copied = copy.chunks[key] = Chunk()
+            copied.types, copied.variants, copied.count = array('h', chunk.types), array('B', chunk.variants), chunk.count
+        copy.type_names = list(self.type_names)
+        copy.type_ids = dict(self.type_ids)
+        copy.solid_types = list(self.solid_types)
+        copy.autotile_types = list(self.autotile_types)
+        copy.offgrid = self.offgrid.copy()
+        return copy
+
+    def _reset(self):
+        self.close()
+        self.chunks = {}
+        self.chunk_surfaces.clear()
+        self.dirty_cells.clear()
+        self.type_names = []
+        self.type_ids = {}
+        self.solid_types = []
+        self.autotile_types = []
+        self.offgrid = SpatialHash(OFFGRID_CELL_SIZE)
+
     def save(self, path):
         """Saving the current tilemap as a JSON file
 
         :param path -- the file path wherein the .json file will reside
         """
-        f = open(path, 'w')
-        json.dump({'tilemap' : self.tilemap, 'tile_size' : self.tile_size, 'offgrid' : self.offgrid_tiles}, f)
-        f.close()
+        tilemap = {}
+        for tile in self.tiles():
+            tilemap[str(tile['pos'][0]) + ';' + str(tile['pos'][1])] = tile # outputs X;Y
+
+        # Written to a temporary file and renamed into place, so a crash never leaves a half-written map behind
+        write_atomic(path, json.dumps({'tilemap' : tilemap, 'tile_size' : self.tile_size, 'offgrid' : self.offgrid_tiles}).encode('utf-8'))
+
+    def save_binary(self, path):
+        """Saving the current tilemap in the binary map format, see scripts/mapfile.py
+
+        :param path -- the file path wherein the binary map will reside
+        """
+        # Pull everything out of the file we were loaded from first, in case we are about to overwrite it
+        self.all_chunks()
+        self.close()
+        save_map_file(self, path)
 
     def load(self, path):
-        """Loading a local JSON file as the tilemap for the current level
+        """Loading a local map file as the tilemap for the current level
+
+        :param path -- the file path wherein the target .json or binary map resides
+        """
+        # Loading a map isn't an edit, so the listeners don't hear about the tiles going in
+        listeners, self.listeners = self.listeners, []
+        try:
+            if is_map_file(path):
+                self.load_binary(path)
+            else:
+                self.load_json(path)
+        finally:
+            self.listeners = listeners
+
+    def load_json(self, path):
+        """Load a map saved with save()
 
-        :param path -- the file path wherein the target .json file resides
+        :param path -- the file path wherein the .json file resides
         """
         f = open(path, 'r')
         map_data = json.load(f)
         f.close()
 
-        self.tilemap = map_data['tilemap']
+        self._reset()
+        self.set_cells((int(tile['pos'][0]), int(tile['pos'][1]), tile['type'], tile['variant']) for tile in map_data['tilemap'].values())
+        self.dirty_cells.clear()
         self.tile_size = map_data['tile_size']
-        self.offgrid_tiles = map_data['offgrid']
+        for tile in map_data['offgrid']:
+            self.add_offgrid(tile)
+
+    def load_binary(self, path):
+        """Open a binary map; its grid chunks are decoded on demand as the camera and physics reach them
+
+        :param path -- the file path wherein the binary map resides
+        """
+        map_file = MapFile(path)
+        if map_file.chunk_size != CHUNK_SIZE:
+            map_file.close()
+            raise ValueError('%s uses %d-cell chunks, expected %d' % (path, map_file.chunk_size, CHUNK_SIZE))
+
+        # Register the file's types in its own order, so the type ids in its chunks can be used as they are
+        self.use_type_table(map_file.type_names)
+        self.map_file = map_file
+        self.tile_size = map_file.tile_size
+        self.lazy_chunks = {key for key, entry in map_file.index.items() if entry[0]}
+
+        # The off-grid decor is small and the game extracts spawners from it straight away, so read it all now
+        offgrid = []
+        for key in map_file.index:
+            offgrid.extend(map_file.read_offgrid(key))
+        for order, tile in sorted(offgrid, key=lambda record: record[0]):
+            self.add_offgrid(tile)
 
     def solid_check(self, pos):
         """Checking whether the tile position observed is a solid and abides by the laws of PHYSICS_TILES
@@ -94,44 +796,269 @@ class Tilemap:
         :param pos -- the X and Y position of the tile we're checking
         :return -- the tile, if it is a valid physics object
         """
-        tile_loc = str(int(pos[0] // self.tile_size)) + ';' + str(int(pos[1] // self.tile_size))
-        if tile_loc in self.tilemap:
-            if self.tilemap[tile_loc]['type'] in PHYSICS_TILES:
-                return self.tilemap[tile_loc]
+        x, y = int(pos[0] // self.tile_size), int(pos[1] // self.tile_size)
+        tile_type = self._type_at(x, y)
+        if tile_type != EMPTY and self.solid_types[tile_type]:
+            return self.get_tile((x, y))
+
+    def solid_at(self, x, y):
+        """Whether the grid cell (x, y) holds one of the PHYSICS_TILES"""
+        tile_type = self._type_at(x, y)
+        return tile_type != EMPTY and self.solid_types[tile_type]
+
+    def raycast(self, start, end):
+        """Walk a line through the grid cell by cell and find the first physics tile it runs into
+
+        :param start -- the X and Y pixel position the line starts from
+        :param end -- the X and Y pixel position it goes to
+        :return -- the pixel position where the line enters the tile, or None if the way is clear
+        """
+        tile_size = self.tile_size
+        dx, dy = end[0] - start[0], end[1] - start[1]
+        x, y = int(start[0] // tile_size), int(start[1] // tile_size)
+        end_x, end_y = int(end[0] // tile_size), int(end[1] // tile_size)
+        step_x = 1 if dx > 0 else -1
+        step_y = 1 if dy > 0 else -1
+        # How far along the line (0 to 1) the next vertical and horizontal grid lines are, and the distance between them
+        next_x = ((x + (dx > 0)) * tile_size - start[0]) / dx if dx else float('inf')
+        next_y = ((y + (dy > 0)) * tile_size - start[1]) / dy if dy else float('inf')
+        delta_x = tile_size / abs(dx) if dx else float('inf')
+        delta_y = tile_size / abs(dy) if dy else float('inf')
+
+        t = 0
+        while True:
+            if self.solid_at(x, y):
+                return (start[0] + dx * t, start[1] + dy * t)
+            if (x, y) == (end_x, end_y):
+                return None
+            if next_x < next_y:
+                t, next_x, x = next_x, next_x + delta_x, x + step_x
+            else:
+                t, next_y, y = next_y, next_y + delta_y, y + step_y
+            if t > 1:
+                return None
+
+    def line_of_sight(self, start, end):
+        """Whether a straight line between two pixel positions is clear of physics tiles"""
+        return self.raycast(start, end) is None
+
+    def solid_around(self, x, y):
+        """Which of the nine cells around a grid cell hold physics tiles
+
+        :param x -- the X grid position of the central cell
+        :param y -- the Y grid position of the central cell
+        :return -- a bitmask with bit i set if the cell at NEIGHBOR_OFFSETS[i] is solid
+        """
+        local_x, local_y = x & CHUNK_MASK, y & CHUNK_MASK
+        if 0 < local_x < CHUNK_MASK and 0 < local_y < CHUNK_MASK:
+            # All nine cells are in the same chunk, so read them straight out of its array
+            chunk = self._chunk((x >> CHUNK_SHIFT, y >> CHUNK_SHIFT))
+            if chunk is None:
+                return 0
+            types = chunk.types
+            solid_types = self.solid_types
+            center = (local_y << CHUNK_SHIFT) | local_x
+            mask = 0
+            for bit, delta in NEIGHBOR_DELTAS:
+                tile_type = types[center + delta]
+                if tile_type != EMPTY and solid_types[tile_type]:
+                    mask |= bit
+            return mask
+
+        mask = 0
+        for i, offset in enumerate(NEIGHBOR_OFFSETS):
+            if self.solid_at(x + offset[0], y + offset[1]):
+                mask |= 1 << i
+        return mask
+
+    def solid_mask(self, chunk):
+        """The occupancy mask of a chunk: a flat bool array that is True for every cell holding a physics tile"""
+        if chunk.solid is None:
+            # EMPTY is -1, which picks the trailing False
+            lookup = np.array(self.solid_types + [False], dtype=bool)
+            chunk.solid = lookup[np.frombuffer(chunk.types, dtype=np.int16)]
+        return chunk.solid
+
+    def solid_cells(self, xs, ys):
+        """Vectorized solid check of many grid cells at once
+
+        :param xs -- NumPy int array of X grid positions
+        :param ys -- NumPy int array of Y grid positions
+        :return -- a bool array, True where the cell holds a physics tile
+        """
+        if not len(xs):
+            return np.zeros(0, dtype=bool)
+        xs = np.asarray(xs, dtype=np.int64)
+        ys = np.asarray(ys, dtype=np.int64)
+        local = ((ys & CHUNK_MASK) << CHUNK_SHIFT) | (xs & CHUNK_MASK)
+        # One integer per chunk key, so the distinct chunks can be found with a flat unique
+        keys = ((xs >> CHUNK_SHIFT) << 32) ^ ((ys >> CHUNK_SHIFT) & 0xFFFFFFFF)
+        chunk_keys, inverse = np.unique(keys, return_inverse=True)
+
+        # Stack the masks of those chunks into one table (missing chunks keep an all-False row) and gather from it
+        table = np.zeros((len(chunk_keys), CHUNK_AREA), dtype=bool)
+        for k, key in enumerate(chunk_keys.tolist()):
+            chunk = self._chunk((key >> 32, ((key & 0xFFFFFFFF) ^ 0x80000000) - 0x80000000))
+            if chunk is not None:
+                table[k] = self.solid_mask(chunk)
+        return table[inverse.reshape(-1), local]
+
+    def solid_check_many(self, positions):
+        """Vectorized version of solid_check() for many pixel positions at once
+
+        :param positions -- an (N, 2) array of X and Y pixel positions
+        :return -- a bool array, True where the position is inside a physics tile
+        """
+        cells = np.floor_divide(np.asarray(positions, dtype=np.float64).reshape(-1, 2), self.tile_size).astype(np.int64)
+        return self.solid_cells(cells[:, 0], cells[:, 1])
 
     def physics_rects_around(self, pos):
         rects = []
-        for tile in self.tiles_around(pos):
-            if tile['type'] in PHYSICS_TILES:
-                rects.append(pygame.Rect(tile['pos'][0] * self.tile_size, tile['pos'][1] * self.tile_size, self.tile_size, self.tile_size))
+        tile_loc = (int(pos[0] // self.tile_size), int(pos[1] // self.tile_size))
+        for offset in NEIGHBOR_OFFSETS:
+            x, y = tile_loc[0] + offset[0], tile_loc[1] + offset[1]
+            tile_type = self._type_at(x, y)
+            if tile_type != EMPTY and self.solid_types[tile_type]:
+                rects.append(pygame.Rect(x * self.tile_size, y * self.tile_size, self.tile_size, self.tile_size))
         return rects
 
+    def _autotile_chunk(self, key, cells, changes):
+        """Pick the variant of some autotiled cells of one chunk from which of their 4 neighbours share their type
+
+        The neighbour masks of the whole chunk come out of a few array operations, so this costs about
+        the same for one cell as for all of them.
+
+        :param key -- the chunk
+        :param cells -- flat indices of the cells to autotile within it
+        :param changes -- a list to add (pos, before, after) to for every cell that changed, or None
+        :return -- whether any cell changed
+        """
+        chunk = self._chunk(key)
+        if chunk is None:
+            return False
+        cx, cy = key
+        # The types of the chunk with a ring of its neighbours' edge cells around them
+        types = np.full((CHUNK_SIZE + 2, CHUNK_SIZE + 2), EMPTY, dtype=np.int16)
+        types[1:-1, 1:-1] = np.frombuffer(chunk.types, dtype=np.int16).reshape(CHUNK_SIZE, CHUNK_SIZE)
+        for dx, dy in AUTOTILE_SHIFTS:
+            other = self._chunk((cx + dx, cy + dy))
+            if other is None:
+                continue
+            other = np.frombuffer(other.types, dtype=np.int16).reshape(CHUNK_SIZE, CHUNK_SIZE)
+            if dx == 1:
+                types[1:-1, -1] = other[:, 0]
+            elif dx == -1:
+                types[1:-1, 0] = other[:, -1]
+            elif dy == -1:
+                types[0, 1:-1] = other[-1]
+            else:
+                types[-1, 1:-1] = other[0]
+
+        centre = types[1:-1, 1:-1]
+        # The bits follow AUTOTILE_SHIFTS: right, left, up, down
+        mask = ((types[1:-1, 2:] == centre).astype(np.uint8)
+                | (types[1:-1, :-2] == centre).astype(np.uint8) << 1
+                | (types[:-2, 1:-1] == centre).astype(np.uint8) << 2
+                | (types[2:, 1:-1] == centre).astype(np.uint8) << 3)
+        wanted = AUTOTILE_VARIANTS[mask].ravel()
+        centre = centre.ravel()
+
+        cells = np.asarray(cells, dtype=np.intp)
+        # EMPTY is -1, which picks the trailing False
+        autotiled = np.array(self.autotile_types + [False], dtype=bool)
+        variants = np.frombuffer(chunk.variants, dtype=np.uint8)
+        new = wanted[cells]
+        keep = autotiled[centre[cells]] & (new >= 0) & (new != variants[cells])
+        cells, new = cells[keep], new[keep]
+        if not len(cells):
+            return False
+        if changes is not None:
+            positions = zip(((cx << CHUNK_SHIFT) | (cells & CHUNK_MASK)).tolist(), ((cy << CHUNK_SHIFT) | (cells >> CHUNK_SHIFT)).tolist())
+            changes.extend(zip(positions, self._cell_values(centre[cells], variants[cells]), self._cell_values(centre[cells], new)))
+        variants[cells] = new
+        return True
+
+    def _autotile_chunks(self, chunk_cells):
+        """Autotile (chunk key, flat cell indices) pairs, dropping each changed chunk's cached surfaces once"""
+        changes = [] if self.listeners else None
+        for key, cells in chunk_cells:
+            if self._autotile_chunk(key, cells, changes):
+                self.invalidate((key[0] << CHUNK_SHIFT, key[1] << CHUNK_SHIFT))
+        if changes:
+            self._notify('grid', changes)
+
     def autotile(self):
-        for loc in self.tilemap:
-            tile = self.tilemap[loc]
-            neighbors = set()
-            for shift in [(1, 0), (-1, 0), (0, -1), (0, 1)]:
-                check_loc = str(tile['pos'][0] + shift[0]) + ';' + str(tile['pos'][1] + shift[1])
-                if check_loc in self.tilemap:
-                    if self.tilemap[check_loc]['type'] == tile['type']:
-                        neighbors.add(shift)
-            neighbors = tuple(sorted(neighbors))
-            if tile['type'] in AUTOTILE_TYPES and neighbors in AUTOTILE_MAP:
-                tile['variant'] = AUTOTILE_MAP[neighbors]
+        """Autotile the whole map"""
+        self._autotile_chunks((key, np.flatnonzero(np.frombuffer(chunk.types, dtype=np.int16) != EMPTY))
+                              for key, chunk in self.all_chunks())
+        self.dirty_cells.clear()
+
+    def autotile_dirty(self):
+        """Autotile only the cells whose neighbourhood changed since the last autotile"""
+        self._autotile_chunks([(key, np.flatnonzero(mask)) for key, mask in self.dirty_cells.items()])
+        self.dirty_cells.clear()
+
+    def _build_chunk_surface(self, key):
+        """Pre-render every grid tile that overlaps a chunk onto one surface
+
+        :param key -- the (chunk_x, chunk_y) to build
+        :return -- the baked surface, or None if there is nothing to draw there
+        """
+        size = CHUNK_SIZE * self.tile_size
+        origin = (key[0] * size, key[1] * size)
+        surf = None
+
+        # Chunks above and to the left go first, since big tiles from them can hang over into this one
+        for shift in [(-1, -1), (0, -1), (-1, 0), (0, 0)]:
+            cx, cy = key[0] + shift[0], key[1] + shift[1]
+            chunk = self._chunk((cx, cy))
+            if chunk is None:
+                continue
+            for i in range(CHUNK_AREA):
+                if chunk.types[i] == EMPTY:
+                    continue
+                img = self.game.assets[self.type_names[chunk.types[i]]][chunk.variants[i]]
+                pos = ((((cx << CHUNK_SHIFT) | (i & CHUNK_MASK)) * self.tile_size) - origin[0],
+                       (((cy << CHUNK_SHIFT) | (i >> CHUNK_SHIFT)) * self.tile_size) - origin[1])
+                if pos[0] + img.get_width() <= 0 or pos[1] + img.get_height() <= 0:
+                    continue
+                if surf is None:
+                    surf = pygame.Surface((size, size))
+                surf.blit(img, pos)
+
+        if surf is not None:
+            # The tile art is colorkeyed on black, so the baked chunk is too
+            surf.set_colorkey((0, 0, 0), pygame.RLEACCEL)
+        return surf
+
+    def chunk_surface(self, key):
+        """Get the pre-rendered surface of a chunk, building it if it isn't cached
+
+        :param key -- the (chunk_x, chunk_y) to look up
+        :return -- the baked surface, or None if there is nothing to draw there
+        """
+        if key in self.chunk_surfaces:
+            self.chunk_surfaces.move_to_end(key)
+            return self.chunk_surfaces[key]
+
+        surf = self._build_chunk_surface(key)
+        self.chunk_surfaces[key] = surf
+        # Least recently used chunks get evicted first
+        while len(self.chunk_surfaces) > self.chunk_cache_size:
+            self.chunk_surfaces.popitem(last=False)
+        return surf
 
     def render(self, surface, offset=(0, 0)):
-        # Render the off-grid "decorative elements" first
-        for tile in self.offgrid_tiles:
+        # Render the off-grid "decorative elements" first, but only the ones in view
+        for tile_id, tile in self.offgrid_in_rect((offset[0], offset[1], surface.get_width(), surface.get_height())):
             surface.blit(self.game.assets[tile['type']][tile['variant']],
                          (tile['pos'][0] - offset[0], tile['pos'][1] - offset[1]))
 
         # Drawing the objects that will be used for collision and physics and logic
-        # We only need to render the tiles that can be seen by the in-game camera
-        for x in range(offset[0] // self.tile_size, (offset[0] + surface.get_width()) // self.tile_size + 1):
-            for y in range(offset[1] // self.tile_size, (offset[1] + surface.get_height()) // self.tile_size + 1):
-                loc = str(x) + ';' + str(y)
-                if loc in self.tilemap:
-                    tile = self.tilemap[loc]
-                    surface.blit(self.game.assets[tile['type']][tile['variant']],
-                                 (tile['pos'][0] * self.tile_size - offset[0],
-                                  tile['pos'][1] * self.tile_size - offset[1]))
+        # We only need to render the chunks that can be seen by the in-game camera
+        size = CHUNK_SIZE * self.tile_size
+        for cx in range(offset[0] // size, (offset[0] + surface.get_width()) // size + 1):
+            for cy in range(offset[1] // size, (offset[1] + surface.get_height()) // size + 1):
+                surf = self.chunk_surface((cx, cy))
+                if surf is not None:
+                    surface.blit(surf, (cx * size - offset[0], cy * size - offset[1]))
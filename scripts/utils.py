@@ -3,6 +3,9 @@ import pygame
 
 BASE_IMAGE_PATH = 'data/images/'
 
+# Horizontally mirrored copies of images, made once per image rather than once per frame
+_flipped = {}
+
 def load_image(path):
     img = pygame.image.load(BASE_IMAGE_PATH + path).convert()
     img.set_colorkey((0, 0, 0))
@@ -14,24 +17,57 @@ def load_images(path):
         images.append(load_image(path + '/' + img_name))
     return images
 
-class Animation:
+def flipped(img):
+    """The horizontally mirrored version of an image, made the first time it is asked for"""
+    mirror = _flipped.get(img)
+    if mirror is None:
+        mirror = _flipped[img] = pygame.transform.flip(img, True, False)
+    return mirror
+
+class AnimationClip:
+    __slots__ = ('images', 'flipped', 'image_duration', 'loop', 'length', 'frame_index')
+
     def __init__(self, images, img_dur=5, loop=True):
-        self.images = images
+        """The frames of an animation and its timing, shared by everything that plays it (treat it as read-only)
+
+        :param images -- the frames, in order
+        :param img_dur -- how many ticks each frame is shown for
+        :param loop -- whether to start over at the end, or stop on the last frame
+        """
+        self.images = tuple(images)
+        self.flipped = tuple(flipped(img) for img in images)
         self.image_duration = img_dur
         self.loop = loop
-        self.done = False
-        self.frame = 0
+        self.length = img_dur * len(self.images) # in ticks
+        # Which image to show on each tick, so playing needs no division
+        self.frame_index = tuple(tick // img_dur for tick in range(self.length))
 
-    def copy(self):
-        return Animation(self.images, self.image_duration, self.loop)
+class Playhead:
+    __slots__ = ('clip', 'frame', 'done')
+
+    def __init__(self, clip):
+        """Where one entity is in an AnimationClip; all the per-entity state there is
+
+        :param clip -- the clip to play
+        """
+        self.play(clip)
+
+    def play(self, clip):
+        """Start a clip from the beginning, reusing this playhead instead of making a new one"""
+        self.clip = clip
+        self.frame = 0
+        self.done = False
 
     def update(self):
-        if self.loop:
-            self.frame = (self.frame + 1) % (self.image_duration * len(self.images))
+        clip = self.clip
+        if clip.loop:
+            self.frame = (self.frame + 1) % clip.length
         else:
-            self.frame = min(self.frame + 1, self.image_duration * len(self.images) - 1)
-            if self.frame >= self.image_duration * len(self.images) - 1:
+            self.frame = min(self.frame + 1, clip.length - 1)
+            if self.frame >= clip.length - 1:
                 self.done = True
 
-    def img(self):
-        return self.images[int(self.frame / self.image_duration)]
+    def img(self, flip=False):
+        """The current frame, mirrored if flip is set (the mirrored frames are made up front, so this never allocates)"""
+        clip = self.clip
+        return (clip.flipped if flip else clip.images)[clip.frame_index[self.frame]]
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The game loads its assets and maps relative to the repository root, and the tests never open a real window
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+os.environ['SDL_VIDEODRIVER'] = 'dummy'
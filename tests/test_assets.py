@@ -0,0 +1,47 @@
+import pygame
+
+from scripts.assets import AssetManager
+
+def make_assets():
+    pygame.display.init()
+    pygame.display.set_mode((1, 1))
+    assets = AssetManager(cache_dir=None, use_atlas=False)
+    assets['gun'] = 'loaded'
+    assets['anim'] = assets.lazy(lambda: 'lazy')
+    return assets
+
+def test_whole_store_views_include_lazy_entries():
+    assets = make_assets()
+    assert assets.keys() == ['gun', 'anim']
+    assert not assets.is_loaded('anim')
+    assert assets.items() == [('gun', 'loaded'), ('anim', 'lazy')]
+    assert assets.values() == ['loaded', 'lazy']
+    assert assets.is_loaded('anim')
+
+def test_copy_keeps_lazy_entries_lazy():
+    assets = make_assets()
+    copy = assets.copy()
+    assert isinstance(copy, AssetManager)
+    assert not copy.is_loaded('anim')
+    assert dict(copy.items()) == {'gun' : 'loaded', 'anim' : 'lazy'}
+    # Loading it in the copy leaves the original alone
+    assert not assets.is_loaded('anim')
+
+def test_update_matches_dict():
+    assets = make_assets()
+    assets.update([('a', 1)], b=2)
+    assets.update({'c' : assets.lazy(lambda: 3)})
+    assets.update(d=4)
+    assert not assets.is_loaded('c')
+    assert dict(assets.items()) == {'gun' : 'loaded', 'anim' : 'lazy', 'a' : 1, 'b' : 2, 'c' : 3, 'd' : 4}
+
+def test_removing_lazy_entries():
+    assets = make_assets()
+    assert assets.pop('anim') == 'lazy'
+    assert 'anim' not in assets
+    assets['anim'] = assets.lazy(lambda: 'again')
+    del assets['anim']
+    assert assets.pop('anim', None) is None
+    assert assets.setdefault('anim', 'default') == 'default'
+    assets.clear()
+    assert len(assets) == 0 and not assets.pending
@@ -0,0 +1,62 @@
+from scripts.history import EditHistory
+from scripts.tilemaps import Tilemap
+
+def grid(tilemap):
+    return sorted((tuple(tile['pos']), tile['type'], tile['variant']) for tile in tilemap.tiles())
+
+def paint(history, tilemap, cells, variant):
+    history.begin('paint')
+    for pos in cells:
+        tilemap.set_tile(pos, 'grass', variant)
+    history.end()
+
+def test_undo_across_the_limit_when_reworking_the_same_cells():
+    tilemap = Tilemap(None)
+    tilemap.set_tile((0, 1), 'stone', 0)
+    start = grid(tilemap)
+    history = EditHistory(tilemap, limit=25)
+    states = []
+    for variant in range(10):
+        paint(history, tilemap, [(x, 0) for x in range(10)], variant)
+        states.append(grid(tilemap))
+        assert history.size <= history.limit
+
+    # The oldest strokes were folded together rather than forgotten, so undoing goes all the way back
+    undone = 0
+    while history.undo():
+        undone += 1
+    assert grid(tilemap) == start
+    assert undone < 10
+
+    # ...and redoing comes forward through the recent strokes one at a time
+    for i in range(undone):
+        history.redo()
+    assert grid(tilemap) == states[-1]
+    history.undo()
+    assert grid(tilemap) == states[-2]
+
+def test_oldest_commands_are_forgotten_when_folding_saves_nothing():
+    tilemap = Tilemap(None)
+    history = EditHistory(tilemap, limit=25)
+    states = []
+    for row in range(5):
+        paint(history, tilemap, [(x, row) for x in range(10)], 0)
+        states.append(grid(tilemap))
+    assert history.size <= history.limit
+
+    while history.undo():
+        pass
+    # Only as far back as the commands that still fit in the limit
+    assert grid(tilemap) == states[5 - len(history.redo_stack) - 1]
+    assert len(history.redo_stack) == 2
+
+def test_folding_back_to_where_it_started_leaves_nothing_to_undo():
+    tilemap = Tilemap(None)
+    history = EditHistory(tilemap, limit=5)
+    paint(history, tilemap, [(x, 0) for x in range(4)], 0)
+    history.begin('erase')
+    for x in range(4):
+        tilemap.remove_tile((x, 0))
+    history.end()
+    assert history.size == 0
+    assert not history.can_undo()
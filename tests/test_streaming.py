@@ -0,0 +1,43 @@
+from game import Game
+from scripts.tilemaps import Tilemap
+
+def make_map(path, player_on_grid=False):
+    """A strip of stone with the player spawner above it and two enemy spawners on the grid"""
+    game = Game(headless=True, seed=0)
+    tilemap = Tilemap(game, tile_size=16)
+    tilemap.fill_rect((0, 5, 40, 1), 'stone', 1)
+    if player_on_grid:
+        tilemap.set_tile((2, 4), 'spawners', 0)
+    else:
+        tilemap.add_offgrid({'type' : 'spawners', 'variant' : 0, 'pos' : (32, 64)})
+    tilemap.set_tile((6, 4), 'spawners', 1)
+    tilemap.set_tile((20, 4), 'spawners', 1)
+    tilemap.save_binary(path)
+
+def test_grid_spawners_are_extracted_when_streaming(tmp_path):
+    path = str(tmp_path / 'map.bin')
+    make_map(path)
+
+    loaded = Game(headless=True, seed=0, map_path=path)
+    streamed = Game(headless=True, seed=0, map_path=path, stream=True)
+    streamed.streamer.update()
+    try:
+        # The same enemies as loading the whole map, and no spawner tiles left on the grid to be drawn or collided with
+        assert sorted(list(enemy.pos) for enemy in streamed.enemies) == sorted(list(enemy.pos) for enemy in loaded.enemies) == [[96, 64], [320, 64]]
+        assert streamed.tilemap.get_tile((6, 4)) is None
+        assert streamed.tilemap.get_tile((20, 4)) is None
+        assert streamed.tilemap.get_tile((6, 5))['type'] == 'stone'
+    finally:
+        streamed.streamer.close()
+
+def test_grid_player_spawner_when_streaming(tmp_path):
+    path = str(tmp_path / 'map.bin')
+    make_map(path, player_on_grid=True)
+
+    streamed = Game(headless=True, seed=0, map_path=path, stream=True)
+    streamed.streamer.update()
+    try:
+        assert list(streamed.player.pos) == [32, 64]
+        assert streamed.tilemap.get_tile((2, 4)) is None
+    finally:
+        streamed.streamer.close()